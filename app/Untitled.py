@@ -4,7 +4,8 @@ import os
 import streamlit as st
 import pandas as pd
 from datetime import date
-from sqlalchemy import create_engine, MetaData, Table, text
+from functools import lru_cache
+from sqlalchemy import create_engine, MetaData, text
 from sqlalchemy.orm import sessionmaker
 
 # =============================================================================
@@ -24,31 +25,26 @@ DATABASE_URL = (
 engine = create_engine(DATABASE_URL, echo=False)
 SessionLocal = sessionmaker(bind=engine)
 # =============================================================================
-# 2. Reflect schemas into MetaData objects
+# 2. Reflect schemas into MetaData objects (lazily, on first use)
 # =============================================================================
 
-# --- doctor_schema ---
-doctor_meta = MetaData(schema="doctor_schema")
-doctor_meta.reflect(bind=engine)
-Patients_doctor        = Table("patients", doctor_meta, autoload_with=engine)
-MedicalRecords_doctor  = Table("medical_records", doctor_meta, autoload_with=engine)
-Medications_doctor     = Table("medications", doctor_meta, autoload_with=engine)
-
-# --- patient_schema ---
-patient_meta = MetaData(schema="patient_schema")
-patient_meta.reflect(bind=engine)
-Patients_patient       = Table("patients", patient_meta, autoload_with=engine)
-MedicalRecords_patient = Table("medical_records", patient_meta, autoload_with=engine)
-
-# --- admin_schema ---
-admin_meta = MetaData(schema="admin_schema")
-admin_meta.reflect(bind=engine)
-Patients_admin           = Table("patients", admin_meta, autoload_with=engine)
-Hospitals_admin          = Table("hospitals", admin_meta, autoload_with=engine)
-Doctors_admin            = Table("doctors", admin_meta, autoload_with=engine)
-Medications_admin        = Table("medications", admin_meta, autoload_with=engine)
-InsuranceProviders_admin = Table("insurance_providers", admin_meta, autoload_with=engine)
-MedicalRecords_admin     = Table("medical_records", admin_meta, autoload_with=engine)
+# Nothing is reflected at import / on each rerun; a schema is reflected the
+# first time one of its tables is asked for, and then kept for the process.
+SCHEMA_TABLES = {
+    "doctor_schema":  ("patients", "medical_records", "medications"),
+    "patient_schema": ("patients", "medical_records"),
+    "admin_schema":   ("patients", "hospitals", "doctors", "medications",
+                       "insurance_providers", "medical_records"),
+}
+
+@lru_cache(maxsize=None)
+def get_metadata(schema: str):
+    meta = MetaData(schema=schema)
+    meta.reflect(bind=engine, only=list(SCHEMA_TABLES[schema]))
+    return meta
+
+def get_table(schema: str, name: str):
+    return get_metadata(schema).tables[f"{schema}.{name}"]
 
 # =============================================================================
 # 3. Helper: SET ROLE + SET search_path + execute SQL
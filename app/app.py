@@ -3,9 +3,15 @@
 
 import streamlit as st
 import pandas as pd
+import uuid
 from datetime import date
 
 import db  # the file we just created
+import db_async
+import export
+import rollups
+import validation
+import write_queue
 
 # =============================================================================
 # 1. Basic Streamlit configuration
@@ -17,6 +23,20 @@ st.set_page_config(
 
 st.title("Healthcare Management Interface")
 
+# Keeps cached tables current from the database's change events (db.py
+# section 19); a no-op after the first run.
+db.start_change_feed()
+
+# Form submissions are written in the background (write_queue.py); each
+# session remembers its job ids to report how they went. Starting the worker
+# here also drains whatever a previous run left in the journal.
+write_queue.queue.start()
+if "session_id" not in st.session_state:
+    st.session_state["session_id"] = uuid.uuid4().hex
+st.session_state.setdefault("write_jobs", {})
+# This session's reads see its own writes even when served by a replica.
+db.bind_session(st.session_state["session_id"])
+
 # =============================================================================
 # 2. Sidebar: Choose your “role” mode
 # =============================================================================
@@ -34,26 +54,137 @@ st.sidebar.write(
 )
 
 # =============================================================================
-# 3. Doctor Mode  
+# 3. Helpers
+# =============================================================================
+def submit_write(op: str, label: str, **values):
+    """
+    Queues an insert (see write_queue.py) without waiting for the database;
+    report_writes() shows the outcome on a later run. Values that fail
+    validation.py's checks are reported here and not queued.
+    """
+    _, schema, table_name = write_queue.OPS[op]
+    problems = validation.validate_record(schema, table_name, values)
+    if problems:
+        st.error(f"{label} not saved: " + "; ".join(problems))
+        return
+    job_id = write_queue.submit(op, session=st.session_state["session_id"], **values)
+    st.session_state["write_jobs"][job_id] = label
+    st.info(f"{label} queued; it is being saved in the background.")
+
+
+def report_writes():
+    """
+    Shows the session's finished background writes (once each) and how many
+    are still being saved.
+    """
+    jobs = st.session_state["write_jobs"]
+    if not jobs:
+        return
+    for job_id, job in write_queue.results(list(jobs)).items():
+        if job["status"] == "done":
+            st.success(f"{jobs.pop(job_id)} saved (id {job['result']}).")
+        elif job["status"] == "failed":
+            st.error(f"Failed to save {jobs.pop(job_id)}: {job['error']}")
+    if jobs:
+        st.caption(f"{len(jobs)} change(s) still being saved…")
+
+
+report_writes()
+
+
+def render_paged_table(key: str, fetch_page, sort_columns, empty_message: str):
+    """
+    Shows one page of a table with Prev/Next buttons. fetch_page is one of the
+    db.*_page functions; the current cursor lives in st.session_state.
+    sort_columns: choices for the sort box (None = primary key).
+    """
+    cursor_key = f"{key}_cursor"
+    st.session_state.setdefault(cursor_key, None)
+
+    def reset_cursor():
+        st.session_state[cursor_key] = None
+
+    ctl1, ctl2, ctl3 = st.columns(3)
+    with ctl1:
+        sort_column = st.selectbox(
+            "Sort by", sort_columns, key=f"{key}_sort", on_change=reset_cursor,
+            format_func=lambda c: c or "ID",
+        )
+    with ctl2:
+        direction = st.selectbox(
+            "Order", ["asc", "desc"], key=f"{key}_dir", on_change=reset_cursor
+        )
+    with ctl3:
+        page_size = st.selectbox(
+            "Rows per page", [25, 50, 100, 250], index=1,
+            key=f"{key}_size", on_change=reset_cursor
+        )
+
+    page = fetch_page(
+        page_size=page_size,
+        sort_column=sort_column,
+        direction=direction,
+        cursor=st.session_state[cursor_key],
+    )
+    if not page["rows"]:
+        st.info(empty_message)
+        return
+
+    st.dataframe(pd.DataFrame(page["rows"]), use_container_width=True)
+
+    def go(token):
+        st.session_state[cursor_key] = token
+
+    nav1, nav2, nav3 = st.columns([1, 1, 4])
+    with nav1:
+        st.button("◀ Prev", key=f"{key}_prev", disabled=page["prev_cursor"] is None,
+                  on_click=go, args=(page["prev_cursor"],))
+    with nav2:
+        st.button("Next ▶", key=f"{key}_next", disabled=page["next_cursor"] is None,
+                  on_click=go, args=(page["next_cursor"],))
+    with nav3:
+        if page["estimated_total"] is not None:
+            st.caption(f"≈ {page['estimated_total']:,} rows in total (estimate)")
+
+# =============================================================================
+# 4. Doctor Mode  
 # =============================================================================
 if role == "Doctor":
     st.header("👨‍⚕️ Doctor Dashboard")
 
-    # 3.1 Show all patients (doctor_schema.patients)
+    # 4.1 Search patients by name or condition, then page through all of them
     st.subheader("All Patients")
+    search = st.text_input(
+        "Search patients", key="patient_search",
+        placeholder="Name, surname or condition (e.g. 'smi', 'diabetes')",
+    )
+    if search.strip():
+        try:
+            hits = db.doctor_search_patients(search)
+            if hits:
+                st.dataframe(
+                    pd.DataFrame(hits)[["patient_id", "name", "age", "gender",
+                                        "blood_type", "matched", "condition"]],
+                    use_container_width=True,
+                )
+            else:
+                st.info(f"No patients match '{search.strip()}'.")
+        except Exception as e:
+            st.error(f"Error searching patients: {e}")
+
     try:
-        all_patients = db.doctor_get_all_patients()
-        if all_patients:
-            df_patients = pd.DataFrame(all_patients)
-            st.dataframe(df_patients, use_container_width=True)
-        else:
-            st.info("No patients found in doctor_schema.patients.")
+        render_paged_table(
+            "patients",
+            db.doctor_get_patients_page,
+            [None, "name", "age", "gender", "blood_type"],
+            "No patients found in doctor_schema.patients.",
+        )
     except Exception as e:
         st.error(f"Error loading patients: {e}")
 
     st.markdown("---")
 
-    # 3.2 Form: Add a new patient
+    # 4.2 Form: Add a new patient
     st.subheader("Add New Patient")
     with st.form("add_patient_form"):
         col1, col2, col3, col4 = st.columns(4)
@@ -72,34 +203,36 @@ if role == "Doctor":
                 st.error("Name and Blood Type cannot be empty.")
             else:
                 try:
-                    db.doctor_insert_patient(
+                    submit_write(
+                        "doctor_insert_patient",
+                        f"Patient '{p_name.strip()}'",
                         name=p_name.strip(),
                         age=int(p_age),
                         gender=p_gender,
                         blood_type=p_blood.strip()
                     )
-                    st.success(f"Patient '{p_name}' added successfully.")
-                    st.experimental_rerun()
                 except Exception as e:
-                    st.error(f"Failed to insert patient: {e}")
+                    st.error(f"Failed to queue patient: {e}")
 
     st.markdown("---")
 
-    # 3.3 Show all medical records (doctor_schema.medical_records)
+    # 4.3 Show medical records one page at a time, with patient / doctor /
+    #     hospital / insurer / medication names next to the ids
     st.subheader("All Medical Records")
     try:
-        records = db.doctor_get_all_medical_records()
-        if records:
-            df_records = pd.DataFrame(records)
-            st.dataframe(df_records, use_container_width=True)
-        else:
-            st.info("No records found in doctor_schema.medical_records.")
+        render_paged_table(
+            "records",
+            db.doctor_get_medical_record_details_page,
+            [None, "date_of_admission", "discharge_date", "patient_id",
+             "medical_condition", "billing_amount"],
+            "No records found in doctor_schema.medical_records.",
+        )
     except Exception as e:
         st.error(f"Error loading records: {e}")
 
     st.markdown("---")
 
-    # 3.4 Form: Add a new medical record
+    # 4.4 Form: Add a new medical record
     st.subheader("Add New Medical Record")
     with st.form("add_record_form"):
         c1, c2 = st.columns(2)
@@ -132,7 +265,9 @@ if role == "Doctor":
                 st.error("Medical Condition cannot be empty.")
             else:
                 try:
-                    db.doctor_insert_medical_record(
+                    submit_write(
+                        "doctor_insert_medical_record",
+                        f"Medical record for patient {int(mr_patient_id)}",
                         patient_id=int(mr_patient_id),
                         doctor_id=int(mr_doctor_id),
                         hospital_id=int(mr_hospital_id),
@@ -146,13 +281,11 @@ if role == "Doctor":
                         billing_amount=float(mr_billing_amount),
                         length_of_stay=int(mr_length_of_stay)
                     )
-                    st.success("Medical record added successfully.")
-                    st.experimental_rerun()
                 except Exception as e:
-                    st.error(f"Failed to insert medical record: {e}")
+                    st.error(f"Failed to queue medical record: {e}")
 
 # =============================================================================
-# 4. Patient Mode
+# 5. Patient Mode
 # =============================================================================
 elif role == "Patient":
     st.header("🧑 Patient Dashboard")
@@ -165,9 +298,8 @@ elif role == "Patient":
 
     if st.button("Load My Medical Records"):
         try:
-            my_records = db.patient_get_own_medical_records(patient_id=int(pid))
-            if my_records:
-                df_my = pd.DataFrame(my_records)
+            df_my = db.patient_get_own_medical_records_df(patient_id=int(pid))
+            if not df_my.empty:
                 st.dataframe(df_my, use_container_width=True)
             else:
                 st.warning(f"No medical records found for Patient ID {pid}.")
@@ -175,17 +307,32 @@ elif role == "Patient":
             st.error(f"Error fetching your records: {e}")
 
 # =============================================================================
-# 5. Admin Mode
+# 6. Admin Mode
 # =============================================================================
 elif role == "Admin":
     st.header("🛠️ Admin Dashboard")
 
-    # 5.1 Show all doctors (admin_schema.doctors)
+    # Rollups are refreshed in the background (rollups.py); this page only reads.
+    rollups.start_refresher()
+
+    # Load the independent panels concurrently (see db_async.py); each entry is
+    # the panel's data or the exception it raised.
+    panels = db_async.fan_out({
+        "doctors": db_async.admin_get_all_doctors_df,
+        "hospitals": db_async.admin_get_all_hospitals_df,
+        "rollups": rollups.status,
+    })
+
+    def panel(name):
+        if isinstance(panels[name], Exception):
+            raise panels[name]
+        return panels[name]
+
+    # 6.1 Show all doctors (admin_schema.doctors)
     st.subheader("All Doctors")
     try:
-        docs = db.admin_get_all_doctors()
-        if docs:
-            df_docs = pd.DataFrame(docs)
+        df_docs = panel("doctors")
+        if not df_docs.empty:
             st.dataframe(df_docs, use_container_width=True)
         else:
             st.info("No doctors found in admin_schema.doctors.")
@@ -194,7 +341,7 @@ elif role == "Admin":
 
     st.markdown("---")
 
-    # 5.2 Form: Add a new doctor
+    # 6.2 Form: Add a new doctor
     st.subheader("Add New Doctor")
     with st.form("add_doctor_form"):
         dcol1, dcol2, dcol3 = st.columns(3)
@@ -211,24 +358,23 @@ elif role == "Admin":
                 st.error("Name and Specialty cannot be empty.")
             else:
                 try:
-                    db.admin_insert_doctor(
+                    submit_write(
+                        "admin_insert_doctor",
+                        f"Doctor '{d_name.strip()}'",
                         name=d_name.strip(),
                         specialty=d_specialty.strip(),
                         phone_number=d_phone.strip()
                     )
-                    st.success(f"Doctor '{d_name}' added.")
-                    st.experimental_rerun()
                 except Exception as e:
-                    st.error(f"Failed to add doctor: {e}")
+                    st.error(f"Failed to queue doctor: {e}")
 
     st.markdown("---")
 
-    # 5.3 Show all hospitals (admin_schema.hospitals)
+    # 6.3 Show all hospitals (admin_schema.hospitals)
     st.subheader("All Hospitals")
     try:
-        hospitals = db.admin_get_all_hospitals()
-        if hospitals:
-            df_hosp = pd.DataFrame(hospitals)
+        df_hosp = panel("hospitals")
+        if not df_hosp.empty:
             st.dataframe(df_hosp, use_container_width=True)
         else:
             st.info("No hospitals found in admin_schema.hospitals.")
@@ -237,7 +383,7 @@ elif role == "Admin":
 
     st.markdown("---")
 
-    # 5.4 Form: Add new hospital
+    # 6.4 Form: Add new hospital
     st.subheader("Add New Hospital")
     with st.form("add_hospital_form"):
         hcol1, hcol2 = st.columns(2)
@@ -253,16 +399,154 @@ elif role == "Admin":
                 st.error("Hospital Name cannot be empty.")
             else:
                 try:
-                    db.admin_insert_hospital(
+                    submit_write(
+                        "admin_insert_hospital",
+                        f"Hospital '{h_name.strip()}'",
                         name=h_name.strip(),
                         address=h_address.strip() or None,
                         phone_number=h_phone.strip() or None
                     )
-                    st.success(f"Hospital '{h_name}' added.")
-                    st.experimental_rerun()
                 except Exception as e:
-                    st.error(f"Failed to add hospital: {e}")
+                    st.error(f"Failed to queue hospital: {e}")
 
-# --- Cell ---
+    st.markdown("---")
+
+    # 6.5 KPIs served from the daily rollup tables (see rollups.py)
+    st.subheader("KPIs")
+    try:
+        rollup_status = panel("rollups")
+        kcol1, kcol2, kcol3 = st.columns(3)
+        with kcol1:
+            k_rollup = st.selectbox("Per", list(rollups.ROLLUPS))
+        with kcol2:
+            k_bucket = st.selectbox("Over", [None] + list(db.TIME_BUCKETS), key="k_bucket")
+        with kcol3:
+            st.write("")
+            if st.button("Refresh rollups"):
+                if rollups.request_refresh():
+                    st.info("Refresh requested; the figures update on a later run.")
+                else:
+                    st.warning("No background refresher here; run `python rollups.py refresh`.")
+
+        refreshed = rollup_status["refreshed_at"]
+        pending = rollup_status["pending_records"]
+        st.caption(
+            f"As of {refreshed:%Y-%m-%d %H:%M:%S}"
+            + (f" — {pending} newer records not yet included" if pending else " — up to date")
+            if refreshed else "Rollups have not been built yet."
+        )
+        df_kpi = rollups.kpis(
+            k_rollup, time_bucket=k_bucket, order_by=None if k_bucket else "-admissions"
+        )
+        st.dataframe(df_kpi, use_container_width=True)
+    except Exception as e:
+        st.error(f"Error loading KPIs: {e}")
+
+    # 6.6 Analytics over admin_schema.medical_records (aggregated in the database)
+    st.subheader("Analytics")
+    analysis = st.selectbox(
+        "Analysis",
+        [
+            "Average billing per hospital",
+            "Length of stay by medical condition",
+            "Admissions per admission type per month",
+            "Custom",
+        ],
+    )
+    try:
+        if analysis == "Average billing per hospital":
+            df_agg = db.admin_aggregate(
+                ["count", "avg:billing_amount"], group_by=["hospital_id"],
+                order_by=["-avg_billing_amount"],
+            )
+            st.dataframe(df_agg, use_container_width=True)
+            if not df_agg.empty:
+                st.bar_chart(df_agg.set_index("hospital_id")["avg_billing_amount"])
+        elif analysis == "Length of stay by medical condition":
+            df_agg = db.admin_aggregate(
+                ["count", "avg:length_of_stay", "p50:length_of_stay",
+                 "p90:length_of_stay", "max:length_of_stay"],
+                group_by=["medical_condition"],
+            )
+            st.dataframe(df_agg, use_container_width=True)
+            condition = st.selectbox(
+                "Distribution for", df_agg["medical_condition"].tolist()
+            ) if not df_agg.empty else None
+            if condition is not None:
+                df_hist = db.admin_histogram(
+                    "length_of_stay", bins=15, filters={"medical_condition": condition}
+                )
+                if not df_hist.empty:
+                    st.bar_chart(df_hist.set_index("lower")["count"])
+        elif analysis == "Admissions per admission type per month":
+            df_agg = db.admin_aggregate(
+                ["count"], group_by=["admission_type"], time_bucket="month",
+            )
+            if not df_agg.empty:
+                st.line_chart(
+                    df_agg.pivot(index="month", columns="admission_type", values="count")
+                )
+            st.dataframe(df_agg, use_container_width=True)
+        else:
+            acol1, acol2, acol3 = st.columns(3)
+            with acol1:
+                a_measure = st.selectbox(
+                    "Measure",
+                    ["count", "avg:billing_amount", "sum:billing_amount",
+                     "avg:length_of_stay", "p50:length_of_stay",
+                     "count_distinct:patient_id"],
+                )
+            with acol2:
+                a_group = st.multiselect(
+                    "Group by",
+                    ["hospital_id", "doctor_id", "provider_id", "medication_id",
+                     "medical_condition", "admission_type"],
+                )
+            with acol3:
+                a_bucket = st.selectbox("Time bucket", [None] + list(db.TIME_BUCKETS))
+            a_range = st.date_input(
+                "Admission date range", value=(date(2000, 1, 1), date.today())
+            )
+            if len(a_range) != 2:
+                st.info("Pick both a start and an end date.")
+            else:
+                df_agg = db.admin_aggregate(
+                    [a_measure], group_by=a_group, time_bucket=a_bucket,
+                    filters=[("date_of_admission", "between", tuple(a_range))],
+                )
+                st.dataframe(df_agg, use_container_width=True)
+    except Exception as e:
+        st.error(f"Error running analysis: {e}")
 
+    st.markdown("---")
+
+    # 6.7 Columnar export of medical records for offline analysis (export.py)
+    st.subheader("Export for Offline Analysis")
+    ecol1, ecol2, ecol3 = st.columns(3)
+    with ecol1:
+        e_dir = st.text_input("Export directory", value=export.EXPORT_DIR)
+    with ecol2:
+        e_format = st.selectbox("Format", list(export.FORMATS))
+    with ecol3:
+        e_full = st.checkbox("Full re-export", value=False)
+    try:
+        e_status = export.status(e_dir)
+        st.caption(
+            f"Last export {e_status['exported_at']} ({e_status['format']}), "
+            f"{e_status['pending_records']} new records since"
+            if e_status["exported_at"] else "Nothing exported to this directory yet."
+        )
+        if st.button("Export medical records"):
+            with st.spinner("Exporting ..."):
+                result = export.export(e_dir, e_format, full=e_full)
+            if result["rows"] is None:
+                st.warning("medical_records is busy (bulk load running?); try again shortly.")
+            else:
+                st.success(
+                    f"Exported {result['rows']} records into {len(result['files'])} "
+                    f"files in {result['seconds']:.1f}s."
+                )
+    except Exception as e:
+        st.error(f"Export failed: {e}")
 
+# --- Cell ---
@@ -0,0 +1,140 @@
+# bench_dataframe.py
+#
+# Compares the two ways of turning query results into a DataFrame:
+#   - dicts   : [dict(row) ...] then pd.DataFrame(list_of_dicts)   (old path)
+#   - columnar: db.frame_from_batches(...) with dtypes from the reflected
+#               column types                                       (new path)
+#
+# By default rows are synthetic medical_records tuples generated in memory,
+# so only the client-side cost is measured and no database is needed.
+# --live reads doctor_schema.medical_records through both paths instead.
+#
+#   python bench_dataframe.py                 # 10k, 100k, 1M rows
+#   python bench_dataframe.py --rows 10000 --repeat 5
+#   python bench_dataframe.py --live
+
+import argparse
+import gc
+import random
+import time
+from datetime import date, timedelta
+from decimal import Decimal
+
+import pandas as pd
+from sqlalchemy import Column, Date, Integer, MetaData, Numeric, String, Table
+
+import db
+
+# Same shape as doctor_schema.medical_records.
+_meta = MetaData()
+MEDICAL_RECORDS = Table(
+    "medical_records", _meta,
+    Column("record_id", Integer, primary_key=True),
+    Column("patient_id", Integer),
+    Column("doctor_id", Integer),
+    Column("hospital_id", Integer),
+    Column("provider_id", Integer),
+    Column("medication_id", Integer),
+    Column("medical_condition", String),
+    Column("date_of_admission", Date),
+    Column("discharge_date", Date),
+    Column("admission_type", String),
+    Column("room_number", Integer),
+    Column("billing_amount", Numeric(12, 2)),
+    Column("length_of_stay", Integer),
+)
+
+CONDITIONS = ["Asthma", "Cancer", "Diabetes", "Hypertension", "Obesity", "Arthritis"]
+ADMISSION_TYPES = ["Emergency", "Elective", "Routine"]
+
+
+def synthetic_rows(n: int, seed: int = 0):
+    rng = random.Random(seed)
+    start = date(2019, 1, 1)
+    rows = []
+    for i in range(1, n + 1):
+        admitted = start + timedelta(days=rng.randrange(2000))
+        stay = rng.randrange(1, 30)
+        rows.append((
+            i,
+            rng.randrange(1, 50_000),
+            rng.randrange(1, 500),
+            rng.randrange(1, 50),
+            rng.randrange(1, 10),
+            rng.randrange(1, 200),
+            rng.choice(CONDITIONS),
+            admitted,
+            admitted + timedelta(days=stay),
+            rng.choice(ADMISSION_TYPES),
+            rng.randrange(100, 500),
+            Decimal(rng.randrange(100_000, 5_000_000)) / 100,
+            stay if i % 50 else None,  # a few NULLs
+        ))
+    return rows
+
+
+def dict_path(names, rows):
+    return pd.DataFrame([dict(zip(names, r)) for r in rows])
+
+
+def columnar_path(names, types, rows, batch_size=db.STREAM_BATCH_SIZE):
+    batches = (rows[i:i + batch_size] for i in range(0, len(rows), batch_size))
+    return db.frame_from_batches(names, types, batches)
+
+
+def _time(fn, repeat: int):
+    best = float("inf")
+    for _ in range(repeat):
+        gc.collect()
+        started = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def run_synthetic(sizes, repeat: int):
+    names = [c.name for c in MEDICAL_RECORDS.c]
+    types = [c.type for c in MEDICAL_RECORDS.c]
+    print(f"{'rows':>9} {'dicts':>10} {'columnar':>10} {'speedup':>8}")
+    for n in sizes:
+        rows = synthetic_rows(n)
+        t_dict = _time(lambda: dict_path(names, rows), repeat)
+        t_col = _time(lambda: columnar_path(names, types, rows), repeat)
+        print(f"{n:>9,} {t_dict:>9.3f}s {t_col:>9.3f}s {t_dict / t_col:>7.1f}x")
+
+
+def run_live(repeat: int):
+    # Both helpers go through the read cache; clear it on every call so each
+    # repeat reads from the database instead of timing a cache hit.
+    def old():
+        db.read_cache.clear()
+        return pd.DataFrame(db.doctor_get_all_medical_records())
+
+    def new():
+        db.read_cache.clear()
+        return db.table_dataframe("doctor_schema", "medical_records")
+
+    t_dict = _time(old, repeat)
+    t_col = _time(new, repeat)
+    print(f"doctor_schema.medical_records: dicts {t_dict:.3f}s, "
+          f"columnar {t_col:.3f}s ({t_dict / t_col:.1f}x)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="DataFrame construction benchmark (dict vs columnar)")
+    parser.add_argument("--rows", type=int, action="append",
+                        help="row count (repeatable); default 10k, 100k, 1M")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--live", action="store_true",
+                        help="read doctor_schema.medical_records from the database")
+    args = parser.parse_args(argv)
+
+    if args.live:
+        run_live(args.repeat)
+    else:
+        run_synthetic(args.rows or [10_000, 100_000, 1_000_000], args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,523 @@
+# bench_db.py
+#
+# Benchmark harness for db.py.
+#
+# 1. Gets a database: --url, or a throw-away local PostgreSQL cluster started
+#    with the optional `pgserver` package (pip install pgserver).
+# 2. Creates the schemas / roles / RLS policy the app expects and seeds a
+#    synthetic healthcare dataset (patients, doctors, hospitals,
+#    insurance_providers, medications, medical_records) at --scale patients.
+# 3. Times import + reflection, then every public doctor_* / patient_* /
+#    admin_* function in db.py: p50 / p95 / p99 latency, throughput and RSS.
+# 4. Writes JSON that can be compared against an earlier run (--compare), so
+#    regressions show up between commits.
+#
+#   python bench_db.py --scale 10000 --out results.json
+#   python bench_db.py --url postgresql+psycopg2://postgres@localhost/bench --seed
+#   python bench_db.py --scale 10000 --compare results.json
+#
+# Read functions run with the read cache cleared before every call (pass
+# --cache to measure warm-cache behaviour instead).
+
+import argparse
+import datetime
+import inspect
+import json
+import os
+import platform
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+# =============================================================================
+# 1. Database: given URL or a temporary local cluster
+# =============================================================================
+
+def start_temporary_cluster():
+    """
+    Starts a private PostgreSQL cluster in a temp directory (via pgserver) and
+    returns (url, server). The cluster is removed when the process exits.
+    """
+    try:
+        import pgserver
+    except ImportError:
+        raise SystemExit(
+            "No --url given and pgserver is not installed "
+            "(pip install pgserver, or point --url at a scratch database)."
+        )
+    data_dir = tempfile.mkdtemp(prefix="healthcare-bench-")
+    server = pgserver.get_server(data_dir, cleanup_mode="delete")
+    server.psql('CREATE DATABASE "Healthcare_bench";')
+    url = f"postgresql+psycopg2://postgres@/Healthcare_bench?host={data_dir}"
+    return url, server
+
+
+# =============================================================================
+# 2. Schema + synthetic data
+# =============================================================================
+
+SCHEMA_SQL = """
+DO $$ BEGIN
+  IF NOT EXISTS (SELECT 1 FROM pg_roles WHERE rolname = 'doctor_user')  THEN CREATE ROLE doctor_user;  END IF;
+  IF NOT EXISTS (SELECT 1 FROM pg_roles WHERE rolname = 'patient_user') THEN CREATE ROLE patient_user; END IF;
+  IF NOT EXISTS (SELECT 1 FROM pg_roles WHERE rolname = 'admin_user')   THEN CREATE ROLE admin_user;   END IF;
+END $$;
+
+DROP SCHEMA IF EXISTS doctor_schema, patient_schema, admin_schema CASCADE;
+DROP TABLE IF EXISTS public.medical_records, public.patients, public.doctors,
+    public.hospitals, public.insurance_providers, public.medications CASCADE;
+
+CREATE TABLE public.patients (
+    patient_id serial PRIMARY KEY, name text NOT NULL, age int,
+    gender text, blood_type text);
+CREATE TABLE public.doctors (
+    doctor_id serial PRIMARY KEY, name text NOT NULL, specialty text, phone_number text);
+CREATE TABLE public.hospitals (
+    hospital_id serial PRIMARY KEY, name text NOT NULL, address text, phone_number text);
+CREATE TABLE public.insurance_providers (
+    provider_id serial PRIMARY KEY, name text NOT NULL);
+CREATE TABLE public.medications (
+    medication_id serial PRIMARY KEY, name text NOT NULL);
+CREATE TABLE public.medical_records (
+    record_id serial PRIMARY KEY,
+    patient_id int, doctor_id int, hospital_id int, provider_id int, medication_id int,
+    medical_condition text, date_of_admission date, discharge_date date,
+    admission_type text, room_number int, billing_amount numeric(12, 2),
+    length_of_stay int);
+
+CREATE SCHEMA doctor_schema;
+CREATE SCHEMA patient_schema;
+CREATE SCHEMA admin_schema;
+CREATE TABLE doctor_schema.patients            (LIKE public.patients INCLUDING ALL);
+CREATE TABLE doctor_schema.medical_records     (LIKE public.medical_records INCLUDING ALL);
+CREATE TABLE doctor_schema.medications         (LIKE public.medications INCLUDING ALL);
+CREATE TABLE patient_schema.patients           (LIKE public.patients INCLUDING ALL);
+CREATE TABLE patient_schema.medical_records    (LIKE public.medical_records INCLUDING ALL);
+CREATE TABLE admin_schema.patients             (LIKE public.patients INCLUDING ALL);
+CREATE TABLE admin_schema.hospitals            (LIKE public.hospitals INCLUDING ALL);
+CREATE TABLE admin_schema.doctors              (LIKE public.doctors INCLUDING ALL);
+CREATE TABLE admin_schema.medications          (LIKE public.medications INCLUDING ALL);
+CREATE TABLE admin_schema.insurance_providers  (LIKE public.insurance_providers INCLUDING ALL);
+CREATE TABLE admin_schema.medical_records      (LIKE public.medical_records INCLUDING ALL);
+
+GRANT USAGE ON SCHEMA doctor_schema TO doctor_user;
+GRANT SELECT, INSERT, UPDATE, DELETE ON ALL TABLES IN SCHEMA doctor_schema TO doctor_user;
+GRANT USAGE ON SCHEMA patient_schema TO patient_user;
+GRANT SELECT ON ALL TABLES IN SCHEMA patient_schema TO patient_user;
+GRANT USAGE ON SCHEMA admin_schema TO admin_user;
+GRANT SELECT, INSERT, UPDATE, DELETE ON ALL TABLES IN SCHEMA admin_schema TO admin_user;
+GRANT USAGE ON ALL SEQUENCES IN SCHEMA public TO doctor_user, admin_user;
+
+ALTER TABLE patient_schema.medical_records ENABLE ROW LEVEL SECURITY;
+CREATE POLICY patient_own_records ON patient_schema.medical_records
+    FOR SELECT TO patient_user
+    USING (patient_id = current_setting('app.patient_id')::int);
+"""
+
+SEED_SQL = """
+INSERT INTO public.hospitals (name, address, phone_number)
+SELECT 'Hospital ' || g, g || ' Main St', '555-' || lpad(g::text, 4, '0')
+FROM generate_series(1, :hospitals) g;
+
+INSERT INTO public.doctors (name, specialty, phone_number)
+SELECT 'Dr. ' || g,
+       (ARRAY['Cardiology','Oncology','Neurology','Pediatrics','Orthopedics'])[1 + g % 5],
+       '555-' || lpad(g::text, 4, '0')
+FROM generate_series(1, :doctors) g;
+
+INSERT INTO public.insurance_providers (name)
+SELECT (ARRAY['Aetna','Blue Cross','Cigna','Medicare','UnitedHealthcare'])[1 + (g - 1) % 5]
+       || CASE WHEN g > 5 THEN ' ' || g ELSE '' END
+FROM generate_series(1, :providers) g;
+
+INSERT INTO public.medications (name)
+SELECT (ARRAY['Aspirin','Ibuprofen','Lipitor','Paracetamol','Penicillin'])[1 + g % 5] || ' ' || g
+FROM generate_series(1, :medications) g;
+
+INSERT INTO public.patients (name, age, gender, blood_type)
+SELECT 'Patient ' || g, 1 + (hashint4(g) & 2147483647) % 95,
+       (ARRAY['Male','Female','Other'])[1 + g % 3],
+       (ARRAY['A+','A-','B+','B-','AB+','AB-','O+','O-'])[1 + g % 8]
+FROM generate_series(1, :patients) g;
+
+INSERT INTO public.medical_records (
+    patient_id, doctor_id, hospital_id, provider_id, medication_id,
+    medical_condition, date_of_admission, discharge_date,
+    admission_type, room_number, billing_amount, length_of_stay)
+SELECT 1 + (g - 1) % :patients,
+       1 + (hashint4(g) & 2147483647) % :doctors,
+       1 + (hashint4(g + 1) & 2147483647) % :hospitals,
+       1 + (hashint4(g + 2) & 2147483647) % :providers,
+       1 + (hashint4(g + 3) & 2147483647) % :medications,
+       (ARRAY['Asthma','Arthritis','Cancer','Diabetes','Hypertension','Obesity'])[1 + g % 6],
+       DATE '2019-01-01' + (hashint4(g + 4) & 2147483647) % 2000,
+       DATE '2019-01-01' + (hashint4(g + 4) & 2147483647) % 2000 + 1 + g % 30,
+       (ARRAY['Emergency','Elective','Routine'])[1 + g % 3],
+       100 + g % 400,
+       ((hashint4(g + 5) & 2147483647) % 5000000) / 100.0,
+       1 + g % 30
+FROM generate_series(1, :records) g;
+
+INSERT INTO doctor_schema.patients            SELECT * FROM public.patients;
+INSERT INTO doctor_schema.medical_records     SELECT * FROM public.medical_records;
+INSERT INTO doctor_schema.medications         SELECT * FROM public.medications;
+INSERT INTO patient_schema.patients           SELECT * FROM public.patients;
+INSERT INTO patient_schema.medical_records    SELECT * FROM public.medical_records;
+INSERT INTO admin_schema.patients             SELECT * FROM public.patients;
+INSERT INTO admin_schema.hospitals            SELECT * FROM public.hospitals;
+INSERT INTO admin_schema.doctors              SELECT * FROM public.doctors;
+INSERT INTO admin_schema.medications          SELECT * FROM public.medications;
+INSERT INTO admin_schema.insurance_providers  SELECT * FROM public.insurance_providers;
+INSERT INTO admin_schema.medical_records      SELECT * FROM public.medical_records;
+"""
+
+
+def dataset_size(scale: int, records_per_patient: int = 3):
+    """
+    Row counts for a dataset with `scale` patients.
+    """
+    return {
+        "patients": scale,
+        "records": scale * records_per_patient,
+        "doctors": max(20, scale // 100),
+        "hospitals": max(10, scale // 1000),
+        "providers": 10,
+        "medications": 200,
+    }
+
+
+def seed(url: str, scale: int, records_per_patient: int = 3):
+    """
+    (Re)creates the three schemas in the database at `url` and fills them.
+    Returns the row counts used.
+    """
+    from sqlalchemy import create_engine, text
+
+    sizes = dataset_size(scale, records_per_patient)
+    eng = create_engine(url)
+    with eng.begin() as conn:
+        conn.exec_driver_sql(SCHEMA_SQL)
+        for statement in SEED_SQL.split(";\n"):
+            if statement.strip():
+                conn.execute(text(statement), sizes)
+        for table, pk in (("patients", "patient_id"), ("doctors", "doctor_id"),
+                          ("hospitals", "hospital_id"), ("medications", "medication_id"),
+                          ("insurance_providers", "provider_id"),
+                          ("medical_records", "record_id")):
+            conn.exec_driver_sql(
+                f"SELECT setval(pg_get_serial_sequence('public.{table}', '{pk}'), "
+                f"(SELECT max({pk}) FROM public.{table}))"
+            )
+    with eng.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.exec_driver_sql("ANALYZE")
+    eng.dispose()
+    return sizes
+
+
+# =============================================================================
+# 3. Timing
+# =============================================================================
+
+def _percentile(sorted_values, pct: float):
+    if not sorted_values:
+        return None
+    k = (len(sorted_values) - 1) * pct / 100.0
+    lo = int(k)
+    hi = min(lo + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+
+def _rss_kb():
+    # Linux reports ru_maxrss in KiB, macOS in bytes.
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == "darwin" else rss
+
+
+def summarize(latencies, wall_seconds: float):
+    """
+    Latency percentiles (ms) and throughput (calls/s) for a list of seconds.
+    """
+    ordered = sorted(latencies)
+    return {
+        "calls": len(ordered),
+        "p50_ms": _percentile(ordered, 50) * 1000,
+        "p95_ms": _percentile(ordered, 95) * 1000,
+        "p99_ms": _percentile(ordered, 99) * 1000,
+        "mean_ms": statistics.fmean(ordered) * 1000,
+        "throughput_per_s": len(ordered) / wall_seconds if wall_seconds else None,
+    }
+
+
+def time_calls(fn, make_args, iterations: int, warmup: int, max_seconds: float,
+               before_each=None):
+    for _ in range(warmup):
+        if before_each:
+            before_each()
+        args, kwargs = make_args()
+        fn(*args, **kwargs)
+
+    latencies = []
+    rss_before = _rss_kb()
+    wall_started = time.perf_counter()
+    for _ in range(iterations):
+        if before_each:
+            before_each()
+        args, kwargs = make_args()
+        started = time.perf_counter()
+        fn(*args, **kwargs)
+        latencies.append(time.perf_counter() - started)
+        if time.perf_counter() - wall_started > max_seconds:
+            break
+    wall = time.perf_counter() - wall_started
+    result = summarize(latencies, wall)
+    result["rss_growth_kb"] = _rss_kb() - rss_before
+    return result
+
+
+def time_import(url: str, runs: int = 3):
+    """
+    Import time of db.py and time of a full (uncached) reflection, each in a
+    fresh interpreter.
+    """
+    child = (
+        "import json, time; t = time.perf_counter(); import db; "
+        "t1 = time.perf_counter(); db.load_schemas(refresh=True); "
+        "t2 = time.perf_counter(); "
+        "print(json.dumps({'import_s': t1 - t, 'reflect_s': t2 - t1}))"
+    )
+    samples = []
+    with tempfile.TemporaryDirectory() as cache_dir:
+        env = dict(os.environ, DATABASE_URL=url, SCHEMA_CACHE_DIR=cache_dir)
+        for _ in range(runs):
+            out = subprocess.run([sys.executable, "-c", child], cwd=HERE, env=env,
+                                 capture_output=True, text=True, check=True)
+            samples.append(json.loads(out.stdout.strip().splitlines()[-1]))
+    return {
+        "import_ms": statistics.median(s["import_s"] for s in samples) * 1000,
+        "reflect_ms": statistics.median(s["reflect_s"] for s in samples) * 1000,
+    }
+
+
+# =============================================================================
+# 4. What to call, and with which arguments
+# =============================================================================
+
+def workloads(sizes: dict, rng: random.Random):
+    """
+    Returns {function name: make_args} for the db.py public functions.
+    make_args() returns (args, kwargs) for one call.
+    """
+    today = datetime.date.today()
+
+    def pid():
+        return rng.randint(1, sizes["patients"])
+
+    def none():
+        return (), {}
+
+    def new_patient():
+        return (), dict(name=f"Bench {rng.random():.6f}", age=rng.randint(0, 99),
+                        gender=rng.choice(["Male", "Female", "Other"]),
+                        blood_type=rng.choice(["A+", "O-", "B+"]))
+
+    def record_fields():
+        stay = rng.randint(0, 20)
+        return dict(
+            doctor_id=rng.randint(1, sizes["doctors"]),
+            hospital_id=rng.randint(1, sizes["hospitals"]),
+            provider_id=rng.randint(1, sizes["providers"]),
+            medication_id=rng.randint(1, sizes["medications"]),
+            medical_condition=rng.choice(["Asthma", "Diabetes", "Obesity"]),
+            date_of_admission=today,
+            discharge_date=today + datetime.timedelta(days=stay),
+            admission_type=rng.choice(["Emergency", "Elective", "Routine"]),
+            room_number=rng.randint(100, 499),
+            billing_amount=round(rng.uniform(100, 50000), 2),
+            length_of_stay=stay,
+        )
+
+    def new_record():
+        return (), dict(patient_id=pid(), **record_fields())
+
+    def admit():
+        return (new_patient()[1], record_fields()), {}
+
+    return {
+        "doctor_get_all_patients": none,
+        "doctor_get_patients_page": none,
+        "doctor_insert_patient": new_patient,
+        "doctor_get_all_medical_records": none,
+        "doctor_get_medical_records_page": none,
+        "doctor_get_medical_record_details_page": none,
+        "doctor_search_patients": lambda: ((rng.choice(["ja", "smi", "diab", "patient 1"]),), {}),
+        "doctor_insert_medical_record": new_record,
+        "doctor_admit_new_patient": admit,
+        "patient_get_own_medical_records": lambda: ((pid(),), {}),
+        "patient_get_own_medical_records_df": lambda: ((pid(),), {}),
+        "patient_get_medical_records_batch": lambda: (([pid() for _ in range(20)],), {}),
+        "admin_get_all_doctors": none,
+        "admin_get_all_doctors_df": none,
+        "admin_insert_doctor": lambda: ((), dict(
+            name=f"Dr. Bench {rng.random():.6f}", specialty="Bench", phone_number="555")),
+        "admin_get_all_hospitals": none,
+        "admin_get_all_hospitals_df": none,
+        "admin_insert_hospital": lambda: ((), dict(name=f"Bench {rng.random():.6f}")),
+        "admin_aggregate": lambda: ((["count", "avg:billing_amount"],),
+                                    dict(group_by=["hospital_id"])),
+        "admin_histogram": lambda: (("length_of_stay",),
+                                    dict(bins=20, group_by="medical_condition")),
+    }
+
+
+def public_functions(db):
+    return sorted(
+        name for name, obj in vars(db).items()
+        if inspect.isfunction(obj) and obj.__module__ == db.__name__
+        and name.startswith(("doctor_", "patient_", "admin_"))
+    )
+
+
+def run(url: str, sizes: dict, iterations: int, warmup: int, max_seconds: float,
+        use_cache: bool, only=None):
+    os.environ["DATABASE_URL"] = url
+    result = {"import": time_import(url)}
+
+    import db
+
+    rng = random.Random(42)
+    work = workloads(sizes, rng)
+    before_each = None if use_cache else db.read_cache.clear
+    functions = {}
+    for name in public_functions(db):
+        if only and name not in only:
+            continue
+        if name not in work:
+            functions[name] = {"skipped": "no workload defined in bench_db.py"}
+            continue
+        print(f"  {name} ...", file=sys.stderr)
+        functions[name] = time_calls(getattr(db, name), work[name], iterations,
+                                     warmup, max_seconds, before_each)
+    result["functions"] = functions
+    result["peak_rss_kb"] = _rss_kb()
+    result["pool"] = db.pool_metrics()
+    return result
+
+
+# =============================================================================
+# 5. Reporting + comparing runs
+# =============================================================================
+
+def _git_commit():
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=HERE,
+                             capture_output=True, text=True, check=True)
+        return out.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_table(result):
+    imp = result["import"]
+    print(f"import {imp['import_ms']:.1f} ms, reflection {imp['reflect_ms']:.1f} ms, "
+          f"peak RSS {result['peak_rss_kb'] / 1024:.1f} MiB")
+    print(f"{'function':<40} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'calls/s':>9}")
+    for name, r in result["functions"].items():
+        if "skipped" in r:
+            print(f"{name:<40} skipped: {r['skipped']}")
+            continue
+        print(f"{name:<40} {r['p50_ms']:>9.2f} {r['p95_ms']:>9.2f} "
+              f"{r['p99_ms']:>9.2f} {r['throughput_per_s']:>9.1f}")
+
+
+def compare(current, baseline, threshold: float):
+    """
+    Prints p50/p95 ratios against a baseline run; returns the names of
+    functions that got slower than `threshold` (e.g. 0.10 = 10%).
+    """
+    regressions = []
+    print(f"\n{'function':<40} {'p50 x':>8} {'p95 x':>8}")
+    for name, r in current["functions"].items():
+        b = baseline.get("functions", {}).get(name)
+        if not b or "skipped" in r or "skipped" in b:
+            continue
+        p50 = r["p50_ms"] / b["p50_ms"] if b["p50_ms"] else float("inf")
+        p95 = r["p95_ms"] / b["p95_ms"] if b["p95_ms"] else float("inf")
+        flag = ""
+        if p50 > 1 + threshold:
+            regressions.append(name)
+            flag = "  <-- regression"
+        print(f"{name:<40} {p50:>8.2f} {p95:>8.2f}{flag}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the db.py functions")
+    parser.add_argument("--url", help="SQLAlchemy URL of a scratch database "
+                                      "(default: temporary local cluster via pgserver)")
+    parser.add_argument("--seed", action="store_true",
+                        help="(re)create and seed the schemas at --url "
+                             "(always done for a temporary cluster)")
+    parser.add_argument("--scale", type=int, default=10000, help="number of patients")
+    parser.add_argument("--records-per-patient", type=int, default=3)
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--max-seconds", type=float, default=10.0,
+                        help="time budget per function")
+    parser.add_argument("--cache", action="store_true", help="keep the read cache on")
+    parser.add_argument("--no-prepared", action="store_true",
+                        help="plain statements instead of server-side prepared ones")
+    parser.add_argument("--only", action="append", help="benchmark only this function")
+    parser.add_argument("--out", help="write JSON results here")
+    parser.add_argument("--compare", metavar="BASELINE_JSON")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="p50 slowdown that counts as a regression")
+    args = parser.parse_args(argv)
+
+    server = None
+    url = args.url
+    if url is None:
+        url, server = start_temporary_cluster()
+    sizes = dataset_size(args.scale, args.records_per_patient)
+    if server is not None or args.seed:
+        print(f"seeding {sizes} ...", file=sys.stderr)
+        started = time.perf_counter()
+        seed(url, args.scale, args.records_per_patient)
+        print(f"seeded in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+
+    if args.no_prepared:
+        os.environ["PREPARED_STATEMENTS"] = "0"  # read when db is imported
+    result = run(url, sizes, args.iterations, args.warmup, args.max_seconds,
+                 args.cache, set(args.only) if args.only else None)
+    result["meta"] = {
+        "commit": _git_commit(),
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "scale": args.scale,
+        "sizes": sizes,
+        "iterations": args.iterations,
+        "cache": args.cache,
+        "prepared": not args.no_prepared,
+        "python": platform.python_version(),
+    }
+
+    print_table(result)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(result, f, indent=2, default=str)
+    status = 0
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(result, baseline, args.threshold):
+            status = 1
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
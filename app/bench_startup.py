@@ -0,0 +1,97 @@
+# bench_startup.py
+#
+# Measures how long it takes to import db.py and get the first reflected
+# Table, comparing:
+#   - eager : what db.py used to do (reflect all three schemas, then
+#             autoload every Table a second time)
+#   - cold  : lazy reflection with an empty schema cache
+#   - warm  : lazy reflection with the cache already populated
+#   - trust : warm + SCHEMA_CACHE_TRUST=1 (no catalog queries at all)
+#
+# Each run happens in a fresh interpreter so import costs are real.
+#
+#   python bench_startup.py --runs 5
+#   DATABASE_URL=postgresql+psycopg2://... python bench_startup.py
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Runs inside the child interpreter; prints one JSON line.
+_CHILD = r"""
+import json, sys, time
+t0 = time.perf_counter()
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+queries = []
+event.listen(Engine, "before_cursor_execute",
+             lambda *a, **k: queries.append(1))
+import db
+t1 = time.perf_counter()
+if sys.argv[1] == "eager":
+    from sqlalchemy import MetaData, Table
+    for schema, tables in db.SCHEMA_TABLES.items():
+        meta = MetaData(schema=schema)
+        meta.reflect(bind=db.engine)
+        for name in tables:
+            Table(name, meta, autoload_with=db.engine)
+else:
+    db.MedicalRecords_doctor
+t2 = time.perf_counter()
+print(json.dumps({"import_s": t1 - t0, "first_table_s": t2 - t1,
+                  "total_s": t2 - t0, "queries": len(queries)}))
+"""
+
+
+def _run(mode: str, cache_dir: str):
+    env = dict(os.environ)
+    env["SCHEMA_CACHE_DIR"] = cache_dir
+    env["SCHEMA_CACHE_TRUST"] = "1" if mode == "trust" else ""
+    out = subprocess.run(
+        [sys.executable, "-c", _CHILD, mode],
+        cwd=HERE, env=env, capture_output=True, text=True, check=True,
+    )
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Import / first-table startup benchmark for db.py")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--json", action="store_true",
+                        help="print raw results as JSON")
+    args = parser.parse_args(argv)
+
+    results = {}
+    for mode in ("eager", "cold", "warm", "trust"):
+        samples = []
+        for _ in range(args.runs):
+            with tempfile.TemporaryDirectory() as cold_dir:
+                if mode == "cold":
+                    samples.append(_run(mode, cold_dir))
+                    continue
+                if mode in ("warm", "trust"):
+                    _run("cold", cold_dir)  # populate the cache
+                samples.append(_run(mode, cold_dir))
+        results[mode] = {
+            key: statistics.median(s[key] for s in samples)
+            for key in ("import_s", "first_table_s", "total_s", "queries")
+        }
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{'mode':<6} {'import':>10} {'1st table':>10} {'total':>10} {'queries':>8}")
+    for mode, r in results.items():
+        print(f"{mode:<6} {r['import_s'] * 1000:>8.1f}ms {r['first_table_s'] * 1000:>8.1f}ms "
+              f"{r['total_s'] * 1000:>8.1f}ms {r['queries']:>8.0f}")
+
+
+if __name__ == "__main__":
+    main()
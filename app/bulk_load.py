@@ -0,0 +1,397 @@
+# bulk_load.py
+#
+# Bulk ingestion into doctor_schema / admin_schema tables.
+#
+# Rows are streamed in batches with PostgreSQL COPY FROM STDIN (one round-trip
+# per batch) on a pooled role connection. Each batch is its own transaction.
+# Before it is written, each batch is checked in one vectorized pass by
+# validation.py (types, required columns, enum values, dates, ids that must
+# exist); rows that fail go straight to the dead-letter file without a trip
+# to the database. If a batch still fails, it is split in half and retried under savepoints until
+# the bad rows are isolated; those go to a dead-letter file (JSON lines) and
+# the rest of the load carries on. Backends without COPY use executemany
+# INSERTs with the same batching and isolation.
+#
+# From Python:
+#   import bulk_load
+#   bulk_load.bulk_load(records, "doctor_schema", "medical_records")
+#
+# From the command line:
+#   python bulk_load.py doctor_schema medical_records admissions.csv
+#   python bulk_load.py admin_schema hospitals hospitals.parquet --batch-size 5000
+#   python bulk_load.py doctor_schema patients feed.csv --dead-letter rejects.jsonl
+#
+# Loads into any copy of medical_records (the sync triggers carry rows into
+# admin_schema, where the rollups read them) refresh the KPI rollups
+# afterwards (rollups.py) unless --no-rollups is given.
+
+import argparse
+import csv
+import io
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import exc, insert
+
+import db
+import rollups
+import validation
+
+DEFAULT_BATCH_SIZE = 10000
+
+
+# =============================================================================
+# 1. Sources: CSV, Parquet, or any iterable of dicts
+# =============================================================================
+
+def read_csv(path: str, encoding: str = "utf-8"):
+    """
+    Yields each CSV row as a dict (header row = column names).
+    Empty cells become None (NULL).
+    """
+    with open(path, newline="", encoding=encoding) as f:
+        for row in csv.DictReader(f):
+            yield {k: (v if v != "" else None) for k, v in row.items()}
+
+
+def read_parquet(path: str, batch_size: int = DEFAULT_BATCH_SIZE):
+    """
+    Yields each Parquet row as a dict, reading one record batch at a time.
+    Needs pyarrow.
+    """
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError("Reading Parquet files needs pyarrow (pip install pyarrow).")
+    pf = pq.ParquetFile(path)
+    for batch in pf.iter_batches(batch_size=batch_size):
+        yield from batch.to_pylist()
+
+
+def read_records(path: str, fmt: str = None):
+    """
+    Picks a reader from the file extension (or fmt = "csv" / "parquet").
+    """
+    fmt = fmt or os.path.splitext(path)[1].lstrip(".").lower()
+    if fmt == "csv":
+        return read_csv(path)
+    if fmt in ("parquet", "pq"):
+        return read_parquet(path)
+    raise ValueError(f"Unsupported input format: {fmt!r}")
+
+
+def _batches(records, batch_size: int):
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+# =============================================================================
+# 2. Writers: COPY FROM STDIN, or executemany INSERT as a fallback
+# =============================================================================
+
+def _copy_value(value):
+    # PostgreSQL COPY text format: \N is NULL; backslash, tab, CR, LF escaped.
+    if value is None:
+        return "\\N"
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    s = value.isoformat() if hasattr(value, "isoformat") else str(value)
+    return (s.replace("\\", "\\\\").replace("\t", "\\t")
+             .replace("\n", "\\n").replace("\r", "\\r"))
+
+
+class _CopyWriter:
+    method = "copy"
+
+    def __init__(self, conn, table, columns):
+        self.raw = conn.connection
+        self.cur = self.raw.cursor()
+        cols = ", ".join(f'"{c}"' for c in columns)
+        self.sql = f'COPY {table.schema}."{table.name}" ({cols}) FROM STDIN'
+        self.errors = (exc.DBAPIError, conn.dialect.dbapi.Error)
+
+    def write(self, rows):
+        buf = io.StringIO()
+        for row in rows:
+            buf.write("\t".join(_copy_value(v) for v in row))
+            buf.write("\n")
+        buf.seek(0)
+        self.cur.copy_expert(self.sql, buf)
+
+    @contextmanager
+    def savepoint(self):
+        self.cur.execute("SAVEPOINT bulk_load")
+        try:
+            yield
+        except Exception:
+            self.cur.execute("ROLLBACK TO SAVEPOINT bulk_load")
+            raise
+        self.cur.execute("RELEASE SAVEPOINT bulk_load")
+
+    def commit(self):
+        self.raw.commit()
+
+    def rollback(self):
+        self.raw.rollback()
+
+
+class _InsertWriter:
+    method = "insert"
+
+    def __init__(self, conn, table, columns):
+        self.conn = conn
+        self.stmt = insert(table)
+        self.columns = columns
+        self.errors = (exc.DBAPIError,)
+
+    def write(self, rows):
+        self.conn.execute(self.stmt, [dict(zip(self.columns, r)) for r in rows])
+
+    @contextmanager
+    def savepoint(self):
+        with self.conn.begin_nested():
+            yield
+
+    def commit(self):
+        self.conn.commit()
+
+    def rollback(self):
+        self.conn.rollback()
+
+
+def supports_copy(conn):
+    """
+    True if the connection's driver can do COPY FROM STDIN (psycopg2).
+    """
+    cur = conn.connection.cursor()
+    try:
+        return hasattr(cur, "copy_expert")
+    finally:
+        cur.close()
+
+
+def _write_isolating(writer, rows, records, rejects):
+    """
+    Writes rows under a savepoint. On failure, splits the batch in half and
+    retries each half, so only the rows that really fail are rejected.
+    Returns the number of rows written.
+    """
+    try:
+        with writer.savepoint():
+            writer.write(rows)
+        return len(rows)
+    except writer.errors as e:
+        if len(rows) == 1:
+            rejects.append((records[0], _error_text(e)))
+            return 0
+        mid = len(rows) // 2
+        return (_write_isolating(writer, rows[:mid], records[:mid], rejects)
+                + _write_isolating(writer, rows[mid:], records[mid:], rejects))
+
+
+def _error_text(e):
+    orig = getattr(e, "orig", None) or e
+    return str(orig).strip().splitlines()[0] if str(orig).strip() else type(e).__name__
+
+
+# =============================================================================
+# 3. bulk_load()
+# =============================================================================
+
+def _validate(validator, rows, kept, rejects, columns):
+    # Moves the rows the validator rejects from rows / kept to rejects.
+    result = validator.validate(kept, columns)
+    if result.valid.all():
+        return rows, kept, 0
+    for i, messages in result.errors().items():
+        rejects.append((kept[i], "; ".join(messages)))
+    valid = result.valid.tolist()
+    rows = [row for row, ok in zip(rows, valid) if ok]
+    kept = [record for record, ok in zip(kept, valid) if ok]
+    return rows, kept, len(valid) - len(kept)
+
+
+def _to_rows(records, columns):
+    # dict records -> tuples in `columns` order; anything else is rejected.
+    rows, kept, rejects = [], [], []
+    allowed = set(columns)
+    for record in records:
+        if not isinstance(record, dict):
+            rejects.append((record, "record is not a mapping"))
+            continue
+        extra = set(record) - allowed
+        if extra:
+            rejects.append((record, f"unknown columns: {', '.join(sorted(extra))}"))
+            continue
+        rows.append(tuple(record.get(c) for c in columns))
+        kept.append(record)
+    return rows, kept, rejects
+
+
+def bulk_load(
+    records,
+    schema: str,
+    table_name: str,
+    columns=None,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    dead_letter_path: str = None,
+    progress=None,
+    method: str = "auto",
+    validate: bool = True,
+):
+    """
+    Loads an iterable of dict records into schema.table_name as the schema's
+    own role (db.SCHEMA_ROLES).
+
+    - columns: target columns; defaults to the keys of the first record.
+    - batch_size: rows per COPY / transaction.
+    - dead_letter_path: rejected rows are appended here as JSON lines
+      ({"row": ..., "error": ...}). Without it they are only counted.
+    - progress: callable receiving a dict per batch
+      (batch, rows, loaded, rejected, invalid, seconds, method).
+    - method: "copy", "insert" or "auto" (COPY when the driver supports it).
+    - validate: check each batch with validation.py before writing it.
+
+    Returns a summary dict: rows, loaded, rejected (of which invalid: caught
+    by validation), batches, seconds, method.
+    """
+    if table_name not in db.SCHEMA_TABLES.get(schema, ()):
+        raise ValueError(f"{schema}.{table_name} is not a known table.")
+    if schema not in ("doctor_schema", "admin_schema"):
+        raise ValueError("Bulk loads go into doctor_schema or admin_schema.")
+    table = db.get_table(schema, table_name)
+
+    records = iter(records)
+    first = next(records, None)
+    if first is None:
+        return {"rows": 0, "loaded": 0, "rejected": 0, "invalid": 0, "batches": 0,
+                "seconds": 0.0, "method": None}
+    if columns is None:
+        columns = list(first) if isinstance(first, dict) else []
+    unknown = [c for c in columns if c not in table.c]
+    if unknown or not columns:
+        raise ValueError(f"Unknown columns for {schema}.{table_name}: {unknown}")
+
+    def all_records():
+        yield first
+        yield from records
+
+    dead_letter = open(dead_letter_path, "a", encoding="utf-8") if dead_letter_path else None
+    validator = validation.validator(schema, table_name) if validate else None
+    summary = {"rows": 0, "loaded": 0, "rejected": 0, "invalid": 0, "batches": 0,
+               "seconds": 0.0, "method": None}
+    started = time.perf_counter()
+    try:
+        with db.role_connection(db.SCHEMA_ROLES[schema], schema) as conn:
+            use_copy = method == "copy" or (method == "auto" and supports_copy(conn))
+            writer_cls = _CopyWriter if use_copy else _InsertWriter
+            writer = writer_cls(conn, table, columns)
+            summary["method"] = writer.method
+
+            for number, batch in enumerate(_batches(all_records(), batch_size), 1):
+                batch_started = time.perf_counter()
+                rows, kept, rejects = _to_rows(batch, columns)
+                invalid = 0
+                if validator is not None and kept:
+                    rows, kept, invalid = _validate(validator, rows, kept, rejects, columns)
+                loaded = 0
+                try:
+                    if rows:
+                        loaded = _write_isolating(writer, rows, kept, rejects)
+                    writer.commit()
+                    db.replicas.note_commit(conn)
+                except Exception:
+                    writer.rollback()
+                    raise
+                finally:
+                    db.invalidate_table(schema, table_name)
+
+                for record, error in rejects:
+                    if dead_letter:
+                        dead_letter.write(json.dumps(
+                            {"row": record, "error": error}, default=str) + "\n")
+                summary["rows"] += len(batch)
+                summary["loaded"] += loaded
+                summary["rejected"] += len(rejects)
+                summary["invalid"] += invalid
+                summary["batches"] += 1
+                if progress:
+                    progress({
+                        "batch": number,
+                        "rows": len(batch),
+                        "loaded": loaded,
+                        "rejected": len(rejects),
+                        "invalid": invalid,
+                        "seconds": time.perf_counter() - batch_started,
+                        "method": writer.method,
+                    })
+    finally:
+        if dead_letter:
+            dead_letter.close()
+    summary["seconds"] = time.perf_counter() - started
+    return summary
+
+
+# =============================================================================
+# 4. Command line
+# =============================================================================
+
+def _print_progress(report):
+    print(
+        f"batch {report['batch']:>5}: {report['loaded']:>7} loaded, "
+        f"{report['rejected']:>5} rejected in {report['seconds']:.2f}s "
+        f"({report['method']})",
+        file=sys.stderr,
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Bulk-load CSV / Parquet files into a healthcare schema table.")
+    parser.add_argument("schema", choices=["doctor_schema", "admin_schema"])
+    parser.add_argument("table")
+    parser.add_argument("path", help="input file (.csv or .parquet)")
+    parser.add_argument("--format", choices=["csv", "parquet"],
+                        help="input format (default: from the file extension)")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--dead-letter", metavar="PATH",
+                        help="append rejected rows here as JSON lines "
+                             "(default: <path>.rejected.jsonl)")
+    parser.add_argument("--method", choices=["auto", "copy", "insert"], default="auto")
+    parser.add_argument("--quiet", action="store_true", help="no per-batch progress")
+    parser.add_argument("--no-validate", action="store_true",
+                        help="skip the validation pass (the database still checks)")
+    parser.add_argument("--no-rollups", action="store_true",
+                        help="skip the rollup refresh after loading any copy of "
+                             f"{rollups.SOURCE_TABLE}")
+    args = parser.parse_args(argv)
+
+    summary = bulk_load(
+        read_records(args.path, args.format),
+        args.schema,
+        args.table,
+        batch_size=args.batch_size,
+        dead_letter_path=args.dead_letter or f"{args.path}.rejected.jsonl",
+        progress=None if args.quiet else _print_progress,
+        method=args.method,
+        validate=not args.no_validate,
+    )
+    feeds_rollups = args.table == rollups.SOURCE_TABLE \
+        and args.schema in db.synced_copies(rollups.SOURCE_TABLE)
+    if feeds_rollups and summary["loaded"] and not args.no_rollups:
+        summary["rollups"] = rollups.refresh()
+    print(json.dumps(summary, indent=2, default=str))
+    return 1 if summary["rejected"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
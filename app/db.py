@@ -1,8 +1,27 @@
 # --- Cell ---
 # db.py
 
-from sqlalchemy import create_engine, MetaData, Table, text
+import atexit
+import base64
+import functools
+import hashlib
+import json
+import logging
+import os
+import pickle
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import ExitStack, contextmanager
+
+import sqlalchemy
+from sqlalchemy import (
+    create_engine, MetaData, text, event, exc,
+    select, insert, func, and_, or_, bindparam, true,
+)
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.sql import sqltypes
 
 # =============================================================================
 # 1. Set your actual DB connection info here
@@ -13,11 +32,17 @@ DB_HOST = "localhost"
 DB_PORT = "5432"
 DB_NAME = "Healthcare"
 
-DATABASE_URL = (
+DATABASE_URL = os.environ.get("DATABASE_URL") or (
     f"postgresql+psycopg2://"
     f"{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
 )
 
+# Read replicas (section 20): comma-separated URLs of standbys of the
+# database above. The read-only *_get_* helpers are routed to them; writes
+# always go to DATABASE_URL. Unset: everything runs on the primary.
+REPLICA_URLS = [u.strip() for u in os.environ.get("DATABASE_REPLICA_URLS", "").split(",")
+                if u.strip()]
+
 # Create a single Engine that everyone will share
 engine = create_engine(DATABASE_URL, echo=False)
 
@@ -25,90 +50,536 @@ engine = create_engine(DATABASE_URL, echo=False)
 SessionLocal = sessionmaker(bind=engine)
 
 # =============================================================================
-# 2. Reflect each schema into its own MetaData object
+# 2. Reflect each schema into its own MetaData object (lazily, with a cache)
 # =============================================================================
 
 # NOTE: The SQL you ran created these three schemas and copied "LIKE public…"
 #       for each table. So we know exactly which tables live under which schema.
+#
+# Nothing is reflected at import time. The first access to a table (or to
+# doctor_meta / patient_meta / admin_meta) loads all three schemas, either
+# from the on-disk cache or by reflecting them once. The cache file is named
+# after a fingerprint of the columns in these schemas, so any DDL change
+# produces a new file and the stale one is simply ignored.
+#
+# Set SCHEMA_CACHE_TRUST=1 to skip even the fingerprint query and use the
+# newest cache file as-is (zero catalog queries on a warm start).
+SCHEMA_CACHE_DIR = os.environ.get(
+    "SCHEMA_CACHE_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "healthcare_app"),
+)
+SCHEMA_CACHE_TRUST = os.environ.get("SCHEMA_CACHE_TRUST", "") == "1"
+
+SCHEMA_TABLES = {
+    # --- doctor_schema: contains patients, medical_records, medications ---
+    "doctor_schema": ("patients", "medical_records", "medications"),
+    # --- patient_schema: contains patients, medical_records ---
+    "patient_schema": ("patients", "medical_records"),
+    # --- admin_schema: contains patients, hospitals, doctors, medications,
+    #     insurance_providers, medical_records ---
+    "admin_schema": (
+        "patients", "hospitals", "doctors", "medications",
+        "insurance_providers", "medical_records",
+    ),
+}
+
+# patients and medical_records exist in several schemas. Migration 0005 keeps
+# the copies identical: a write to any copy reaches the others in the same
+# transaction. doctor_schema holds the canonical copy (sync.py verifies and
+# repairs the others against it). Table name -> primary key column.
+SYNCED_TABLES = {"patients": "patient_id", "medical_records": "record_id"}
+CANONICAL_SCHEMA = "doctor_schema"
+
+
+def synced_copies(table_name: str):
+    """
+    Returns the schemas holding a copy of table_name, canonical first
+    (just the one schema for tables that aren't synced).
+    """
+    schemas = [s for s, names in SCHEMA_TABLES.items() if table_name in names]
+    if table_name not in SYNCED_TABLES:
+        return schemas
+    return sorted(schemas, key=lambda s: s != CANONICAL_SCHEMA)
+
+
+# Module attribute name -> schema (for the MetaData objects)
+_META_ATTRS = {
+    "doctor_meta": "doctor_schema",
+    "patient_meta": "patient_schema",
+    "admin_meta": "admin_schema",
+}
+
+# Module attribute name -> (schema, table)
+_TABLE_ATTRS = {
+    "Patients_doctor":          ("doctor_schema", "patients"),
+    "MedicalRecords_doctor":    ("doctor_schema", "medical_records"),
+    "Medications_doctor":       ("doctor_schema", "medications"),
+    "Patients_patient":         ("patient_schema", "patients"),
+    "MedicalRecords_patient":   ("patient_schema", "medical_records"),
+    "Patients_admin":           ("admin_schema", "patients"),
+    "Hospitals_admin":          ("admin_schema", "hospitals"),
+    "Doctors_admin":            ("admin_schema", "doctors"),
+    "Medications_admin":        ("admin_schema", "medications"),
+    "InsuranceProviders_admin": ("admin_schema", "insurance_providers"),
+    "MedicalRecords_admin":     ("admin_schema", "medical_records"),
+}
+
+_schema_lock = threading.Lock()
+_schema_metas = None  # {schema: MetaData} once loaded
+
+_FINGERPRINT_SQL = """
+SELECT md5(coalesce(string_agg(
+           n.nspname || '.' || c.relname || '.' || a.attname || ':'
+           || format_type(a.atttypid, a.atttypmod) || ':' || a.attnotnull::text,
+           ',' ORDER BY n.nspname, c.relname, a.attnum), ''))
+FROM pg_attribute a
+JOIN pg_class c     ON c.oid = a.attrelid
+JOIN pg_namespace n ON n.oid = c.relnamespace
+WHERE n.nspname = ANY(:schemas)
+  AND c.relkind IN ('r', 'p', 'v', 'm')
+  AND a.attnum > 0
+  AND NOT a.attisdropped
+"""
+
+
+def schema_fingerprint():
+    """
+    Returns a hash of every column (name, type, nullability) in the three
+    schemas. One catalog query.
+    """
+    with engine.connect() as conn:
+        value = conn.execute(
+            text(_FINGERPRINT_SQL), {"schemas": list(SCHEMA_TABLES)}
+        ).scalar()
+    # Pickled MetaData is only valid for the SQLAlchemy version that wrote it.
+    return f"{value}-sa{sqlalchemy.__version__}"
+
+
+def _cache_path(fingerprint: str):
+    return os.path.join(SCHEMA_CACHE_DIR, f"schema-{fingerprint}.pickle")
+
+
+def _newest_cache_file():
+    try:
+        names = [
+            n for n in os.listdir(SCHEMA_CACHE_DIR)
+            if n.startswith("schema-") and n.endswith(
+                f"-sa{sqlalchemy.__version__}.pickle")
+        ]
+    except FileNotFoundError:
+        return None
+    if not names:
+        return None
+    paths = [os.path.join(SCHEMA_CACHE_DIR, n) for n in names]
+    return max(paths, key=os.path.getmtime)
+
+
+def _read_cache(path: str):
+    try:
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+        return None
+
+
+def _write_cache(path: str, metas: dict):
+    # Write to a temp file and rename, so concurrent workers never read a
+    # half-written cache.
+    try:
+        os.makedirs(SCHEMA_CACHE_DIR, exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            pickle.dump(metas, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+    except OSError:
+        pass  # the cache is an optimisation; reflection already succeeded
+
+
+def _reflect_all():
+    metas = {}
+    for schema, tables in SCHEMA_TABLES.items():
+        meta = MetaData(schema=schema)
+        meta.reflect(bind=engine, only=list(tables))
+        metas[schema] = meta
+    return metas
+
+
+def load_schemas(refresh: bool = False):
+    """
+    Returns {schema: MetaData} for doctor_schema, patient_schema and
+    admin_schema, loading them on first call.
+    - refresh=True ignores the on-disk cache and reflects again.
+    """
+    global _schema_metas
+    if _schema_metas is not None and not refresh:
+        return _schema_metas
+    with _schema_lock:
+        if _schema_metas is not None and not refresh:
+            return _schema_metas
+
+        metas = None
+        if not refresh and SCHEMA_CACHE_TRUST:
+            newest = _newest_cache_file()
+            if newest:
+                metas = _read_cache(newest)
+        if metas is None:
+            fingerprint = schema_fingerprint()
+            path = _cache_path(fingerprint)
+            if not refresh:
+                metas = _read_cache(path)
+            if metas is None:
+                metas = _reflect_all()
+                _write_cache(path, metas)
+
+        _schema_metas = metas
+        return metas
+
+
+def get_metadata(schema: str):
+    """
+    Returns the reflected MetaData for one schema (e.g. "admin_schema").
+    """
+    return load_schemas()[schema]
+
+
+def get_table(schema: str, name: str):
+    """
+    Returns the reflected Table `name` from `schema`.
+    """
+    return get_metadata(schema).tables[f"{schema}.{name}"]
+
+
+def __getattr__(name):
+    # Keeps `db.Patients_doctor`, `db.admin_meta`, ... working without
+    # reflecting anything until they are first used.
+    if name in _TABLE_ATTRS:
+        return get_table(*_TABLE_ATTRS[name])
+    if name in _META_ATTRS:
+        return get_metadata(_META_ATTRS[name])
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+# =============================================================================
+# 3. Role-scoped connection pool
+# =============================================================================
+
+# Every (role, schema) pair gets its own small pool. SET search_path and
+# SET ROLE are applied once when the physical connection is opened, so a
+# checkout costs no extra round-trips; on return the connection is rolled back
+# and any per-request settings (e.g. app.patient_id) are reset. There is no
+# pre-ping on checkout: connections are recycled after POOL_RECYCLE seconds,
+# and a connection that died anyway fails its first statement, which
+# invalidates it and everything pooled before it (handle_error below).
+POOL_SIZE = 5
+POOL_MAX_OVERFLOW = 10
+POOL_TIMEOUT = 30  # seconds to wait for a free connection before giving up
+POOL_RECYCLE = 1800
+
+
+class RolePool:
+    """
+    A set of sub-pools, one per (role, schema) pair, over a single database URL.
+
+    Usage:
+        with role_pool.connection("doctor_user", "doctor_schema") as conn:
+            conn.execute(text("SELECT * FROM patients"))
+    """
+
+    def __init__(self, url: str, pool_size: int = POOL_SIZE,
+                 max_overflow: int = POOL_MAX_OVERFLOW,
+                 timeout: float = POOL_TIMEOUT, recycle: int = POOL_RECYCLE):
+        self.url = url
+        self.pool_size = pool_size
+        self.max_overflow = max_overflow
+        self.timeout = timeout
+        self.recycle = recycle
+        self._engines = {}
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def configure(self, pool_size: int = None, max_overflow: int = None,
+                  timeout: float = None, recycle: int = None):
+        """
+        Change the pool settings. Existing sub-pools are disposed so the new
+        settings take effect on the next checkout.
+        """
+        if pool_size is not None:
+            self.pool_size = pool_size
+        if max_overflow is not None:
+            self.max_overflow = max_overflow
+        if timeout is not None:
+            self.timeout = timeout
+        if recycle is not None:
+            self.recycle = recycle
+        self.dispose()
+
+    def _new_metrics(self):
+        return {
+            "connects": 0,      # physical connections opened (role applied)
+            "checkouts": 0,
+            "checkins": 0,
+            "waits": 0,         # checkouts that blocked on a full pool
+            "wait_seconds": 0.0,  # time spent blocked on a full pool
+            "resets": 0,        # per-request session settings reset on return
+            "timeouts": 0,
+            "disconnects": 0,   # dead connections found (pool invalidated)
+        }
+
+    def engine_for(self, role: str, schema: str):
+        """
+        Returns the Engine backing the (role, schema) sub-pool, creating it
+        on first use.
+        """
+        key = (role, schema)
+        eng = self._engines.get(key)
+        if eng is not None:
+            return eng
+        with self._lock:
+            eng = self._engines.get(key)
+            if eng is None:
+                eng = self._create_engine(role, schema)
+                self._engines[key] = eng
+                self._metrics.setdefault(key, self._new_metrics())
+        return eng
+
+    def _create_engine(self, role: str, schema: str):
+        eng = create_engine(
+            self.url,
+            echo=False,
+            pool_size=self.pool_size,
+            max_overflow=self.max_overflow,
+            pool_timeout=self.timeout,
+            pool_recycle=self.recycle,
+        )
+        metrics = self._metrics.setdefault((role, schema), self._new_metrics())
+
+        @event.listens_for(eng, "connect")
+        def _apply_role(dbapi_conn, connection_record):
+            # One round-trip, committed so a later rollback does not undo it.
+            cur = dbapi_conn.cursor()
+            cur.execute(f"SET search_path TO {schema}; SET ROLE {role}")
+            cur.close()
+            dbapi_conn.commit()
+            metrics["connects"] += 1
+
+        @event.listens_for(eng, "checkout")
+        def _on_checkout(dbapi_conn, connection_record, connection_proxy):
+            metrics["checkouts"] += 1
+
+        @event.listens_for(eng, "checkin")
+        def _on_checkin(dbapi_conn, connection_record):
+            metrics["checkins"] += 1
+
+        @event.listens_for(eng, "handle_error")
+        def _on_error(context):
+            # The server went away (restart, failover, idle kill): drop this
+            # connection and every one pooled before it so the next checkout
+            # opens a fresh connection instead of finding another dead one.
+            if context.is_disconnect:
+                context.invalidate_pool_on_disconnect = True
+                metrics["disconnects"] += 1
 
-# --- doctor_schema: contains patients, medical_records, medications ---
-doctor_meta = MetaData(schema="doctor_schema")
-doctor_meta.reflect(bind=engine)
+        _instrument_engine(eng, role, schema)
+        return eng
 
-Patients_doctor        = Table("patients", doctor_meta, autoload_with=engine)
-MedicalRecords_doctor  = Table("medical_records", doctor_meta, autoload_with=engine)
-Medications_doctor     = Table("medications", doctor_meta, autoload_with=engine)
+    @contextmanager
+    def connection(self, role: str, schema: str, settings: dict = None):
+        """
+        Check out a connection already running as `role` with `schema` on its
+        search_path. Optional `settings` are session variables (for example
+        {"app.patient_id": 42}) applied for this checkout only and reset
+        before the connection goes back to the pool.
+        """
+        eng = self.engine_for(role, schema)
+        metrics = self._metrics[(role, schema)]
+        # Only a pool with no idle connection and no overflow left makes the
+        # caller wait; opening a new connection is not counted as a wait.
+        blocked = (eng.pool.checkedin() == 0
+                   and eng.pool.overflow() >= self.max_overflow)
+        started = time.perf_counter()
+        try:
+            conn = eng.connect()
+        except exc.TimeoutError:
+            metrics["timeouts"] += 1
+            raise
+        finally:
+            waited = time.perf_counter() - started
+            if blocked:
+                metrics["waits"] += 1
+                metrics["wait_seconds"] += waited
+        # Attributed to the first statement run on this checkout.
+        conn.info["checkout_wait"] = waited
 
-# --- patient_schema: contains patients, medical_records ---
-patient_meta = MetaData(schema="patient_schema")
-patient_meta.reflect(bind=engine)
+        try:
+            if settings:
+                _apply_settings(conn, settings)
+            yield conn
+        finally:
+            try:
+                if settings:
+                    conn.rollback()
+                    _reset_settings(conn, settings)
+                    metrics["resets"] += 1
+            except Exception:
+                # A connection we cannot reset must not be reused.
+                conn.invalidate()
+            conn.close()
 
-Patients_patient       = Table("patients", patient_meta, autoload_with=engine)
-MedicalRecords_patient = Table("medical_records", patient_meta, autoload_with=engine)
+    def metrics(self):
+        """
+        Returns a snapshot of per-(role, schema) pool metrics, including the
+        live pool size / checked-out counts.
+        """
+        snapshot = {}
+        for key, values in list(self._metrics.items()):
+            entry = dict(values)
+            eng = self._engines.get(key)
+            if eng is not None:
+                entry["size"] = eng.pool.size()
+                entry["checked_out"] = eng.pool.checkedout()
+                entry["idle"] = eng.pool.checkedin()
+                entry["overflow"] = eng.pool.overflow()
+            snapshot[f"{key[0]}@{key[1]}"] = entry
+        return snapshot
 
-# --- admin_schema: contains patients, hospitals, doctors, medications, 
-#     insurance_providers, medical_records ---
-admin_meta = MetaData(schema="admin_schema")
-admin_meta.reflect(bind=engine)
+    def dispose(self):
+        """
+        Close every pooled connection (e.g. after a fork or on shutdown).
+        """
+        with self._lock:
+            for eng in self._engines.values():
+                eng.dispose()
+            self._engines.clear()
+
+
+def _apply_settings(conn, settings: dict):
+    # set_config(..., false) is session-level; all settings go in one SELECT.
+    names = list(settings)
+    exprs = ", ".join(
+        f"set_config(:k{i}, :v{i}, false)" for i in range(len(names))
+    )
+    params = {}
+    for i, name in enumerate(names):
+        params[f"k{i}"] = name
+        params[f"v{i}"] = str(settings[name])
+    conn.execute(text(f"SELECT {exprs}"), params)
+
+
+def _reset_settings(conn, settings: dict):
+    for name in settings:
+        conn.execute(text(f"RESET {name}"))
+    conn.commit()
+
+
+role_pool = RolePool(DATABASE_URL)
+
+# Per-thread routing state: "read" inside a replica_read helper, "shared"
+# while loading a result other sessions will see, "session" (bind_session).
+_routing = threading.local()
+
+
+def replica_read(fn):
+    """
+    Marks a read-only helper: the connections it checks out may come from a
+    read replica (section 20).
+    """
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        outer = getattr(_routing, "read", False)
+        _routing.read = True
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _routing.read = outer
+    return wrapper
+
+
+@contextmanager
+def _shared_load():
+    # Reads made here fill a cache every session sees: a replica must have
+    # every write this process made, not just the current session's.
+    outer = getattr(_routing, "shared", False)
+    _routing.shared = True
+    try:
+        yield
+    finally:
+        _routing.shared = outer
+
+
+def role_connection(role: str, schema: str, settings: dict = None):
+    """
+    Shortcut for role_pool.connection(...); inside a replica_read helper,
+    replicas.connection(...) when replicas are configured.
+    """
+    if getattr(_routing, "read", False) and replicas.enabled:
+        return replicas.connection(role, schema, settings)
+    return role_pool.connection(role, schema, settings)
+
+
+def pool_metrics():
+    """
+    Returns checkout / wait / reset counters for every (role, schema) sub-pool.
+    """
+    return role_pool.metrics()
 
-Patients_admin          = Table("patients", admin_meta, autoload_with=engine)
-Hospitals_admin         = Table("hospitals", admin_meta, autoload_with=engine)
-Doctors_admin           = Table("doctors", admin_meta, autoload_with=engine)
-Medications_admin       = Table("medications", admin_meta, autoload_with=engine)
-InsuranceProviders_admin= Table("insurance_providers", admin_meta, autoload_with=engine)
-MedicalRecords_admin    = Table("medical_records", admin_meta, autoload_with=engine)
 
 # =============================================================================
-# 3. A helper to “SET ROLE” + “SET search_path” + run your SQL
+# 4. A helper to run your SQL as a role on a schema
 # =============================================================================
 
 def _execute_with_role(sql_text: str, role: str, schema: str, **params):
     """
-    Open a new Connection, do SET search_path and SET ROLE, then execute sql_text.
+    Check out a pooled connection for (role, schema) and execute sql_text.
     - sql_text: a SQL string (it can use :param placeholders).
     - role: the exact Postgres role name (“doctor_user”, “patient_user”, “admin_user”).
     - schema: the schema we want on the search_path (e.g. "doctor_schema").
     - params: any bind parameters for the SQL.
 
-    Returns a ResultProxy if it’s a SELECT, or None for INSERT/UPDATE/DELETE.
+    Returns the rows as a list of dicts if it’s a SELECT, or None for
+    INSERT/UPDATE/DELETE (which are committed). The connection always goes
+    back to the pool before this returns. SQL registered in `statements`
+    runs as a server-side prepared statement.
     """
-    conn = engine.connect()
-    # 1) set the schema search_path
-    conn.execute(text(f"SET search_path TO {schema}"))
-    # 2) switch to the given role
-    conn.execute(text(f"SET ROLE {role}"))
-    # 3) run the actual query
-    result = conn.execute(text(sql_text), params)  # pass **params for :placeholders
-    return result
+    with role_connection(role, schema) as conn:
+        name = statements.name_for(sql_text) if statements.enabled(conn) else None
+        if name is not None:
+            result = statements.execute(conn, name, role, schema, params, retry=True)
+        else:
+            result = conn.execute(text(sql_text), params)
+        if result.returns_rows:
+            rows = [dict(r._mapping) for r in result.fetchall()]
+            result.close()
+            query_stats.note_materialized(rows)
+            conn.commit()
+            return rows
+        conn.commit()
+        return None
 
 
 # =============================================================================
-# 4. Doctor‐side functions (runs as doctor_user on doctor_schema)
+# 5. Doctor‐side functions (runs as doctor_user on doctor_schema)
 # =============================================================================
 
+@replica_read
 def doctor_get_all_patients():
     """
     Returns all rows from doctor_schema.patients as a list of dicts.
     """
     sql = "SELECT * FROM patients"  # search_path is already set to doctor_schema
-    result = _execute_with_role(sql, role="doctor_user", schema="doctor_schema")
-    rows = [dict(r) for r in result.fetchall()]
-    result.close()
-    return rows
+    return _execute_cached(sql, "doctor_user", "doctor_schema", ["patients"], delta="rows")
 
 
-def doctor_insert_patient(name: str, age: int, gender: str, blood_type: str):
+def doctor_insert_patient(name: str, age: int, gender: str, blood_type: str, uow=None):
     """
-    Inserts a new row into doctor_schema.patients.
+    Inserts a new row into doctor_schema.patients and returns its patient_id.
+    Pass uow (a doctor_schema unit_of_work) to make it part of a larger
+    transaction; otherwise it commits on its own.
     """
-    sql = """
-    INSERT INTO patients (name, age, gender, blood_type)
-    VALUES (:name, :age, :gender, :blood_type)
-    """
-    _execute_with_role(
-        sql,
-        role="doctor_user",
-        schema="doctor_schema",
+    return _insert_returning_id(
+        "doctor_user",
+        "doctor_schema",
+        "patients",
+        uow,
         name=name,
         age=age,
         gender=gender,
@@ -116,15 +587,47 @@ def doctor_insert_patient(name: str, age: int, gender: str, blood_type: str):
     )
 
 
+@replica_read
 def doctor_get_all_medical_records():
     """
     Returns all rows from doctor_schema.medical_records as a list of dicts.
     """
     sql = "SELECT * FROM medical_records"
-    result = _execute_with_role(sql, role="doctor_user", schema="doctor_schema")
-    rows = [dict(r) for r in result.fetchall()]
-    result.close()
-    return rows
+    return _execute_cached(sql, "doctor_user", "doctor_schema", ["medical_records"], delta="rows")
+
+
+@replica_read
+def doctor_get_patients_page(
+    page_size: int = None,
+    sort_column: str = None,
+    direction: str = "asc",
+    cursor: str = None,
+):
+    """
+    Returns one page of doctor_schema.patients (see get_page for the result).
+    """
+    return get_page(
+        "doctor_user", "doctor_schema", "patients",
+        page_size=page_size, sort_column=sort_column,
+        direction=direction, cursor=cursor,
+    )
+
+
+@replica_read
+def doctor_get_medical_records_page(
+    page_size: int = None,
+    sort_column: str = None,
+    direction: str = "asc",
+    cursor: str = None,
+):
+    """
+    Returns one page of doctor_schema.medical_records (see get_page).
+    """
+    return get_page(
+        "doctor_user", "doctor_schema", "medical_records",
+        page_size=page_size, sort_column=sort_column,
+        direction=direction, cursor=cursor,
+    )
 
 
 def doctor_insert_medical_record(
@@ -139,26 +642,18 @@ def doctor_insert_medical_record(
     admission_type: str,
     room_number: int,
     billing_amount: float,
-    length_of_stay: int
+    length_of_stay: int,
+    uow=None
 ):
     """
-    Inserts a new row into doctor_schema.medical_records.
-    """
-    sql = """
-    INSERT INTO medical_records (
-        patient_id, doctor_id, hospital_id, provider_id, medication_id,
-        medical_condition, date_of_admission, discharge_date,
-        admission_type, room_number, billing_amount, length_of_stay
-    ) VALUES (
-        :patient_id, :doctor_id, :hospital_id, :provider_id, :medication_id,
-        :medical_condition, :date_of_admission, :discharge_date,
-        :admission_type, :room_number, :billing_amount, :length_of_stay
-    )
+    Inserts a new row into doctor_schema.medical_records and returns its
+    generated id. Pass uow to make it part of a larger transaction.
     """
-    _execute_with_role(
-        sql,
-        role="doctor_user",
-        schema="doctor_schema",
+    return _insert_returning_id(
+        "doctor_user",
+        "doctor_schema",
+        "medical_records",
+        uow,
         patient_id=patient_id,
         doctor_id=doctor_id,
         hospital_id=hospital_id,
@@ -174,97 +669,3079 @@ def doctor_insert_medical_record(
     )
 
 
+def doctor_admit_new_patient(patient: dict, record: dict):
+    """
+    Inserts a patient and their first medical record in one transaction:
+    either both rows are committed or neither is.
+    - patient: doctor_insert_patient keyword arguments
+    - record: doctor_insert_medical_record keyword arguments, without patient_id
+    Returns (patient_id, record_id).
+    """
+    with unit_of_work("doctor_user", "doctor_schema") as uow:
+        patient_id = doctor_insert_patient(**patient, uow=uow)
+        record_id = doctor_insert_medical_record(patient_id=patient_id, **record, uow=uow)
+    return patient_id, record_id
+
+
 # =============================================================================
-# 5. Patient‐side functions (runs as patient_user on patient_schema, with RLS)
+# 6. Patient‐side functions (runs as patient_user on patient_schema, with RLS)
 # =============================================================================
 
+# app.patient_id is bound with set_config(..., true), i.e. transaction-local
+# (SET LOCAL), and sent in the same simple-query message as the SELECT. On an
+# autocommit connection PostgreSQL runs the two statements as one implicit
+# transaction, so the setting is gone as soon as the SELECT finishes: one
+# round-trip per read, nothing to reset, and the RLS policy still does the
+# filtering.
+_PATIENT_SETTING_SQL = "SELECT set_config('app.patient_id', %(patient_id)s, true); "
+_PATIENT_RECORDS_SQL = _PATIENT_SETTING_SQL + "SELECT * FROM medical_records"
+
+
+@contextmanager
+def _patient_connection():
+    with role_connection("patient_user", "patient_schema") as conn:
+        # The pool restores the isolation level when the connection returns.
+        yield conn.execution_options(isolation_level="AUTOCOMMIT")
+
+
+def _patient_records(conn, patient_id: int):
+    if statements.enabled(conn):
+        # Same single round-trip, with the SELECT as a prepared statement.
+        result = statements.execute(
+            conn, "medical_records_all", "patient_user", "patient_schema",
+            prefix=_PATIENT_SETTING_SQL,
+            prefix_params={"patient_id": str(int(patient_id))}, retry=True,
+        )
+    else:
+        result = conn.exec_driver_sql(
+            _PATIENT_RECORDS_SQL, {"patient_id": str(int(patient_id))}
+        )
+    rows = [dict(r._mapping) for r in result.fetchall()]
+    result.close()
+    query_stats.note_materialized(rows)
+    return rows
+
+
+@replica_read
 def patient_get_own_medical_records(patient_id: int):
     """
     Returns only those rows from patient_schema.medical_records where 
     patient_id = given patient_id. This relies on your RLS policy
     using session variable app.patient_id.
 
-    We do, in order:
-      1) SET ROLE patient_user
-      2) SET app.patient_id = <patient_id>
-      3) SET search_path TO patient_schema
-      4) SELECT * FROM medical_records
-    """
-    conn = engine.connect()
-    # 1. switch to patient_user
-    conn.execute(text("SET ROLE patient_user"))
-    # 2. establish the session variable RLS expects
-    conn.execute(text("SET app.patient_id = :pid"), {"pid": patient_id})
-    # 3. set schema to patient_schema
-    conn.execute(text("SET search_path TO patient_schema"))
-    # 4. run the SELECT
-    result = conn.execute(text("SELECT * FROM medical_records"))
-    rows = [dict(r) for r in result.fetchall()]
-    result.close()
-    return rows
+    Runs on the pooled (patient_user, patient_schema) connection, which
+    already has its role and search_path; app.patient_id is set
+    transaction-locally in the same round-trip as the SELECT. Results are
+    cached per patient_id.
+    """
+    def load():
+        with _patient_connection() as conn:
+            return _patient_records(conn, patient_id)
+
+    return cached_read(
+        "patient_user", "patient_schema", ["medical_records"],
+        "SELECT * FROM medical_records", load, scope=("patient_id", patient_id),
+    )
+
+
+@replica_read
+def patient_get_medical_records_batch(patient_ids):
+    """
+    Back-office helper: returns {patient_id: [rows]} for many patients, still
+    filtered by the RLS policy (never by a WHERE clause of ours). Uses one
+    pooled connection and one round-trip per patient.
+    """
+    records = {}
+    with _patient_connection() as conn:
+        for patient_id in dict.fromkeys(int(p) for p in patient_ids):
+            records[patient_id] = _patient_records(conn, patient_id)
+    return records
+
+
+@replica_read
+def patient_get_own_medical_records_df(patient_id: int):
+    """
+    Same rows as patient_get_own_medical_records, as a typed pandas DataFrame
+    (primary-key order). Built from that helper's cached rows, so it costs
+    the same single round-trip.
+    """
+    table = get_table("patient_schema", "medical_records")
+    (pk,) = [c.name for c in table.primary_key.columns]
+    names = [c.name for c in table.c]
+    rows = sorted(patient_get_own_medical_records(patient_id), key=lambda r: r[pk])
+    return frame_from_batches(
+        names, [c.type for c in table.c], [[tuple(r[n] for n in names) for r in rows]]
+    )
 
 
 # =============================================================================
-# 6. Admin‐side functions (runs as admin_user on admin_schema)
+# 7. Admin‐side functions (runs as admin_user on admin_schema)
 # =============================================================================
 
+@replica_read
 def admin_get_all_doctors():
     """
     Returns all rows from admin_schema.doctors as a list of dicts.
     """
+    if reference_store.holds("admin_schema", "doctors"):
+        return reference_store.rows("admin_schema", "doctors")
     sql = "SELECT * FROM doctors"
-    result = _execute_with_role(sql, role="admin_user", schema="admin_schema")
-    rows = [dict(r) for r in result.fetchall()]
-    result.close()
-    return rows
+    return _execute_cached(sql, "admin_user", "admin_schema", ["doctors"], delta="rows")
 
 
-def admin_insert_doctor(name: str, specialty: str, phone_number: str):
+@replica_read
+def admin_get_all_doctors_df():
     """
-    Inserts a new doctor into admin_schema.doctors.
+    Returns admin_schema.doctors as a typed pandas DataFrame.
     """
-    sql = """
-    INSERT INTO doctors (name, specialty, phone_number)
-    VALUES (:name, :specialty, :phone_number)
+    return table_dataframe("admin_schema", "doctors")
+
+
+def admin_insert_doctor(name: str, specialty: str, phone_number: str, uow=None):
     """
-    _execute_with_role(
-        sql,
-        role="admin_user",
-        schema="admin_schema",
+    Inserts a new doctor into admin_schema.doctors and returns its doctor_id.
+    Pass uow (an admin_schema unit_of_work) to batch it with other writes.
+    """
+    return _insert_returning_id(
+        "admin_user",
+        "admin_schema",
+        "doctors",
+        uow,
         name=name,
         specialty=specialty,
         phone_number=phone_number
     )
 
 
+@replica_read
 def admin_get_all_hospitals():
     """
     Returns all rows from admin_schema.hospitals.
     """
+    if reference_store.holds("admin_schema", "hospitals"):
+        return reference_store.rows("admin_schema", "hospitals")
     sql = "SELECT * FROM hospitals"
-    result = _execute_with_role(sql, role="admin_user", schema="admin_schema")
-    rows = [dict(r) for r in result.fetchall()]
-    result.close()
-    return rows
+    return _execute_cached(sql, "admin_user", "admin_schema", ["hospitals"], delta="rows")
 
 
-def admin_insert_hospital(name: str, address: str = None, phone_number: str = None):
+@replica_read
+def admin_get_all_hospitals_df():
+    """
+    Returns admin_schema.hospitals as a typed pandas DataFrame.
     """
-    Inserts a new hospital into admin_schema.hospitals.
+    return table_dataframe("admin_schema", "hospitals")
+
+
+def admin_insert_hospital(name: str, address: str = None, phone_number: str = None, uow=None):
     """
-    sql = """
-    INSERT INTO hospitals (name, address, phone_number)
-    VALUES (:name, :address, :phone_number)
+    Inserts a new hospital into admin_schema.hospitals and returns its
+    hospital_id. Pass uow to batch it with other writes.
     """
-    _execute_with_role(
-        sql,
-        role="admin_user",
-        schema="admin_schema",
+    return _insert_returning_id(
+        "admin_user",
+        "admin_schema",
+        "hospitals",
+        uow,
         name=name,
         address=address,
         phone_number=phone_number
     )
 
-# --- Cell ---
 
+# =============================================================================
+# 8. Keyset (seek) pagination
+# =============================================================================
+
+# Pages are fetched with WHERE (sort_col, pk) > (last_seen) ORDER BY ... LIMIT n,
+# so page 1000 costs the same as page 1 (no OFFSET scan). Rows with NULL in the
+# sort column come last in either direction. A cursor token is an opaque,
+# URL-safe string that remembers the row to seek from.
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 1000
+
+
+def _encode_cursor(sort_column: str, direction: str, key, move: str):
+    payload = {"c": sort_column, "d": direction, "k": key, "m": move}
+    raw = json.dumps(payload, default=str, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def _decode_cursor(token: str, sort_column: str, direction: str):
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(token.encode()))
+    except (ValueError, TypeError):
+        raise ValueError("Invalid page cursor.")
+    if payload.get("c") != sort_column or payload.get("d") != direction:
+        raise ValueError("Page cursor does not match the requested sort order.")
+    return payload["k"], payload["m"]
+
+
+def _seek_condition(col, pk, key, descending: bool, after: bool):
+    """
+    WHERE clause selecting rows strictly after (or before) `key` in the order
+    `col [desc] NULLS LAST, pk [desc]`. When col is the primary key, col is None.
+    """
+    sort_value, pk_value = key
+    if col is None:
+        forward = pk < pk_value if descending else pk > pk_value
+        backward = pk > pk_value if descending else pk < pk_value
+        return forward if after else backward
+
+    pk_after = pk < pk_value if descending else pk > pk_value
+    pk_before = pk > pk_value if descending else pk < pk_value
+
+    if sort_value is None:
+        # We are in the trailing block of NULLs.
+        if after:
+            return and_(col.is_(None), pk_after)
+        return or_(col.isnot(None), and_(col.is_(None), pk_before))
+
+    value = bindparam(None, sort_value, type_=col.type)
+    col_after = col < value if descending else col > value
+    col_before = col > value if descending else col < value
+    if after:
+        return or_(col_after, and_(col == value, pk_after), col.is_(None))
+    return or_(col_before, and_(col == value, pk_before))
+
+
+def _order_by(col, pk, descending: bool, reverse: bool):
+    # reverse=True walks the same order backwards (used for "previous page").
+    desc_ = descending != reverse
+    clauses = []
+    if col is not None:
+        c = col.desc() if desc_ else col.asc()
+        clauses.append(c.nulls_first() if reverse else c.nulls_last())
+    clauses.append(pk.desc() if desc_ else pk.asc())
+    return clauses
+
+
+def get_page(
+    role: str,
+    schema: str,
+    table_name: str,
+    page_size: int = None,
+    sort_column: str = None,
+    direction: str = "asc",
+    cursor: str = None,
+    columns=None,
+    joins=None,
+):
+    """
+    Returns one page of `schema.table_name`, read as `role`.
+
+    - page_size: rows per page (default DEFAULT_PAGE_SIZE, max MAX_PAGE_SIZE).
+    - sort_column: any column of the table (defaults to the primary key).
+    - direction: "asc" or "desc".
+    - cursor: a token from a previous page's next_cursor / prev_cursor.
+    - columns: optional list of column names to load (default: all).
+    - joins: optional {fk column: (table in schema, {column: output name})},
+      LEFT JOINed on that table's primary key in the same query.
+
+    Returns a dict:
+        rows            list of dicts (at most page_size)
+        next_cursor     token for the following page, or None
+        prev_cursor     token for the preceding page, or None
+        estimated_total cheap planner estimate of the table size (may be None)
+    """
+    key = ("page", table_name, page_size, sort_column, direction, cursor,
+           tuple(columns) if columns else None, _freeze(joins))
+    tables = [table_name] + [ref for ref, _ in (joins or {}).values()]
+    return cached_read(
+        role, schema, tables, key,
+        lambda: _load_page(role, schema, table_name, page_size, sort_column,
+                           direction, cursor, columns, joins),
+    )
+
+
+def _load_page(
+    role: str,
+    schema: str,
+    table_name: str,
+    page_size: int = None,
+    sort_column: str = None,
+    direction: str = "asc",
+    cursor: str = None,
+    columns=None,
+    joins=None,
+):
+    table = get_table(schema, table_name)
+    pk_cols = list(table.primary_key.columns)
+    if len(pk_cols) != 1:
+        raise ValueError(f"{schema}.{table_name} needs a single-column primary key.")
+    pk = pk_cols[0]
+
+    direction = direction.lower()
+    if direction not in ("asc", "desc"):
+        raise ValueError("direction must be 'asc' or 'desc'.")
+    sort_column = sort_column or pk.name
+    if sort_column not in table.c:
+        raise ValueError(f"Unknown sort column: {sort_column}")
+    col = None if sort_column == pk.name else table.c[sort_column]
+    page_size = max(1, min(int(page_size or DEFAULT_PAGE_SIZE), MAX_PAGE_SIZE))
+    descending = direction == "desc"
+
+    selected = [table.c[c] for c in columns] if columns else list(table.c)
+    for needed in (pk, col):
+        if needed is not None and needed.name not in [c.name for c in selected]:
+            selected.append(needed)
+
+    source, joined = table, []
+    for fk_name, (ref_name, labels) in (joins or {}).items():
+        ref = get_table(schema, ref_name)
+        (ref_pk,) = ref.primary_key.columns
+        source = source.outerjoin(ref, table.c[fk_name] == ref_pk)
+        joined += [ref.c[c].label(label) for c, label in labels.items()]
+
+    move = "next"
+    stmt = select(*selected, *joined).select_from(source)
+    if cursor:
+        key, move = _decode_cursor(cursor, sort_column, direction)
+        stmt = stmt.where(
+            _seek_condition(col, pk, key, descending, after=(move == "next"))
+        )
+    backwards = move == "prev"
+    stmt = stmt.order_by(*_order_by(col, pk, descending, reverse=backwards))
+    stmt = stmt.limit(page_size + 1)
+
+    with role_connection(role, schema) as conn:
+        rows = [dict(r._mapping) for r in conn.execute(stmt).fetchall()]
+        query_stats.note_materialized(rows)
+        estimated_total = _estimate_row_count(conn, schema, table_name)
+        conn.commit()
+
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+    if backwards:
+        rows.reverse()
+        has_prev, has_next = has_more, True
+    else:
+        has_prev, has_next = cursor is not None, has_more
+
+    def key_of(row):
+        return [row[sort_column] if col is not None else None, row[pk.name]]
+
+    next_cursor = prev_cursor = None
+    if rows and has_next:
+        next_cursor = _encode_cursor(sort_column, direction, key_of(rows[-1]), "next")
+    if rows and has_prev:
+        prev_cursor = _encode_cursor(sort_column, direction, key_of(rows[0]), "prev")
+
+    if columns:
+        keep = list(columns) + [c.name for c in joined]
+        rows = [{c: r[c] for c in keep} for r in rows]
+
+    return {
+        "rows": rows,
+        "next_cursor": next_cursor,
+        "prev_cursor": prev_cursor,
+        "estimated_total": estimated_total,
+    }
+
+
+_ESTIMATE_SQL = text("""
+SELECT c.reltuples::bigint
+FROM pg_class c
+JOIN pg_namespace n ON n.oid = c.relnamespace
+WHERE n.nspname = :schema AND c.relname = :table
+""")
+
+
+def _estimate_row_count(conn, schema: str, table_name: str):
+    estimate = conn.execute(
+        _ESTIMATE_SQL, {"schema": schema, "table": table_name}
+    ).scalar()
+    return estimate if estimate is not None and estimate >= 0 else None
+
+
+def estimate_row_count(role: str, schema: str, table_name: str):
+    """
+    Returns the planner's row estimate for schema.table_name from pg_class
+    (kept current by autovacuum / ANALYZE) instead of a full COUNT(*).
+    Returns None if the table has never been analyzed.
+    """
+    with role_connection(role, schema) as conn:
+        estimate = _estimate_row_count(conn, schema, table_name)
+        conn.commit()
+    return estimate
+
+
+# =============================================================================
+# 9. Streaming reads (server-side cursors)
+# =============================================================================
+
+# For exports / analytics over whole tables. Rows are pulled from a named
+# (server-side) cursor STREAM_BATCH_SIZE at a time, so client memory stays
+# constant no matter how large the table is. The pooled connection is held
+# until the iterator is exhausted or closed.
+STREAM_BATCH_SIZE = 5000
+
+# Which role reads which schema.
+SCHEMA_ROLES = {
+    "doctor_schema": "doctor_user",
+    "patient_schema": "patient_user",
+    "admin_schema": "admin_user",
+}
+
+
+def stream_query_batches(
+    sql,
+    role: str,
+    schema: str,
+    batch_size: int = None,
+    settings: dict = None,
+    as_dicts: bool = True,
+    **params,
+):
+    """
+    Runs `sql` (a SQL string or a SQLAlchemy select) as `role` on `schema`
+    and yields lists of at most batch_size rows.
+    - as_dicts=False yields SQLAlchemy Row tuples (cheaper for exports).
+    - settings: session variables for this checkout (e.g. app.patient_id).
+    """
+    batch_size = batch_size or STREAM_BATCH_SIZE
+    stmt = text(sql) if isinstance(sql, str) else sql
+    with role_connection(role, schema, settings) as conn:
+        result = conn.execution_options(yield_per=batch_size).execute(stmt, params)
+        try:
+            for part in result.partitions(batch_size):
+                if as_dicts:
+                    yield [dict(r._mapping) for r in part]
+                else:
+                    yield part
+        finally:
+            result.close()
+            conn.rollback()
+
+
+def stream_query(sql, role: str, schema: str, batch_size: int = None,
+                 settings: dict = None, as_dicts: bool = True, **params):
+    """
+    Like stream_query_batches, but yields one row at a time.
+    """
+    for batch in stream_query_batches(sql, role, schema, batch_size,
+                                      settings, as_dicts, **params):
+        yield from batch
+
+
+def _table_select(schema: str, table_name: str, columns=None):
+    if table_name not in SCHEMA_TABLES.get(schema, ()):
+        raise ValueError(f"{schema}.{table_name} is not a known table.")
+    table = get_table(schema, table_name)
+    cols = [table.c[c] for c in columns] if columns else list(table.c)
+    pk = list(table.primary_key.columns)
+    return select(*cols).order_by(*pk)
+
+
+def _stream_settings(schema: str, patient_id):
+    if schema == "patient_schema":
+        if patient_id is None:
+            raise ValueError("patient_schema reads need a patient_id (RLS).")
+        return {"app.patient_id": patient_id}
+    return None
+
+
+def stream_table_batches(schema: str, table_name: str, batch_size: int = None,
+                         columns=None, as_dicts: bool = True, patient_id: int = None):
+    """
+    Yields `schema.table_name` in primary-key order as lists of rows, reading
+    as the schema's own role (see SCHEMA_ROLES).
+    - columns: optional list of column names to load (default: all).
+    - patient_id: required for patient_schema, where RLS filters the rows.
+    """
+    stmt = _table_select(schema, table_name, columns)
+    yield from stream_query_batches(
+        stmt, SCHEMA_ROLES[schema], schema, batch_size,
+        _stream_settings(schema, patient_id), as_dicts,
+    )
+
+
+def stream_table(schema: str, table_name: str, batch_size: int = None,
+                 columns=None, as_dicts: bool = True, patient_id: int = None):
+    """
+    Like stream_table_batches, but yields one row at a time.
+    """
+    for batch in stream_table_batches(schema, table_name, batch_size,
+                                      columns, as_dicts, patient_id):
+        yield from batch
+
+
+# =============================================================================
+# 10. Columnar fetch straight into pandas DataFrames
+# =============================================================================
+
+# Instead of list-of-dicts -> pd.DataFrame (one dict per row, then pandas
+# guesses every column's type), rows are read as tuples, transposed into one
+# list per column, and each column is converted once to the dtype implied by
+# the reflected column type:
+#   Integer -> Int64 (nullable), Numeric/Float -> float64, Date -> datetime64,
+#   DateTime -> datetime64 (UTC if timezone-aware), Boolean -> boolean,
+#   anything else -> object.
+
+def pandas_dtype(column_type):
+    """
+    Returns the pandas dtype name used for a SQLAlchemy column type.
+    """
+    if isinstance(column_type, sqltypes.Boolean):
+        return "boolean"
+    if isinstance(column_type, sqltypes.Integer):
+        return "Int64"
+    if isinstance(column_type, (sqltypes.Numeric, sqltypes.Float)):
+        return "float64"
+    if isinstance(column_type, sqltypes.DateTime):
+        if getattr(column_type, "timezone", False):
+            return "datetime64[ns, UTC]"
+        return "datetime64[ns]"
+    if isinstance(column_type, sqltypes.Date):
+        return "datetime64[ns]"
+    return "object"
+
+
+def _column_array(values: list, column_type):
+    import numpy as np
+    import pandas as pd
+
+    dtype = pandas_dtype(column_type) if column_type is not None else "object"
+    if dtype in ("Int64", "boolean"):
+        return pd.array(values, dtype=dtype)
+    if dtype == "float64":
+        return np.array(values, dtype="float64")  # None -> NaN, Decimal -> float
+    if dtype == "datetime64[ns, UTC]":
+        return pd.to_datetime(values, utc=True)
+    arr = np.empty(len(values), dtype=object)
+    arr[:] = values
+    if dtype == "datetime64[ns]":
+        # Dates repeat a lot: convert each distinct value once, then gather.
+        unit = "datetime64[us]" if isinstance(column_type, sqltypes.DateTime) else "datetime64[D]"
+        codes, uniques = pd.factorize(arr)  # None -> code -1
+        converted = np.array(list(uniques), dtype=unit).astype(dtype)
+        out = np.full(len(codes), np.datetime64("NaT"), dtype=dtype)
+        present = codes >= 0
+        out[present] = converted[codes[present]]
+        return out
+    return arr
+
+
+def frame_from_batches(names, column_types, batches):
+    """
+    Builds a DataFrame from an iterable of row batches (sequences of tuples),
+    converting each column once using column_types (None = leave as object).
+    """
+    import pandas as pd
+
+    columns = [[] for _ in names]
+    for batch in batches:
+        if not batch:
+            continue
+        for acc, values in zip(columns, zip(*batch)):
+            acc.extend(values)
+    data = {
+        name: _column_array(values, type_)
+        for name, type_, values in zip(names, column_types, columns)
+    }
+    return pd.DataFrame(data, columns=list(names))
+
+
+def _statement_types(stmt, table=None):
+    # A select() knows its column types; for raw SQL fall back to the
+    # reflected table's columns by name.
+    if hasattr(stmt, "selected_columns"):
+        return {c.name: c.type for c in stmt.selected_columns}
+    if table is not None:
+        return {c.name: c.type for c in table.c}
+    return {}
+
+
+def fetch_dataframe(sql, role: str, schema: str, table=None,
+                    settings: dict = None, batch_size: int = None, **params):
+    """
+    Runs `sql` (string or select) as `role` on `schema` and returns a pandas
+    DataFrame built column-by-column with dtypes from the reflected types.
+    - table: reflected Table used for dtypes when sql is a plain string.
+    - settings: session variables for this checkout (e.g. app.patient_id).
+    """
+    stmt = text(sql) if isinstance(sql, str) else sql
+    types = _statement_types(stmt, table)
+    batch_size = batch_size or STREAM_BATCH_SIZE
+    with role_connection(role, schema, settings) as conn:
+        result = conn.execution_options(yield_per=batch_size).execute(stmt, params)
+        try:
+            names = list(result.keys())
+            frame = frame_from_batches(
+                names, [types.get(n) for n in names], result.partitions(batch_size)
+            )
+            query_stats.note_materialized(
+                nbytes=int(frame.memory_usage(index=False).sum()), row_count=len(frame)
+            )
+        finally:
+            result.close()
+            conn.rollback()
+    return frame
+
+
+def table_dataframe(schema: str, table_name: str, columns=None, patient_id: int = None):
+    """
+    Returns all of `schema.table_name` (primary-key order) as a typed DataFrame,
+    read as the schema's own role. Served from the read cache when fresh.
+    - patient_id: required for patient_schema, where RLS filters the rows.
+    Reference tables come from the shared reference store when it is enabled.
+    """
+    if not columns and reference_store.holds(schema, table_name):
+        return reference_store.frame(schema, table_name)
+    stmt = _table_select(schema, table_name, columns)
+    role = SCHEMA_ROLES[schema]
+    return cached_read(
+        role, schema, [table_name],
+        ("frame", table_name, tuple(columns) if columns else None),
+        lambda: fetch_dataframe(
+            stmt, role, schema, settings=_stream_settings(schema, patient_id)
+        ),
+        scope=("patient_id", patient_id) if patient_id is not None else None,
+        delta="frame" if patient_id is None else None,
+    )
+
+
+# The same mapping for Arrow (export.py, the shared reference store): Integer
+# -> int16/32/64 by width, Numeric/Float -> float64, Date -> date32,
+# DateTime -> timestamp[us] (UTC if timezone-aware), anything else -> string.
+
+def arrow_type(column_type):
+    """
+    Returns the Arrow type used for a SQLAlchemy column type. Needs pyarrow.
+    """
+    import pyarrow as pa
+
+    if isinstance(column_type, sqltypes.Boolean):
+        return pa.bool_()
+    if isinstance(column_type, sqltypes.BigInteger):
+        return pa.int64()
+    if isinstance(column_type, sqltypes.SmallInteger):
+        return pa.int16()
+    if isinstance(column_type, sqltypes.Integer):
+        return pa.int32()
+    if isinstance(column_type, (sqltypes.Numeric, sqltypes.Float)):
+        return pa.float64()
+    if isinstance(column_type, sqltypes.DateTime):
+        return pa.timestamp("us", tz="UTC" if getattr(column_type, "timezone", False) else None)
+    if isinstance(column_type, sqltypes.Date):
+        return pa.date32()
+    return pa.string()
+
+
+def arrow_schema(table):
+    """
+    Returns the Arrow schema for a reflected Table.
+    """
+    import pyarrow as pa
+
+    return pa.schema([
+        pa.field(c.name, arrow_type(c.type), nullable=c.nullable) for c in table.c
+    ])
+
+
+def arrow_batch(schema, rows):
+    """
+    Builds an Arrow RecordBatch from row tuples, one column at a time.
+    """
+    import pyarrow as pa
 
+    columns = list(zip(*rows)) if rows else [()] * len(schema)
+    arrays = []
+    for field, values in zip(schema, columns):
+        if pa.types.is_floating(field.type):
+            values = [None if v is None else float(v) for v in values]  # Decimal
+        arrays.append(pa.array(values, type=field.type))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+# =============================================================================
+# 11. Unit of work (one transaction, many statements)
+# =============================================================================
+
+class UnitOfWork:
+    """
+    A single transaction on a pooled (role, schema) connection. Everything
+    executed through it is committed together when the `with` block exits
+    cleanly, or rolled back if it raises.
+
+        with unit_of_work("doctor_user", "doctor_schema") as uow:
+            pid = uow.insert("patients", name="Ann", age=40,
+                             gender="Female", blood_type="O+")
+            uow.insert("medical_records", patient_id=pid, ...)
+    """
+
+    def __init__(self, conn, role: str, schema: str):
+        self.conn = conn
+        self.role = role
+        self.schema = schema
+        self.touched = set()  # table names written, or None for "unknown"
+        # sessions whose reads must see these writes (section 20)
+        self.sessions = {getattr(_routing, "session", None)} - {None}
+
+    def table(self, table_name: str):
+        return get_table(self.schema, table_name)
+
+    def execute(self, sql, **params):
+        """
+        Runs a SQL string (or SQLAlchemy statement) in this transaction.
+        Returns a list of dicts if it returns rows, else None.
+        """
+        stmt = text(sql) if isinstance(sql, str) else sql
+        result = self.conn.execute(stmt, params)
+        if result.returns_rows:
+            rows = [dict(r._mapping) for r in result.fetchall()]
+            if not isinstance(sql, str) or sql.lstrip()[:6].upper() != "SELECT":
+                self.touched.add(None)  # e.g. INSERT ... RETURNING
+            return rows
+        self.touched.add(None)  # can't tell which table raw SQL wrote
+        return None
+
+    def insert(self, table_name: str, **values):
+        """
+        Inserts one row and returns its generated primary key (via RETURNING).
+        """
+        table = self.table(table_name)
+        pk = list(table.primary_key.columns)
+        if statements.enabled(self.conn) and all(c in table.c for c in values):
+            name = _insert_statement(table, list(values))
+            row = statements.execute(self.conn, name, self.role, self.schema, values).fetchone()
+        else:
+            stmt = insert(table).values(**values).returning(*pk)
+            row = self.conn.execute(stmt).fetchone()
+        self.touched.add(table_name)
+        return row[0] if len(pk) == 1 else tuple(row)
+
+    def insert_many(self, table_name: str, rows):
+        """
+        Inserts many rows (all with the same columns) and returns their
+        generated primary keys, in input order. SQLAlchemy batches the rows
+        into multi-VALUES statements and sorts the RETURNING rows back into
+        parameter order, which PostgreSQL itself does not promise.
+        """
+        rows = list(rows)
+        if not rows:
+            return []
+        table = self.table(table_name)
+        pk = list(table.primary_key.columns)
+        stmt = insert(table).returning(*pk, sort_by_parameter_order=True)
+        result = self.conn.execute(stmt, rows).fetchall()
+        self.touched.add(table_name)
+        return [r[0] if len(pk) == 1 else tuple(r) for r in result]
+
+    @contextmanager
+    def savepoint(self):
+        """
+        A nested transaction: if the block raises, only its statements are
+        rolled back and the exception propagates; the outer unit of work can
+        catch it and carry on.
+        """
+        with self.conn.begin_nested():
+            yield self
+
+
+@contextmanager
+def unit_of_work(role: str, schema: str):
+    """
+    Yields a UnitOfWork for (role, schema); commits once on success.
+    Cached reads of the tables it wrote are brought up to date by the change
+    feed when it covers them (section 19), else invalidated afterwards.
+    """
+    with role_connection(role, schema) as conn:
+        uow = UnitOfWork(conn, role, schema)
+        token, fed = None, False
+        try:
+            yield uow
+            if change_feed.running and change_feed.covers(schema, uow.touched):
+                token = change_feed.sync_token(conn)
+            conn.commit()
+            if uow.touched:
+                replicas.note_commit(conn, uow.sessions)
+            fed = token is not None and change_feed.wait(token)
+        except BaseException:
+            if token is not None:
+                change_feed.forget(token)
+            conn.rollback()
+            raise
+        finally:
+            _invalidate_touched(uow, fed)
+
+
+def _invalidate_touched(uow, fed: bool = False):
+    # Also runs after a rollback: a savepoint may have been released before
+    # the failure, and dropping a few cache entries is always safe. fed: the
+    # change feed has already applied the writes to this process's caches,
+    # which leaves only the shared reference snapshots.
+    invalidate = reference_store.invalidate if fed else invalidate_table
+    if None in uow.touched:
+        invalidate(uow.schema)
+    for table_name in uow.touched - {None}:
+        invalidate(uow.schema, table_name)
+
+
+def _insert_returning_id(role: str, schema: str, table_name: str, uow=None, **values):
+    # Inside the caller's unit of work if given, else in a transaction of its own.
+    if uow is not None:
+        if uow.schema != schema:
+            raise ValueError(f"This insert needs a {schema} unit of work, not {uow.schema}.")
+        return uow.insert(table_name, **values)
+    with unit_of_work(role, schema) as own:
+        return own.insert(table_name, **values)
+
+
+# =============================================================================
+# 12. Read cache for dashboard queries (TTL + LRU, invalidated by writes)
+# =============================================================================
+
+# Streamlit reruns the whole script on every widget interaction; this keeps
+# the dashboard reads from hitting the database when nothing has changed.
+# Entries are keyed by (role, schema, query, params, scope) and tagged with
+# the tables they read. Every write through unit_of_work / the insert helpers
+# / bulk_load invalidates exactly the tables it touched. Patient reads use the
+# patient_id as their scope, so one patient's rows can never be served to
+# another. Cached values are shared: treat them as read-only.
+#
+# Whole-table reads (SELECT * as rows, table_dataframe as a frame) can be
+# cached with delta="rows" / "frame": the change feed (section 19) then
+# patches them with the changed rows instead of dropping them (apply_change).
+READ_CACHE_TTL = 30           # seconds
+READ_CACHE_MAX_ENTRIES = 256
+
+
+class ReadCache:
+    """
+    A thread-safe TTL + LRU cache of query results, tagged by table.
+    """
+
+    def __init__(self, ttl: float = READ_CACHE_TTL, max_entries: int = READ_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()   # key -> (expires_at, tables, value)
+        self._delta = {}                # key -> ("rows" | "frame", (schema, table))
+        self._by_table = {}             # (schema, table) -> set of keys
+        self._versions = {}             # (schema, table) -> invalidation count
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0,
+                      "expirations": 0, "invalidations": 0, "patches": 0}
+
+    def get_or_load(self, key, tables, loader, delta: str = None):
+        """
+        Returns the cached value for key, or calls loader() and caches it.
+        tables: the (schema, table) pairs the value was read from.
+        delta: "rows" or "frame" if the value is the whole of tables[0], as a
+        list of dicts or a DataFrame; apply_change then patches it in place
+        of dropping it.
+        """
+        hit, value, versions = self._lookup(key, tables)
+        if hit:
+            return value
+        return self._store(key, tables, versions, loader(), delta)
+
+    async def get_or_load_async(self, key, tables, loader, delta: str = None):
+        """
+        get_or_load for a coroutine function loader (see db_async.py).
+        """
+        hit, value, versions = self._lookup(key, tables)
+        if hit:
+            return value
+        return self._store(key, tables, versions, await loader(), delta)
+
+    def _lookup(self, key, tables):
+        # (hit, value, table versions to check before storing a miss)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._entries.move_to_end(key)
+                    self.stats["hits"] += 1
+                    return True, entry[2], None
+                self._drop(key)
+                self.stats["expirations"] += 1
+            self.stats["misses"] += 1
+            return False, None, [self._versions.get(t, 0) for t in tables]
+
+    def _store(self, key, tables, versions, value, delta=None):
+        with self._lock:
+            # Don't store a result that a concurrent write already made stale.
+            if versions != [self._versions.get(t, 0) for t in tables]:
+                return value
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (time.monotonic() + self.ttl, tuple(tables), value)
+            if delta is not None and len(tables) == 1:
+                self._delta[key] = (delta, tables[0])
+            for t in tables:
+                self._by_table.setdefault(t, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                oldest = next(iter(self._entries))
+                self._drop(oldest)
+                self.stats["evictions"] += 1
+        return value
+
+    def _drop(self, key):
+        _, tables, _ = self._entries.pop(key)
+        self._delta.pop(key, None)
+        for t in tables:
+            keys = self._by_table.get(t)
+            if keys is not None:
+                keys.discard(key)
+
+    def invalidate(self, schema: str, table: str = None):
+        """
+        Drops every entry that read schema.table (or anything in schema if
+        table is None).
+        """
+        with self._lock:
+            if table is None:
+                targets = {t for t in self._by_table if t[0] == schema}
+                targets |= {(schema, name) for name in SCHEMA_TABLES.get(schema, ())}
+            else:
+                targets = {(schema, table)}
+            for t in targets:
+                self._versions[t] = self._versions.get(t, 0) + 1
+                for key in list(self._by_table.get(t, ())):
+                    if key in self._entries:
+                        self._drop(key)
+                        self.stats["invalidations"] += 1
+
+    def patchable(self, schema: str, table: str):
+        """
+        True if some entry for schema.table could be patched by apply_change.
+        """
+        with self._lock:
+            return any(
+                self._delta.get(k, (None, None))[1] == (schema, table)
+                for k in self._by_table.get((schema, table), ())
+            )
+
+    def apply_change(self, schema: str, table: str, op: str, pk: str,
+                     rows=None, ids=None, column_types=None):
+        """
+        Brings the cached reads of schema.table up to date with a committed
+        change: op "I"/"U" with the new rows (dicts), or "D" with the deleted
+        primary keys. Entries cached with delta are replaced by patched
+        copies (inserts and updates are upserts by pk, so applying a change
+        twice is harmless); every other entry, or all of them if the rows
+        are unknown (None), is dropped. column_types: {name: SQLAlchemy type}
+        for building DataFrame rows. Returns the number of entries patched.
+        """
+        t = (schema, table)
+        known = ids is not None if op == "D" else rows is not None
+        with self._lock:
+            self._versions[t] = self._versions.get(t, 0) + 1
+            targets = []
+            for key in list(self._by_table.get(t, ())):
+                if key not in self._entries:
+                    continue
+                kind, where = self._delta.get(key, (None, None))
+                if known and where == t:
+                    targets.append((key, kind, self._entries[key][2]))
+                else:
+                    self._drop(key)
+                    self.stats["invalidations"] += 1
+        patched = [
+            (key, value, _patch_rows(value, op, pk, rows, ids) if kind == "rows"
+             else _patch_frame(value, op, pk, rows, ids, column_types or {}))
+            for key, kind, value in targets
+        ]
+        done = 0
+        with self._lock:
+            for key, before, after in patched:
+                entry = self._entries.get(key)
+                if entry is None:
+                    continue
+                if entry[2] is not before:
+                    # Replaced while we were patching: can't tell which is newer.
+                    self._drop(key)
+                    self.stats["invalidations"] += 1
+                    continue
+                self._entries[key] = (entry[0], entry[1], after)
+                done += 1
+            self.stats["patches"] += done
+        return done
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._delta.clear()
+            self._by_table.clear()
+            for t in list(self._versions):
+                self._versions[t] += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def _patch_rows(value, op, pk, rows, ids):
+    # A new list; the row dicts themselves are shared with the old value.
+    if op == "D":
+        gone = set(ids)
+        return [r for r in value if r[pk] not in gone]
+    new = {r[pk]: r for r in rows}
+    patched = [new.pop(r[pk], r) for r in value]
+    patched.extend(new.values())
+    return patched
+
+
+def _patch_frame(frame, op, pk, rows, ids, column_types):
+    import pandas as pd
+
+    if op == "D":
+        return frame[~frame[pk].isin(list(ids))].reset_index(drop=True)
+    names = list(frame.columns)
+    new = frame_from_batches(
+        names, [column_types.get(n) for n in names],
+        [[tuple(r.get(n) for n in names) for r in rows]],
+    )
+    kept = frame[~frame[pk].isin(new[pk].tolist())]
+    patched = pd.concat([kept, new], ignore_index=True)
+    if not patched[pk].is_monotonic_increasing:
+        patched = patched.sort_values(pk, ignore_index=True)  # table_dataframe order
+    return patched
+
+
+read_cache = ReadCache()
+
+
+def _freeze(value):
+    # Turn params into something hashable for the cache key.
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple, set)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+def cached_read(role: str, schema: str, tables, query_key, loader, scope=None, delta=None):
+    """
+    Returns loader()'s result through read_cache.
+    - tables: names (in `schema`) the query reads, used for invalidation.
+    - query_key: the SQL text or any hashable description of the query.
+    - scope: extra isolation key, e.g. the patient_id for RLS reads.
+    - delta: "rows" / "frame" if the result is the whole table (see ReadCache).
+    """
+    key = (role, schema, _freeze(query_key), scope)
+
+    def load():
+        with _shared_load():
+            return loader()
+
+    return read_cache.get_or_load(key, [(schema, t) for t in tables], load, delta)
+
+
+def _execute_cached(sql_text: str, role: str, schema: str, tables, scope=None,
+                    delta=None, **params):
+    # _execute_with_role through the read cache.
+    return cached_read(
+        role, schema, tables, (sql_text, params),
+        lambda: _execute_with_role(sql_text, role=role, schema=schema, **params),
+        scope=scope, delta=delta,
+    )
+
+
+def invalidate_table(schema: str, table_name: str = None):
+    """
+    Drops cached reads of schema.table_name (or of the whole schema), and of
+    the other schemas' copies of synced tables.
+    Call this after writing to the database outside the db helpers.
+    """
+    targets = [(schema, table_name)]
+    for name in SYNCED_TABLES:
+        if table_name in (None, name) and name in SCHEMA_TABLES.get(schema, ()):
+            targets += [(s, name) for s in synced_copies(name) if s != schema]
+    for s, t in targets:
+        read_cache.invalidate(s, t)
+        dimension_cache.invalidate(s, t)
+        reference_store.invalidate(s, t)
+
+
+def read_cache_stats():
+    """
+    Returns hit / miss / eviction / invalidation counters and the entry count.
+    """
+    return dict(read_cache.stats, entries=len(read_cache))
+
+
+# =============================================================================
+# 13. Query instrumentation + slow-query log
+# =============================================================================
+
+# Every statement run on a role sub-pool is observed through SQLAlchemy's
+# cursor events (see RolePool._create_engine), so _execute_with_role, the
+# patient RLS path, units of work and streams are all covered. Per statement
+# we keep: role, schema, normalized SQL, the *shape* of the bind parameters
+# (names and types only, never values - this is PHI), connection-wait time,
+# execution time, rows and an estimate of the bytes materialized.
+#
+# Statements slower than SLOW_QUERY_MS go to the "healthcare.db.slow" logger
+# and to slow_queries(). With SLOW_QUERY_EXPLAIN=1 a SELECT that was slow is
+# re-run in the background under EXPLAIN (ANALYZE, BUFFERS) (in a rolled-back
+# transaction) and literals in its conditions are redacted from the plan.
+SLOW_QUERY_MS = float(os.environ.get("SLOW_QUERY_MS", "500"))
+SLOW_QUERY_EXPLAIN = os.environ.get("SLOW_QUERY_EXPLAIN", "") == "1"
+QUERY_WINDOW = 1000      # recent samples kept per statement for percentiles
+SLOW_QUERY_KEEP = 100    # recent slow queries kept in memory
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+slow_log = logging.getLogger("healthcare.db.slow")
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r"(?<![\w$%])-?\d+(?:\.\d+)?\b")
+_WHITESPACE = re.compile(r"\s+")
+_PLAN_CONDITION = re.compile(r"(Cond|Filter): ")
+_READ_STATEMENT = re.compile(r"\s*(SELECT|WITH)\b", re.IGNORECASE)
+
+
+def normalize_sql(statement: str):
+    """
+    Collapses whitespace and replaces literals with ? so equivalent
+    statements share one series.
+    """
+    sql = _STRING_LITERAL.sub("?", statement)
+    sql = _NUMBER_LITERAL.sub("?", sql)
+    return _WHITESPACE.sub(" ", sql).strip()
+
+
+def _param_shape(parameters, executemany: bool):
+    # Names and Python types only.
+    def shape(p):
+        if isinstance(p, dict):
+            return {k: type(v).__name__ for k, v in p.items()}
+        if isinstance(p, (list, tuple)):
+            return [type(v).__name__ for v in p]
+        return type(p).__name__ if p is not None else None
+
+    if executemany and isinstance(parameters, (list, tuple)):
+        first = shape(parameters[0]) if parameters else None
+        return {"executemany": len(parameters), "row": first}
+    return shape(parameters)
+
+
+def _estimate_bytes(rows, sample: int = 100):
+    # Cheap estimate: measure up to `sample` rows and extrapolate.
+    if not rows:
+        return 0
+    head = rows[:sample]
+    size = 0
+    for row in head:
+        values = row.values() if isinstance(row, dict) else row
+        for v in values:
+            size += len(v) if isinstance(v, (str, bytes)) else 8
+    return int(size * len(rows) / len(head))
+
+
+class QueryStats:
+    """
+    Per-statement counters, a Prometheus-style latency histogram and a
+    rolling window of recent latencies, plus the slow-query log.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._series = {}
+        self._local = threading.local()
+        self.slow = deque(maxlen=SLOW_QUERY_KEEP)
+
+    def _new_series(self, sql: str):
+        return {
+            "sql": sql,
+            "calls": 0,
+            "errors": 0,
+            "seconds_sum": 0.0,
+            "wait_seconds_sum": 0.0,
+            "rows": 0,
+            "bytes": 0,
+            "buckets": [0] * len(LATENCY_BUCKETS),
+            "window": deque(maxlen=QUERY_WINDOW),
+        }
+
+    def observe(self, role, schema, statement, parameters, executemany,
+                seconds, rows, wait_seconds):
+        sql = normalize_sql(statement)
+        query_id = hashlib.md5(sql.encode()).hexdigest()[:12]
+        record = {
+            "role": role,
+            "schema": schema,
+            "query_id": query_id,
+            "sql": sql,
+            "params": _param_shape(parameters, executemany),
+            "wait_ms": wait_seconds * 1000,
+            "exec_ms": seconds * 1000,
+            "rows": rows if rows is not None and rows >= 0 else None,
+            "bytes": None,
+            "at": time.time(),
+        }
+        key = (role, schema, query_id)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = self._new_series(sql)
+            series["calls"] += 1
+            series["seconds_sum"] += seconds
+            series["wait_seconds_sum"] += wait_seconds
+            series["rows"] += record["rows"] or 0
+            series["window"].append(seconds)
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    series["buckets"][i] += 1
+        self._local.last = (key, record)
+        if record["exec_ms"] >= SLOW_QUERY_MS:
+            self.slow.append(record)
+            slow_log.warning("slow query %s", json.dumps(record, default=str))
+        return record
+
+    def observe_error(self, role, schema, statement):
+        key = (role, schema, hashlib.md5(normalize_sql(statement).encode()).hexdigest()[:12])
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = self._new_series(normalize_sql(statement))
+            series["errors"] += 1
+
+    def note_materialized(self, rows=None, nbytes: int = None, row_count: int = None):
+        """
+        Attributes materialized rows / bytes to the statement this thread ran
+        last (called by the helpers after they fetch). Pass either the rows
+        or an nbytes / row_count pair.
+        """
+        last = getattr(self._local, "last", None)
+        if last is None:
+            return
+        key, record = last
+        if nbytes is None:
+            nbytes = _estimate_bytes(rows)
+        if row_count is None and rows is not None:
+            row_count = len(rows)
+        record["bytes"] = nbytes
+        if row_count is not None and record["rows"] is None:
+            record["rows"] = row_count
+        with self._lock:
+            series = self._series.get(key)
+            if series is not None:
+                series["bytes"] += nbytes
+
+    def snapshot(self):
+        """
+        Returns one dict per (role, schema, statement) with totals and
+        p50/p95/p99 over the rolling window (in ms).
+        """
+        out = []
+        with self._lock:
+            items = [(k, dict(s, window=sorted(s["window"]))) for k, s in self._series.items()]
+        for (role, schema, query_id), s in items:
+            window = s.pop("window")
+            s.pop("buckets")
+            s.update(role=role, schema=schema, query_id=query_id)
+            for pct in (50, 95, 99):
+                s[f"p{pct}_ms"] = (
+                    window[min(len(window) - 1, int(len(window) * pct / 100))] * 1000
+                    if window else None
+                )
+            out.append(s)
+        return sorted(out, key=lambda s: s["seconds_sum"], reverse=True)
+
+    def prometheus(self):
+        """
+        Renders the counters and histograms in Prometheus text format.
+        """
+        lines = [
+            "# HELP healthcare_db_query_duration_seconds Statement execution time.",
+            "# TYPE healthcare_db_query_duration_seconds histogram",
+        ]
+        with self._lock:
+            items = [(k, dict(s)) for k, s in self._series.items()]
+        for (role, schema, query_id), s in items:
+            labels = f'role="{role}",schema="{schema}",query="{query_id}"'
+            for bound, count in zip(LATENCY_BUCKETS, s["buckets"]):
+                lines.append(
+                    f'healthcare_db_query_duration_seconds_bucket{{{labels},le="{bound}"}} {count}')
+            lines.append(
+                f'healthcare_db_query_duration_seconds_bucket{{{labels},le="+Inf"}} {s["calls"]}')
+            lines.append(f"healthcare_db_query_duration_seconds_sum{{{labels}}} {s['seconds_sum']}")
+            lines.append(f"healthcare_db_query_duration_seconds_count{{{labels}}} {s['calls']}")
+        for metric, field, help_text in (
+            ("healthcare_db_query_errors_total", "errors", "Statements that raised."),
+            ("healthcare_db_query_rows_total", "rows", "Rows returned."),
+            ("healthcare_db_query_bytes_total", "bytes", "Estimated bytes materialized."),
+            ("healthcare_db_connection_wait_seconds_total", "wait_seconds_sum",
+             "Time spent waiting for a pooled connection."),
+        ):
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} counter")
+            for (role, schema, query_id), s in items:
+                lines.append(
+                    f'{metric}{{role="{role}",schema="{schema}",query="{query_id}"}} {s[field]}')
+        lines.append("# HELP healthcare_db_pool_checked_out Connections currently checked out.")
+        lines.append("# TYPE healthcare_db_pool_checked_out gauge")
+        for name, m in pool_metrics().items():
+            role, schema = name.split("@", 1)
+            lines.append(
+                f'healthcare_db_pool_checked_out{{role="{role}",schema="{schema}"}} '
+                f'{m.get("checked_out", 0)}')
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        with self._lock:
+            self._series.clear()
+            self.slow.clear()
+
+
+query_stats = QueryStats()
+
+
+def _redact_plan(plan_lines):
+    # Conditions in a plan show the bound values; strip them.
+    out = []
+    for line in plan_lines:
+        if _PLAN_CONDITION.search(line):
+            line = _NUMBER_LITERAL.sub("?", _STRING_LITERAL.sub("?", line))
+        out.append(line)
+    return "\n".join(out)
+
+
+def _explain_in_background(eng, record, statement, parameters):
+    if not _READ_STATEMENT.match(statement):
+        return  # EXPLAIN ANALYZE executes the statement: reads only
+    if ";" in statement.strip().rstrip(";"):
+        return  # multi-statement (e.g. the patient path); nothing to EXPLAIN
+
+    def run():
+        try:
+            raw = eng.raw_connection()
+            try:
+                cur = raw.cursor()
+                cur.execute("EXPLAIN (ANALYZE, BUFFERS) " + statement, parameters)
+                plan = _redact_plan(r[0] for r in cur.fetchall())
+                cur.close()
+                raw.rollback()
+            finally:
+                raw.close()
+            record["plan"] = plan
+            slow_log.warning("plan for %s:\n%s", record["query_id"], plan)
+        except Exception as e:
+            slow_log.warning("EXPLAIN failed for %s: %s", record["query_id"], e)
+
+    threading.Thread(target=run, name="slow-query-explain", daemon=True).start()
+
+
+def _instrument_engine(eng, role: str, schema: str, explain: bool = True):
+    # Called for every role sub-engine. explain=False for engines whose
+    # statements cannot be re-run on a psycopg2 connection (asyncpg's $n).
+    @event.listens_for(eng, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    @event.listens_for(eng, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info["query_started"].pop()
+        seconds = time.perf_counter() - started
+        statement, parameters = statements.source(statement, parameters)
+        record = query_stats.observe(
+            role, schema, statement, parameters, executemany, seconds,
+            cursor.rowcount, conn.info.pop("checkout_wait", 0.0),
+        )
+        if explain and SLOW_QUERY_EXPLAIN and record["exec_ms"] >= SLOW_QUERY_MS \
+                and not executemany:
+            _explain_in_background(eng, record, statement, parameters)
+
+    @event.listens_for(eng, "handle_error")
+    def _error(context):
+        conn = context.connection
+        if conn is not None and conn.info.get("query_started"):
+            conn.info["query_started"].pop()
+        if context.statement:
+            statement, _ = statements.source(context.statement, context.parameters)
+            query_stats.observe_error(role, schema, statement)
+
+
+def query_metrics():
+    """
+    Returns per-statement stats (calls, p50/p95/p99, rows, bytes, waits).
+    """
+    return query_stats.snapshot()
+
+
+def slow_queries():
+    """
+    Returns the most recent slow queries (newest last).
+    """
+    return list(query_stats.slow)
+
+
+def prometheus_metrics():
+    """
+    Query and pool metrics in Prometheus text exposition format.
+    """
+    return query_stats.prometheus()
+
+
+# With QUERY_WORKLOAD_FILE set, each process merges its per-statement totals
+# into that JSON file on exit, so index_advisor.py can work from the real
+# dashboard workload. Only normalized SQL and timings are written.
+QUERY_WORKLOAD_FILE = os.environ.get("QUERY_WORKLOAD_FILE")
+
+
+def save_query_workload(path: str):
+    """
+    Merges query_metrics() into the JSON workload file at path (calls, rows
+    and seconds are summed per role / schema / statement).
+    """
+    merged = {}
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            for s in json.load(f):
+                merged[(s["role"], s["schema"], s["query_id"])] = s
+    for s in query_metrics():
+        key = (s["role"], s["schema"], s["query_id"])
+        if key in merged:
+            old = merged[key]
+            for field in ("calls", "errors", "rows", "bytes",
+                          "seconds_sum", "wait_seconds_sum"):
+                s[field] += old.get(field, 0)
+        merged[key] = s
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(list(merged.values()), f, indent=1)
+    os.replace(tmp, path)
+
+
+if QUERY_WORKLOAD_FILE:
+    atexit.register(lambda: save_query_workload(QUERY_WORKLOAD_FILE))
+
+
+# =============================================================================
+# 14. Admin analytics: aggregates pushed down to PostgreSQL
+# =============================================================================
+
+# Group-by / filter / time-bucket requests are compiled into one SELECT over
+# the reflected admin tables, so only the aggregated rows leave the database.
+#
+#   admin_aggregate(["count", "avg:billing_amount"], group_by=["hospital_id"])
+#   admin_aggregate(["count"], group_by=["admission_type"], time_bucket="month")
+#   admin_aggregate(["p50:length_of_stay", "p90:length_of_stay"],
+#                   group_by=["medical_condition"],
+#                   filters=[("date_of_admission", ">=", "2023-01-01")])
+AGGREGATE_FUNCTIONS = {
+    "count": lambda col: func.count(col) if col is not None else func.count(),
+    "count_distinct": lambda col: func.count(col.distinct()),
+    "sum": func.sum,
+    "avg": func.avg,
+    "min": func.min,
+    "max": func.max,
+    "stddev": func.stddev_samp,
+}
+TIME_BUCKETS = ("day", "week", "month", "quarter", "year")
+FILTER_OPERATORS = {
+    "=": lambda c, v: c == v,
+    "!=": lambda c, v: c != v,
+    ">": lambda c, v: c > v,
+    ">=": lambda c, v: c >= v,
+    "<": lambda c, v: c < v,
+    "<=": lambda c, v: c <= v,
+    "in": lambda c, v: c.in_(list(v)),
+    "between": lambda c, v: c.between(v[0], v[1]),
+    "is_null": lambda c, v: c.is_(None) if v else c.isnot(None),
+}
+
+
+def _column(table, name: str):
+    if name not in table.c:
+        raise ValueError(f"{table.fullname} has no column {name!r}")
+    return table.c[name]
+
+
+def _measure(table, spec: str):
+    # "count", "avg:billing_amount", "p90:length_of_stay" -> labelled expression
+    fn_name, _, col_name = spec.partition(":")
+    col = _column(table, col_name) if col_name else None
+    label = f"{fn_name}_{col_name}" if col_name else fn_name
+    if re.fullmatch(r"p\d{1,2}", fn_name):
+        if col is None:
+            raise ValueError(f"{spec!r} needs a column")
+        q = int(fn_name[1:]) / 100.0
+        return func.percentile_cont(q).within_group(col).cast(sqltypes.Float).label(label)
+    if fn_name not in AGGREGATE_FUNCTIONS:
+        raise ValueError(f"Unknown aggregate {fn_name!r}")
+    if col is None and fn_name != "count":
+        raise ValueError(f"{spec!r} needs a column")
+    expr = AGGREGATE_FUNCTIONS[fn_name](col)
+    if fn_name in ("avg", "stddev"):
+        expr = expr.cast(sqltypes.Float)
+    return expr.label(label)
+
+
+def _filters(table, filters):
+    # dict {col: value | [values]} or list of (col, op, value)
+    if not filters:
+        return []
+    if isinstance(filters, dict):
+        filters = [(k, "in" if isinstance(v, (list, tuple, set)) else "=", v)
+                   for k, v in filters.items()]
+    clauses = []
+    for col_name, op, value in filters:
+        if op not in FILTER_OPERATORS:
+            raise ValueError(f"Unknown filter operator {op!r}")
+        clauses.append(FILTER_OPERATORS[op](_column(table, col_name), value))
+    return clauses
+
+
+def build_aggregate(
+    measures,
+    group_by=None,
+    filters=None,
+    time_bucket: str = None,
+    time_column: str = "date_of_admission",
+    order_by=None,
+    limit: int = 1000,
+    table_name: str = "medical_records",
+    schema: str = "admin_schema",
+):
+    """
+    Compiles an aggregate request into a SQLAlchemy select (see admin_aggregate).
+    """
+    table = get_table(schema, table_name)
+    dims = []
+    if time_bucket:
+        if time_bucket not in TIME_BUCKETS:
+            raise ValueError(f"time_bucket must be one of {TIME_BUCKETS}")
+        dims.append(
+            func.date_trunc(time_bucket, _column(table, time_column))
+            .cast(sqltypes.Date).label(time_bucket)
+        )
+    dims += [_column(table, g) for g in (group_by or [])]
+    metrics = [_measure(table, m) for m in measures]
+
+    stmt = select(*dims, *metrics).select_from(table)
+    for clause in _filters(table, filters):
+        stmt = stmt.where(clause)
+    if dims:
+        stmt = stmt.group_by(*dims)
+
+    by_name = {c.name: c for c in dims + metrics}
+    ordering = []
+    for name in order_by or [d.name for d in dims]:
+        descending = name.startswith("-")
+        expr = by_name.get(name.lstrip("-"))
+        if expr is None:
+            raise ValueError(f"Can only order by a group or measure, not {name!r}")
+        ordering.append(expr.desc() if descending else expr.asc())
+    if ordering:
+        stmt = stmt.order_by(*ordering)
+    if limit:
+        stmt = stmt.limit(limit)
+    return stmt
+
+
+def admin_aggregate(
+    measures,
+    group_by=None,
+    filters=None,
+    time_bucket: str = None,
+    time_column: str = "date_of_admission",
+    order_by=None,
+    limit: int = 1000,
+    table_name: str = "medical_records",
+):
+    """
+    Runs an aggregate over an admin_schema table as admin_user and returns a
+    typed DataFrame (one row per group).
+
+    - measures: "count", "count_distinct:col", "sum:col", "avg:col", "min:col",
+      "max:col", "stddev:col" or percentiles like "p50:col" / "p95:col".
+      Output columns are named e.g. avg_billing_amount.
+    - group_by: column names to group on.
+    - filters: {col: value or [values]} or [(col, op, value), ...] with op in
+      =, !=, >, >=, <, <=, in, between, is_null.
+    - time_bucket: day / week / month / quarter / year over time_column; adds
+      a column named after the bucket.
+    - order_by: group or measure names, "-name" for descending (default: groups).
+    """
+    stmt = build_aggregate(measures, group_by, filters, time_bucket, time_column,
+                           order_by, limit, table_name)
+    key = ("aggregate", table_name, tuple(measures), tuple(group_by or ()),
+           _freeze(filters), time_bucket, time_column, tuple(order_by or ()), limit)
+    return cached_read(
+        "admin_user", "admin_schema", [table_name], key,
+        lambda: fetch_dataframe(stmt, "admin_user", "admin_schema"),
+    )
+
+
+def admin_histogram(value_column: str, bins: int = 20, group_by: str = None,
+                    filters=None, table_name: str = "medical_records"):
+    """
+    Distribution of a numeric column (e.g. length_of_stay) in `bins` equal-width
+    buckets, optionally per group, computed with width_bucket() in the database.
+    Returns columns [group_by,] bucket, lower, upper, count.
+    """
+    table = get_table("admin_schema", table_name)
+    col = _column(table, value_column)
+    where = _filters(table, filters)
+
+    bounds = select(func.min(col).label("lo"), func.max(col).label("hi"))
+    for clause in where:
+        bounds = bounds.where(clause)
+    bounds = bounds.subquery("bounds")
+
+    width = (bounds.c.hi - bounds.c.lo) / float(bins)
+    bucket = func.least(
+        func.width_bucket(col, bounds.c.lo, bounds.c.hi, bins), bins,
+        type_=sqltypes.Integer,
+    ).label("bucket")
+    dims = [_column(table, group_by)] if group_by else []
+    stmt = (
+        select(
+            *dims,
+            bucket,
+            (bounds.c.lo + (bucket - 1) * width).cast(sqltypes.Float).label("lower"),
+            (bounds.c.lo + bucket * width).cast(sqltypes.Float).label("upper"),
+            func.count().label("count"),
+        )
+        .select_from(table.join(bounds, true()))
+        .where(col.isnot(None))
+        .group_by(*dims, bucket, bounds.c.lo, bounds.c.hi)
+        .order_by(*dims, bucket)
+    )
+    for clause in where:
+        stmt = stmt.where(clause)
+    key = ("histogram", table_name, value_column, bins, group_by, _freeze(filters))
+    return cached_read(
+        "admin_user", "admin_schema", [table_name], key,
+        lambda: fetch_dataframe(stmt, "admin_user", "admin_schema"),
+    )
+
+
+# =============================================================================
+# 15. Record details: medical records with names instead of *_id columns
+# =============================================================================
+
+# The patient name is joined in the page query itself (patients is large and
+# in every schema). Doctor, hospital, insurer and medication names come from
+# small reference tables that rarely change; those are held in-process as
+# {id: name} maps and filled in after the page is read. The maps are loaded
+# from admin_schema (the only schema holding all four, and none of them hold
+# patient data), expire after DIMENSION_TTL and are dropped by any write that
+# invalidates the table (see invalidate_table).
+DIMENSION_SCHEMA = "admin_schema"
+DIMENSION_TTL = 600           # seconds
+
+# foreign key column -> (reference table, output column)
+RECORD_DIMENSIONS = {
+    "doctor_id": ("doctors", "doctor_name"),
+    "hospital_id": ("hospitals", "hospital_name"),
+    "provider_id": ("insurance_providers", "insurer_name"),
+    "medication_id": ("medications", "medication_name"),
+}
+
+RECORD_DETAIL_COLUMNS = [
+    "record_id", "patient_id", "date_of_admission", "discharge_date",
+    "medical_condition", "admission_type", "doctor_id", "hospital_id",
+    "provider_id", "medication_id", "room_number", "billing_amount",
+]
+
+
+class DimensionCache:
+    """
+    {id: name} maps of the reference tables, with a TTL.
+    """
+
+    def __init__(self, schema: str = DIMENSION_SCHEMA, ttl: float = DIMENSION_TTL):
+        self.schema = schema
+        self.ttl = ttl
+        self._maps = {}        # table -> (expires_at, {id: name})
+        self._versions = {}    # table -> invalidation count
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "loads": 0, "invalidations": 0}
+
+    def mapping(self, table_name: str):
+        """
+        Returns {primary key: name} for table_name, loading it if needed.
+        """
+        if reference_store.holds(self.schema, table_name):
+            return reference_store.mapping(self.schema, table_name)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._maps.get(table_name)
+            if entry is not None and entry[0] > now:
+                self.stats["hits"] += 1
+                return entry[1]
+            version = self._versions.get(table_name, 0)
+
+        table = get_table(self.schema, table_name)
+        (pk,) = table.primary_key.columns
+        with _shared_load(), role_connection(SCHEMA_ROLES[self.schema], self.schema) as conn:
+            names = dict(conn.execute(select(pk, table.c["name"])).all())
+            conn.commit()
+
+        with self._lock:
+            self.stats["loads"] += 1
+            if version == self._versions.get(table_name, 0):
+                self._maps[table_name] = (time.monotonic() + self.ttl, names)
+        return names
+
+    def invalidate(self, schema: str, table_name: str = None):
+        if schema != self.schema:
+            return
+        with self._lock:
+            targets = [table_name] if table_name else list(self._maps)
+            for t in targets:
+                self._versions[t] = self._versions.get(t, 0) + 1
+                if self._maps.pop(t, None) is not None:
+                    self.stats["invalidations"] += 1
+
+    def clear(self):
+        self.invalidate(self.schema)
+
+
+dimension_cache = DimensionCache()
+
+
+def get_record_details(
+    schema: str,
+    page_size: int = None,
+    sort_column: str = None,
+    direction: str = "asc",
+    cursor: str = None,
+    columns=None,
+):
+    """
+    Returns one page of schema.medical_records (see get_page) with
+    patient_name, doctor_name, hospital_name, insurer_name and
+    medication_name next to the ids. Read as the schema's own role.
+
+    - columns: medical_records columns to load (default RECORD_DETAIL_COLUMNS).
+      Names are added for whichever *_id columns are loaded.
+    """
+    if schema not in ("doctor_schema", "admin_schema"):
+        raise ValueError("Record details are available in doctor_schema and admin_schema.")
+    columns = list(columns or RECORD_DETAIL_COLUMNS)
+    joins = None
+    if "patient_id" in columns:
+        joins = {"patient_id": ("patients", {"name": "patient_name"})}
+    page = get_page(
+        SCHEMA_ROLES[schema], schema, "medical_records",
+        page_size=page_size, sort_column=sort_column, direction=direction,
+        cursor=cursor, columns=columns, joins=joins,
+    )
+
+    lookups = [(fk, out, dimension_cache.mapping(ref))
+               for fk, (ref, out) in RECORD_DIMENSIONS.items() if fk in columns]
+    rows = []
+    for row in page["rows"]:
+        row = dict(row)  # cached page rows are shared
+        for fk, out, names in lookups:
+            row[out] = names.get(row[fk])
+        rows.append(row)
+    return dict(page, rows=rows)
+
+
+@replica_read
+def doctor_get_medical_record_details_page(
+    page_size: int = None,
+    sort_column: str = None,
+    direction: str = "asc",
+    cursor: str = None,
+):
+    """
+    Returns one page of doctor_schema.medical_records with patient, doctor,
+    hospital, insurer and medication names (see get_record_details).
+    """
+    return get_record_details(
+        "doctor_schema", page_size=page_size, sort_column=sort_column,
+        direction=direction, cursor=cursor,
+    )
+
+
+def dimension_cache_stats():
+    """
+    Returns hit / load / invalidation counters of the dimension cache.
+    """
+    return dict(dimension_cache.stats, tables=len(dimension_cache._maps))
+
+
+# =============================================================================
+# 16. Patient search (prefix, full-text, fuzzy, by condition)
+# =============================================================================
+
+# One statement gathers candidates from index-backed branches, each capped at
+# limit * SEARCH_POOL rows so the cost does not grow with the table:
+#
+#   prefix     the name, or the name surname-first,   btree (lower(name) COLLATE "C"),
+#              starts with the query                  btree on _SURNAME_FIRST
+#   words      every query word prefixes a name word  GIN to_tsvector('simple', name)
+#   fuzzy      trigram word similarity (typos)        GIN lower(name) gin_trgm_ops
+#   condition  patients most recently admitted with   btree (medical_condition,
+#              a condition matching the query         date_of_admission DESC)
+#
+# The condition branch first matches the query (stemmed full text or prefix)
+# against the distinct conditions, found with a loose index scan, then walks
+# the index for each match. Candidates are ranked prefix > words > fuzzy >
+# condition, then by text rank / similarity, then by the branch's own order
+# (name, or most recent admission for condition matches). A branch only runs
+# while the ones above it have found fewer than `limit` patients, so the
+# common cases (typing a first name or a surname) never touch the GIN indexes.
+# The statement runs with enable_seqscan off: with LIMIT and the planner's
+# flat guess for prefix text matches, it would otherwise sometimes choose a
+# sequential scan that reads the whole table when nothing matches.
+#
+# The fuzzy branch needs the pg_trgm extension. It is used when the extension
+# is installed (checked once per process) and skipped otherwise. The indexes
+# come from migrations/0002 and 0003 (python index_advisor.py migrate).
+PATIENT_SEARCH_LIMIT = 10
+SEARCH_POOL = 4
+SEARCH_CONDITIONS = 3         # distinct conditions a query may expand to
+
+_SEARCH_WORD = re.compile(r"\w+")
+# "James Smith" -> "smith james", so surname-first typing is an index range
+# scan too. Must match the expression of ix_patients_surname_prefix.
+_SURNAME_FIRST = r"lower(regexp_replace(name, '^(.*\S)\s+(\S+)$', '\2 \1'))"
+_extension_schemas = {}
+
+
+def _extension_schema(conn, name: str):
+    # Schema the extension is installed in (its functions and operators are
+    # qualified with it: role search_paths only hold their own schema).
+    if name not in _extension_schemas:
+        _extension_schemas[name] = conn.execute(
+            text("SELECT extnamespace::regnamespace::text FROM pg_extension "
+                 "WHERE extname = :name"), {"name": name},
+        ).scalar()
+    return _extension_schemas[name]
+
+
+def _search_sql(trgm: str = None, words: bool = True):
+    # Branches in rank order. Each one after the first only runs while the
+    # branches above it have found fewer than :limit patients (an
+    # uncorrelated condition, so the planner skips the scan entirely).
+    branches = [("prefix_hits", """
+        SELECT patient_id, 3 AS tier, 'prefix' AS matched, NULL::text AS condition,
+               row_number() OVER (ORDER BY lower(name) COLLATE "C") AS pos
+        FROM patients
+        WHERE lower(name) COLLATE "C" LIKE :prefix
+        ORDER BY lower(name) COLLATE "C"
+        LIMIT :pool""")]
+    branches.append(("surname_hits", f"""
+        SELECT patient_id, 3, 'prefix', NULL,
+               row_number() OVER (ORDER BY {_SURNAME_FIRST} COLLATE "C")
+        FROM patients
+        WHERE {{gate}} AND {_SURNAME_FIRST} COLLATE "C" LIKE :prefix
+        ORDER BY {_SURNAME_FIRST} COLLATE "C"
+        LIMIT :pool"""))
+    if words:
+        branches.append(("word_hits", """
+        SELECT patient_id, 2, 'words', NULL, row_number() OVER ()
+        FROM patients
+        WHERE {gate} AND to_tsvector('simple', name) @@ to_tsquery('simple', :words)
+        LIMIT :pool"""))
+    if trgm:
+        branches.append(("fuzzy_hits", f"""
+        SELECT patient_id, 1, 'fuzzy', NULL,
+               row_number() OVER (ORDER BY {trgm}.word_similarity(:q, lower(name)) DESC)
+        FROM patients
+        WHERE {{gate}} AND :q OPERATOR({trgm}.<%) lower(name)
+        ORDER BY {trgm}.word_similarity(:q, lower(name)) DESC
+        LIMIT :pool"""))
+    branches.append(("condition_hits", """
+        SELECT r.patient_id, 0, 'condition', mc.c, r.pos
+        FROM matched_conditions mc
+        CROSS JOIN LATERAL (
+            SELECT patient_id,
+                   row_number() OVER (ORDER BY date_of_admission DESC) AS pos
+            FROM medical_records
+            WHERE medical_condition = mc.c
+            ORDER BY date_of_admission DESC
+            LIMIT :pool) r
+        WHERE {gate}"""))
+
+    ctes = []
+    for i, (name, body) in enumerate(branches):
+        above = " UNION ".join(f"SELECT patient_id FROM {n}" for n, _ in branches[:i])
+        gate = f"(SELECT count(*) FROM ({above}) above) < :limit" if i else ""
+        ctes.append(f"{name} AS ({body.format(gate=gate)}\n    )")
+    hits = "\n        UNION ALL ".join(f"SELECT * FROM {n}" for n, _ in branches)
+    rank = "ts_rank(to_tsvector('simple', p.name), to_tsquery('simple', :words))" \
+        if words else "0"
+    similarity = f" + {trgm}.word_similarity(:q, lower(p.name))" if trgm else ""
+    return f"""
+    WITH RECURSIVE conditions(c) AS (
+        (SELECT medical_condition FROM medical_records
+         WHERE medical_condition IS NOT NULL
+         ORDER BY medical_condition LIMIT 1)
+        UNION ALL
+        SELECT (SELECT medical_condition FROM medical_records
+                WHERE medical_condition > conditions.c
+                ORDER BY medical_condition LIMIT 1)
+        FROM conditions WHERE conditions.c IS NOT NULL
+    ),
+    matched_conditions AS (
+        SELECT c FROM conditions
+        WHERE c IS NOT NULL
+          AND (to_tsvector('english', c) @@ plainto_tsquery('english', :q)
+               OR lower(c) LIKE :prefix)
+        LIMIT {SEARCH_CONDITIONS}
+    ),
+    {(","+chr(10)+"    ").join(ctes)},
+    best AS (
+        SELECT DISTINCT ON (patient_id) patient_id, tier, matched, condition, pos
+        FROM ({hits}) hits
+        ORDER BY patient_id, tier DESC, pos
+    )
+    SELECT p.patient_id, p.name, p.age, p.gender, p.blood_type,
+           b.matched, b.condition,
+           (b.tier + {rank}{similarity})::float8 AS score
+    FROM best b
+    JOIN patients p ON p.patient_id = b.patient_id
+    ORDER BY score DESC, b.pos, p.patient_id
+    LIMIT :limit
+    """
+
+
+def search_patients(query: str, limit: int = PATIENT_SEARCH_LIMIT,
+                    schema: str = "doctor_schema"):
+    """
+    Returns up to `limit` patients matching `query`, best first, as dicts:
+    patient_id, name, age, gender, blood_type, matched (prefix / words /
+    fuzzy / condition), condition (for condition matches) and score.
+    Read as the schema's own role, through the read cache.
+    """
+    if schema not in ("doctor_schema", "admin_schema"):
+        raise ValueError("Patient search is available in doctor_schema and admin_schema.")
+    words = [w.lower() for w in _SEARCH_WORD.findall(query or "")]
+    if not words:
+        return []
+    q = " ".join(words)
+    limit = max(1, min(int(limit), 100))
+    # Earlier words are complete; the last one may still be being typed. A
+    # one-letter prefix would expand to most of the index, so it is left to
+    # the name-prefix branch.
+    terms = words[:-1] + ([f"{words[-1]}:*"] if len(words[-1]) >= 2 else [])
+    params = {
+        "q": q,
+        "prefix": q.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%",
+        "words": " & ".join(terms),
+        "pool": limit * SEARCH_POOL,
+        "limit": limit,
+    }
+    role = SCHEMA_ROLES[schema]
+
+    def load():
+        with role_connection(role, schema) as conn:
+            sql = _search_sql(_extension_schema(conn, "pg_trgm"), words=bool(terms))
+            conn.execute(text("SET LOCAL enable_seqscan = off"))
+            rows = [dict(r._mapping) for r in conn.execute(text(sql), params).fetchall()]
+            query_stats.note_materialized(rows)
+            conn.commit()
+        return rows
+
+    return cached_read(role, schema, ["patients", "medical_records"],
+                       ("search", q, limit), load)
+
+
+def doctor_search_patients(query: str, limit: int = PATIENT_SEARCH_LIMIT):
+    """
+    Search-as-you-type over doctor_schema.patients (see search_patients).
+    """
+    return search_patients(query, limit=limit, schema="doctor_schema")
+
+# =============================================================================
+# 17. Prepared statements (server-side, per pooled connection)
+# =============================================================================
+
+# The fixed SQL behind the helpers (the full-table reads, the patient RLS
+# read and the unit-of-work INSERT ... RETURNING) is registered here by name.
+# The first time a pooled connection runs a statement it sends
+# PREPARE name AS ...; after that it only sends EXECUTE name(...), so the
+# server skips parsing and analysis and can reuse its cached plan. Prepared
+# statements live on the physical connection, and each sub-pool's connections
+# have one fixed role and search_path, so a statement is always bound to the
+# tables its (role, schema) sees. A table whose columns changed makes
+# EXECUTE fail with "cached plan must not change result type"; the statement
+# is then re-prepared on that connection the next time it is used.
+#
+# Set PREPARED_STATEMENTS=0 behind a transaction-pooling proxy (pgbouncer
+# pool_mode=transaction), where the next transaction may land on a server
+# connection that never saw the PREPARE.
+PREPARED_STATEMENTS = os.environ.get("PREPARED_STATEMENTS", "1") != "0"
+
+_BIND = re.compile(r"(?<![:\w\\]):(\w+)(?!:)")
+_EXECUTE = re.compile(r"EXECUTE (\w+)(?:\(.*\))?\s*$", re.DOTALL)
+
+
+class StatementRegistry:
+    """
+    Named SQL statements (with :param placeholders), prepared lazily on each
+    pooled connection and executed with EXECUTE.
+    """
+
+    def __init__(self):
+        self._by_name = {}      # name -> (sql, PREPARE text, param names)
+        self._by_sql = {}       # sql -> name
+        self._lock = threading.Lock()
+        self._stats = {}        # (role, schema, name) -> counters
+
+    def register(self, name: str, sql: str):
+        """
+        Registers sql under name (idempotent) and returns the name.
+        """
+        with self._lock:
+            known = self._by_name.get(name)
+            if known is not None:
+                if known[0] != sql:
+                    raise ValueError(f"Statement {name!r} is already registered with other SQL.")
+                return name
+            params = list(dict.fromkeys(_BIND.findall(sql)))
+            body = _BIND.sub(lambda m: f"${params.index(m.group(1)) + 1}", sql)
+            self._by_name[name] = (sql, f"PREPARE {name} AS {body}", params)
+            self._by_sql.setdefault(sql, name)
+        return name
+
+    def name_for(self, sql: str):
+        """
+        Returns the name sql is registered under, or None.
+        """
+        return self._by_sql.get(sql)
+
+    def enabled(self, conn):
+        return PREPARED_STATEMENTS and conn.dialect.name == "postgresql"
+
+    def source(self, statement: str, parameters):
+        """
+        Maps an "EXECUTE name(...)" sent by execute() back to the registered
+        SQL (psycopg2 placeholders) and its parameters by name, so query
+        stats, the index advisor and EXPLAIN see the real statement. Other
+        statements are returned unchanged.
+        """
+        m = _EXECUTE.search(statement) if "EXECUTE" in statement else None
+        known = self._by_name.get(m.group(1)) if m else None
+        if known is None or not isinstance(parameters, dict):
+            return statement, parameters
+        sql, _, names = known
+        values = {k: v for k, v in parameters.items() if not re.fullmatch(r"p\d+", k)}
+        values.update((n, parameters.get(f"p{i}")) for i, n in enumerate(names))
+        sql = _BIND.sub(lambda b: f"%({b.group(1)})s", sql.replace("%", "%%"))
+        return statement[:m.start()] + sql, values
+
+    def execute(self, conn, name: str, role: str, schema: str, params: dict = None,
+                prefix: str = "", prefix_params: dict = None, retry: bool = False):
+        """
+        Runs statement `name` on conn (a role-pool connection for role/schema),
+        preparing it there first if needed, and returns the Result.
+        - prefix: SQL sent in the same round-trip before the EXECUTE (e.g. the
+          patient path's set_config); prefix_params are its parameters.
+        - retry: if the table changed under the prepared plan, roll back and
+          run it again re-prepared. Only for callers whose transaction holds
+          nothing but this statement.
+        """
+        try:
+            return self._execute(conn, name, role, schema, params, prefix, prefix_params)
+        except exc.DBAPIError:
+            if not (retry and name in conn.connection.info.get("stale_statements", ())):
+                raise
+            conn.rollback()
+            return self._execute(conn, name, role, schema, params, prefix, prefix_params)
+
+    def _execute(self, conn, name, role, schema, params, prefix, prefix_params):
+        _, prepare, names = self._by_name[name]
+        info = conn.connection.info
+        prepared = info.setdefault("prepared_statements", set())
+        stale = info.setdefault("stale_statements", set())
+        stats = self._counters(role, schema, name)
+        if name in stale:
+            conn.exec_driver_sql(f"DEALLOCATE {name}", {})
+            stale.discard(name)
+            prepared.discard(name)
+            stats["replans"] += 1
+        if name not in prepared:
+            conn.exec_driver_sql(prepare.replace("%", "%%"), {})
+            prepared.add(name)
+            stats["prepares"] += 1
+        args = ", ".join(f"%(p{i})s" for i in range(len(names)))
+        values = {f"p{i}": (params or {})[n] for i, n in enumerate(names)}
+        values.update(prefix_params or {})
+        stats["executions"] += 1
+        try:
+            return conn.exec_driver_sql(
+                f"{prefix}EXECUTE {name}" + (f"({args})" if names else ""), values
+            )
+        except exc.DBAPIError as e:
+            if getattr(e.orig, "pgcode", None) == "0A000":  # cached plan changed
+                stale.add(name)
+            raise
+
+    def _counters(self, role, schema, name):
+        key = (role, schema, name)
+        stats = self._stats.get(key)
+        if stats is None:
+            with self._lock:
+                stats = self._stats.setdefault(
+                    key, {"executions": 0, "prepares": 0, "replans": 0})
+        return stats
+
+    def stats(self):
+        """
+        Returns one dict per (role, schema, statement): executions, prepares,
+        replans and hit_rate (executions that reused a prepared plan).
+        """
+        out = []
+        for (role, schema, name), s in sorted(self._stats.items()):
+            hits = s["executions"] - s["prepares"]
+            out.append(dict(
+                s, role=role, schema=schema, name=name, hits=hits,
+                hit_rate=hits / s["executions"] if s["executions"] else None,
+            ))
+        return out
+
+
+statements = StatementRegistry()
+
+for _name, _sql in (
+    ("patients_all", "SELECT * FROM patients"),
+    ("medical_records_all", "SELECT * FROM medical_records"),
+    ("doctors_all", "SELECT * FROM doctors"),
+    ("hospitals_all", "SELECT * FROM hospitals"),
+):
+    statements.register(_name, _sql)
+
+
+def _insert_statement(table, columns):
+    # INSERT ... RETURNING pk for one table and column set, registered once.
+    pk = [c.name for c in table.primary_key.columns]
+    name = "ins_{}_{}".format(
+        table.name, hashlib.md5(",".join(columns).encode()).hexdigest()[:8])
+    return statements.register(name, 'INSERT INTO "{}" ({}) VALUES ({}) RETURNING {}'.format(
+        table.name,
+        ", ".join(f'"{c}"' for c in columns),
+        ", ".join(f":{c}" for c in columns),
+        ", ".join(f'"{c}"' for c in pk),
+    ))
+
+
+def prepared_statement_stats():
+    """
+    Returns per-statement prepare / execute counters and hit rates.
+    """
+    return statements.stats()
+
+# =============================================================================
+# 18. Multi-process deployments: shared reference data, connection budget
+# =============================================================================
+
+# When several Streamlit processes serve the app (serve.py), each would hold
+# its own copy of the reference tables and its own pools. Two things keep
+# that in check:
+#
+# Shared reference store. With REFERENCE_DIR set (ideally on tmpfs, e.g.
+# /dev/shm/healthcare-ref), the REFERENCE_TABLES are snapshotted into Arrow
+# IPC files there, listed in manifest.json. Every process memory-maps the
+# current files read-only, so the data sits once in the page cache and is
+# read without copying or querying. A snapshot is rebuilt by the first
+# process that finds it missing, older than REFERENCE_MAX_AGE, or
+# invalidated. A write through the db helpers invalidates it for all
+# processes: invalidate_table() drops its manifest entry, and every process
+# checks the manifest (one stat) on each read. Builds are serialised with a
+# file lock, so N workers starting together read the table once.
+#
+# Connection budget. DB_MAX_CONNECTIONS is what the whole deployment may use
+# (keep it below Postgres max_connections minus superuser_reserved_connections
+# and whatever else connects); WEB_CONCURRENCY is the number of processes.
+# Each process gets DB_MAX_CONNECTIONS // WEB_CONCURRENCY. The shared engine
+# keeps ENGINE_POOL_RESERVE of them, the change feed (section 19) one more,
+# and the rest is split evenly across the role sub-pools (db_async's pools
+# count too), as pool_size + max_overflow.
+# Pools never open more than that, so N processes cannot exceed the total.
+REFERENCE_DIR = os.environ.get("REFERENCE_DIR")
+REFERENCE_MAX_AGE = float(os.environ.get("REFERENCE_MAX_AGE", "600"))
+REFERENCE_TABLES = {
+    "admin_schema": ("hospitals", "doctors", "medications", "insurance_providers"),
+}
+
+DB_MAX_CONNECTIONS = int(os.environ.get("DB_MAX_CONNECTIONS", "0"))   # 0 = no budget
+APP_PROCESSES = int(os.environ.get("WEB_CONCURRENCY", "1"))
+ENGINE_POOL_RESERVE = 2
+CHANGE_FEED = os.environ.get("CHANGE_FEED", "1") != "0"
+
+try:
+    import fcntl
+except ImportError:  # not on Windows; builds are then merely unserialised
+    fcntl = None
+
+
+class SharedReferenceStore:
+    """
+    Memory-mapped Arrow snapshots of the reference tables, shared by every
+    process using the same directory.
+    """
+
+    MANIFEST = "manifest.json"
+
+    def __init__(self, directory: str = None, max_age: float = REFERENCE_MAX_AGE):
+        self.directory = directory
+        self.max_age = max_age
+        self._manifest = {}
+        self._manifest_stamp = None
+        self._mapped = {}      # "schema.table" -> (file, pyarrow.Table)
+        self._maps = {}        # ("schema.table", column) -> (file, {pk: value})
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "maps": 0, "builds": 0, "invalidations": 0}
+
+    @property
+    def enabled(self):
+        return bool(self.directory)
+
+    def holds(self, schema: str, table_name: str):
+        return self.enabled and table_name in REFERENCE_TABLES.get(schema, ())
+
+    def table(self, schema: str, table_name: str):
+        """
+        Returns schema.table_name as a memory-mapped pyarrow Table (primary
+        key order), building the snapshot first if needed.
+        """
+        key = f"{schema}.{table_name}"
+        rebuild = False
+        for _ in range(2):
+            entry = self._entry(key)
+            if rebuild or entry is None or time.time() - entry["built_at"] > self.max_age:
+                entry = self._build(schema, table_name, force=rebuild)
+            with self._lock:
+                mapped = self._mapped.get(key)
+                if mapped is not None and mapped[0] == entry["file"]:
+                    self.stats["hits"] += 1
+                    return mapped[1]
+            try:
+                table = self._map(entry["file"])
+            except FileNotFoundError:
+                rebuild = True  # replaced (or cleaned up) since the manifest was read
+                continue
+            with self._lock:
+                self._mapped[key] = (entry["file"], table)
+                self.stats["maps"] += 1
+            return table
+        raise FileNotFoundError(f"Reference snapshot for {key} keeps disappearing.")
+
+    def mapping(self, schema: str, table_name: str, column: str = "name"):
+        """
+        Returns {primary key: column} for a reference table (built once per
+        snapshot per process).
+        """
+        table = self.table(schema, table_name)
+        key = f"{schema}.{table_name}"
+        with self._lock:
+            file = self._mapped[key][0]
+            cached = self._maps.get((key, column))
+            if cached is not None and cached[0] == file:
+                return cached[1]
+        (pk,) = get_table(schema, table_name).primary_key.columns
+        values = dict(zip(table.column(pk.name).to_pylist(), table.column(column).to_pylist()))
+        with self._lock:
+            self._maps[(key, column)] = (file, values)
+        return values
+
+    def rows(self, schema: str, table_name: str):
+        """
+        Returns a reference table as a list of dicts.
+        """
+        return self.table(schema, table_name).to_pylist()
+
+    def frame(self, schema: str, table_name: str):
+        """
+        Returns a reference table as a pandas DataFrame (db.pandas_dtype types).
+        """
+        import pandas as pd
+
+        table = get_table(schema, table_name)
+        arrow = self.table(schema, table_name)
+        return pd.DataFrame({
+            c.name: _column_array(arrow.column(c.name).to_pylist(), c.type) for c in table.c
+        }, columns=[c.name for c in table.c])
+
+    def invalidate(self, schema: str, table_name: str = None):
+        """
+        Drops the snapshots of schema.table_name (or of every reference table
+        in schema), for all processes sharing the directory.
+        """
+        if not self.enabled:
+            return
+        names = [table_name] if table_name else list(REFERENCE_TABLES.get(schema, ()))
+        keys = [f"{schema}.{n}" for n in names if self.holds(schema, n)]
+        if not keys:
+            return
+        with self._file_lock():
+            manifest = self._read_manifest()
+            dropped = [k for k in keys if manifest.pop(k, None) is not None]
+            if dropped:
+                self._write_manifest(manifest)
+        with self._lock:
+            self.stats["invalidations"] += len(dropped)
+
+    def warm(self):
+        """
+        Builds every missing or stale snapshot (serve.py runs this once
+        before starting the workers). Returns the manifest.
+        """
+        for schema, names in REFERENCE_TABLES.items():
+            for name in names:
+                self.table(schema, name)
+        return dict(self._read_manifest())
+
+    def _path(self, name: str):
+        return os.path.join(self.directory, name)
+
+    def _read_manifest(self):
+        try:
+            with open(self._path(self.MANIFEST), encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _write_manifest(self, manifest: dict):
+        tmp = self._path(f"{self.MANIFEST}.{os.getpid()}.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+        os.replace(tmp, self._path(self.MANIFEST))
+
+    def _entry(self, key: str):
+        # Re-reads the manifest only when it changed on disk.
+        try:
+            st = os.stat(self._path(self.MANIFEST))
+            stamp = (st.st_mtime_ns, st.st_size, st.st_ino)
+        except FileNotFoundError:
+            stamp = None
+        with self._lock:
+            if stamp != self._manifest_stamp:
+                self._manifest = self._read_manifest() if stamp else {}
+                self._manifest_stamp = stamp
+            return self._manifest.get(key)
+
+    @contextmanager
+    def _file_lock(self):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self._path(".lock"), "a") as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _build(self, schema: str, table_name: str, force: bool = False):
+        import pyarrow as pa
+
+        key = f"{schema}.{table_name}"
+        with self._file_lock(), _shared_load():
+            manifest = self._read_manifest()
+            entry = manifest.get(key)
+            if not force and entry is not None and time.time() - entry["built_at"] <= self.max_age:
+                return entry  # another process built it while we waited
+            table = get_table(schema, table_name)
+            schema_ = arrow_schema(table)
+            name = f"{key}.{time.time_ns()}.arrow"
+            tmp = self._path(f".{name}.tmp")
+            rows = 0
+            with pa.OSFile(tmp, "wb") as sink:
+                with pa.ipc.new_file(sink, schema_) as writer:
+                    for batch in stream_query_batches(
+                        _table_select(schema, table_name), SCHEMA_ROLES[schema], schema,
+                        as_dicts=False,
+                    ):
+                        writer.write_batch(arrow_batch(schema_, batch))
+                        rows += len(batch)
+            os.replace(tmp, self._path(name))
+            entry = manifest[key] = {"file": name, "built_at": time.time(), "rows": rows}
+            self._write_manifest(manifest)
+            for old in os.listdir(self.directory):
+                # Processes that still map an old file keep reading it safely.
+                if old.startswith(key + ".") and old.endswith(".arrow") and old != name:
+                    os.remove(self._path(old))
+        with self._lock:
+            self.stats["builds"] += 1
+        return entry
+
+    def _map(self, name: str):
+        import pyarrow as pa
+
+        # read_all() on a memory map references the mapped pages, no copy.
+        return pa.ipc.open_file(pa.memory_map(self._path(name), "r")).read_all()
+
+
+reference_store = SharedReferenceStore(REFERENCE_DIR)
+
+
+def reference_store_stats():
+    """
+    Returns the shared reference store's counters and manifest.
+    """
+    if not reference_store.enabled:
+        return {"enabled": False}
+    return dict(reference_store.stats, enabled=True, directory=reference_store.directory,
+                manifest=reference_store._read_manifest())
+
+
+_budgeted_pools = []   # [(pool, number of (role, schema) sub-pools it may open)]
+
+
+def connection_budget(total: int = None, processes: int = None):
+    """
+    Splits `total` connections (default DB_MAX_CONNECTIONS) across
+    `processes` worker processes (default WEB_CONCURRENCY) and, inside one
+    process, between the shared engine and every role sub-pool.
+    Returns total, processes, per_process, engine, change_feed, sub_pools,
+    pool_size and max_overflow (per sub-pool).
+    """
+    total = DB_MAX_CONNECTIONS if total is None else total
+    processes = max(1, APP_PROCESSES if processes is None else processes)
+    per_process = total // processes
+    sub_pools = sum(n for _, n in _budgeted_pools)
+    reserve = ENGINE_POOL_RESERVE + int(CHANGE_FEED)
+    per_sub_pool = (per_process - reserve) // max(1, sub_pools)
+    if per_sub_pool < 1:
+        raise ValueError(
+            f"{total} connections for {processes} processes leaves {per_process} per "
+            f"process: not enough for the engine and change feed ({reserve}) plus one "
+            f"per role sub-pool ({sub_pools}). Raise DB_MAX_CONNECTIONS or run fewer workers."
+        )
+    pool_size = min(POOL_SIZE, per_sub_pool)
+    return {
+        "total": total,
+        "processes": processes,
+        "per_process": per_process,
+        "engine": ENGINE_POOL_RESERVE,
+        "change_feed": int(CHANGE_FEED),
+        "sub_pools": sub_pools,
+        "pool_size": pool_size,
+        "max_overflow": per_sub_pool - pool_size,
+    }
+
+
+def apply_connection_budget(total: int = None, processes: int = None):
+    """
+    Resizes the shared engine and every registered role pool to fit
+    connection_budget(total, processes). Returns the budget.
+    """
+    global engine
+    budget = connection_budget(total, processes)
+    engine.dispose()
+    engine = create_engine(DATABASE_URL, echo=False, pool_size=1,
+                           max_overflow=ENGINE_POOL_RESERVE - 1, pool_pre_ping=True)
+    SessionLocal.configure(bind=engine)
+    for pool, _ in _budgeted_pools:
+        pool.configure(pool_size=budget["pool_size"], max_overflow=budget["max_overflow"])
+    return budget
+
+
+def register_budgeted_pool(pool, sub_pools: int):
+    """
+    Puts another role pool (e.g. db_async.role_pool) under the connection
+    budget; pool needs a configure(pool_size=, max_overflow=) method.
+    """
+    _budgeted_pools.append((pool, sub_pools))
+    if DB_MAX_CONNECTIONS:
+        apply_connection_budget()
+
+
+def check_connection_budget(total: int = None):
+    """
+    Compares the deployment's budget with the server: returns max_connections,
+    reserved (superuser_reserved_connections), in_use and whether the
+    budget fits in what is left.
+    """
+    total = DB_MAX_CONNECTIONS if total is None else total
+    with engine.connect() as conn:
+        max_conn = int(conn.execute(text("SHOW max_connections")).scalar())
+        reserved = int(conn.execute(text("SHOW superuser_reserved_connections")).scalar())
+        in_use = conn.execute(text("SELECT count(*) FROM pg_stat_activity")).scalar()
+    return {
+        "budget": total,
+        "max_connections": max_conn,
+        "reserved": reserved,
+        "in_use": in_use,
+        "fits": total <= max_conn - reserved,
+    }
+
+
+register_budgeted_pool(role_pool, len(SCHEMA_ROLES))
+
+# =============================================================================
+# 19. Change feed: cached reads kept current over LISTEN/NOTIFY
+# =============================================================================
+
+# Migration 0004 puts statement-level triggers on patients, medical_records,
+# doctors and hospitals that publish every committed change on the
+# CHANGE_FEED_CHANNEL (see the migration for the event format). One
+# background thread per process LISTENs on a dedicated connection and applies
+# each event to the read cache (ReadCache.apply_change): whole-table reads
+# get the changed rows merged in, so a dashboard refresh after a write costs
+# one row over the wire, not a full reload. Events carry primary keys only
+# (anyone can LISTEN, so row contents would bypass RLS); the rows are read
+# by key through the schema role's pool, one query per event, and patient
+# rows (RLS) are reloaded instead. Count-only events, and any gap in the
+# feed (lost connection), fall back to invalidation.
+#
+# Read-your-writes: unit_of_work sends a sync token on the channel inside its
+# transaction. NOTIFYs are delivered in commit order, so once the listener
+# sees the token it has applied the transaction's own changes; the writer
+# waits for that (CHANGE_FEED_SYNC_TIMEOUT at most) instead of invalidating.
+# If the feed is not running, or doesn't cover a touched table, or the token
+# is late, the writer invalidates as before. Writes by other processes (and
+# by hand, in psql) reach this process's cache through the feed too. The
+# shared reference snapshots (section 18) are still invalidated by the
+# writer, so N listeners don't all drop the same snapshot.
+#
+# Set CHANGE_FEED=0 (section 18) to disable it, e.g. behind pgbouncer in
+# transaction mode, where LISTEN doesn't work. It needs psycopg2.
+CHANGE_FEED_CHANNEL = "healthcare_changes"
+CHANGE_FEED_FUNCTION = "public.healthcare_notify_change"
+CHANGE_FEED_SYNC_TIMEOUT = 1.0   # seconds
+CHANGE_FEED_RETRY = 60           # seconds between attempts to (re)start it
+
+feed_log = logging.getLogger("healthcare.db.change_feed")
+
+try:
+    import select as _select
+except ImportError:  # pragma: no cover
+    _select = None
+
+
+class ChangeFeed:
+    """
+    A LISTEN connection and thread that applies change events to read_cache.
+    """
+
+    def __init__(self, channel: str = CHANGE_FEED_CHANNEL):
+        self.channel = channel
+        self.covered = frozenset()      # (schema, table) pairs with triggers
+        self.reason = None              # why it isn't running
+        self._thread = None
+        self._stop = threading.Event()
+        self._conn = None
+        self._checked_at = None
+        self._tokens = {}               # sync token -> threading.Event
+        self._token_count = 0
+        self._lock = threading.Lock()
+        self.stats = {"events": 0, "rows": 0, "patched": 0, "fetches": 0,
+                      "reloads": 0, "syncs": 0, "sync_timeouts": 0, "reconnects": 0}
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """
+        Starts the listener unless it runs already, CHANGE_FEED=0, or the
+        migration isn't applied (checked again after CHANGE_FEED_RETRY
+        seconds). Returns whether it is running.
+        """
+        with self._lock:
+            if self.running:
+                return True
+            now = time.monotonic()
+            if self._checked_at is not None and now - self._checked_at < CHANGE_FEED_RETRY:
+                return False
+            self._checked_at = now
+            if not CHANGE_FEED:
+                self.reason = "disabled (CHANGE_FEED=0)"
+                return False
+            if engine.dialect.driver != "psycopg2" or _select is None:
+                self.reason = f"needs psycopg2, not {engine.dialect.driver}"
+                return False
+            try:
+                self.covered = self._covered_tables()
+                if not self.covered:
+                    self.reason = "no change triggers (apply migration 0004)"
+                    return False
+                self._conn = self._listen()
+            except exc.DBAPIError as e:
+                self.reason = f"{type(e.orig).__name__}: {e.orig}"
+                return False
+            self.reason = None
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="change-feed", daemon=True)
+            self._thread.start()
+            return True
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+        self._thread = None
+        self._close()
+
+    def covers(self, schema: str, table_names):
+        return bool(table_names) and all((schema, t) in self.covered for t in table_names)
+
+    def sync_token(self, conn):
+        """
+        Sends a sync token on conn, inside its (not yet committed)
+        transaction. Returns the token for wait().
+        """
+        with self._lock:
+            self._token_count += 1
+            token = f"{os.getpid()}:{self._token_count}"
+            self._tokens[token] = threading.Event()
+        conn.execute(text("SELECT pg_notify(:channel, :payload)"),
+                     {"channel": self.channel, "payload": json.dumps({"sync": token})})
+        return token
+
+    def wait(self, token: str, timeout: float = CHANGE_FEED_SYNC_TIMEOUT):
+        """
+        Waits until the listener has applied everything committed up to the
+        token. Returns False on timeout (or if the token was never sent).
+        """
+        event = self._tokens.get(token)
+        ok = event is not None and self.running and event.wait(timeout)
+        with self._lock:
+            self._tokens.pop(token, None)
+            self.stats["syncs" if ok else "sync_timeouts"] += 1
+        return ok
+
+    def forget(self, token: str):
+        # The transaction was rolled back: its token will never arrive.
+        with self._lock:
+            self._tokens.pop(token, None)
+
+    def _covered_tables(self):
+        with engine.connect() as conn:
+            rows = conn.execute(text(
+                "SELECT DISTINCT n.nspname, c.relname FROM pg_trigger t"
+                " JOIN pg_class c ON c.oid = t.tgrelid"
+                " JOIN pg_namespace n ON n.oid = c.relnamespace"
+                " WHERE t.tgfoid = to_regproc(:fn)"), {"fn": CHANGE_FEED_FUNCTION}).fetchall()
+        return frozenset((s, t) for s, t in rows if t in SCHEMA_TABLES.get(s, ()))
+
+    def _listen(self):
+        # Not from the pool: the connection stays checked out for good.
+        cargs, cparams = engine.dialect.create_connect_args(engine.url)
+        conn = engine.dialect.connect(*cargs, **cparams)
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            cur.execute(f'LISTEN "{self.channel}"')
+        return conn
+
+    def _close(self):
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except Exception:
+                pass
+            self._conn = None
+
+    def _run(self):
+        backoff = 1
+        while not self._stop.is_set():
+            try:
+                if self._conn is None:
+                    self._conn = self._listen()
+                    self.stats["reconnects"] += 1
+                    for schema, table_name in self.covered:  # events may be lost
+                        self._reload(schema, table_name)
+                    backoff = 1
+                if _select.select([self._conn], [], [], 1.0) == ([], [], []):
+                    continue
+                self._conn.poll()
+                while self._conn.notifies:
+                    self._handle(self._conn.notifies.pop(0).payload)
+            except Exception:
+                feed_log.exception("change feed: listener failed, reconnecting")
+                self._close()
+                self._stop.wait(backoff)
+                backoff = min(backoff * 2, 30)
+        self._close()
+
+    def _handle(self, payload: str):
+        event = json.loads(payload)
+        token = event.get("sync")
+        if token is not None:
+            with self._lock:
+                waiting = self._tokens.get(token)
+            if waiting is not None:
+                waiting.set()
+            return
+        schema, table_name, op = event["s"], event["t"], event["op"]
+        if table_name not in SCHEMA_TABLES.get(schema, ()):
+            return
+        self.stats["events"] += 1
+        self.stats["rows"] += event.get("n", 0)
+        table = get_table(schema, table_name)
+        (pk,) = [c.name for c in table.primary_key.columns]
+        types = {c.name: c.type for c in table.c}
+        rows, ids = None, event.get("ids")
+        if op != "D" and ids is not None and read_cache.patchable(schema, table_name):
+            rows = self._fetch(schema, table_name, ids)
+        if rows is None and (op != "D" or ids is None):
+            self._reload(schema, table_name)
+            return
+        self.stats["patched"] += read_cache.apply_change(
+            schema, table_name, op, pk, rows=rows, ids=ids, column_types=types)
+        dimension_cache.invalidate(schema, table_name)
+
+    def _fetch(self, schema: str, table_name: str, ids):
+        # The full rows for an event that only carried their keys. Patient
+        # rows are behind RLS, so those are reloaded instead.
+        if schema == "patient_schema":
+            return None
+        table = get_table(schema, table_name)
+        (pk,) = table.primary_key.columns
+        with role_connection(SCHEMA_ROLES[schema], schema) as conn:
+            rows = [dict(r._mapping) for r in
+                    conn.execute(select(table).where(pk.in_(ids)).order_by(pk)).fetchall()]
+            conn.rollback()
+        self.stats["fetches"] += 1
+        return rows
+
+    def _reload(self, schema: str, table_name: str):
+        read_cache.invalidate(schema, table_name)
+        dimension_cache.invalidate(schema, table_name)
+        self.stats["reloads"] += 1
+
+
+change_feed = ChangeFeed()
+atexit.register(change_feed.stop)
+
+
+def start_change_feed():
+    """
+    Starts the change-feed listener (idempotent; cheap to call on every
+    Streamlit rerun). Returns whether it is running.
+    """
+    return change_feed.start()
+
+
+def change_feed_stats():
+    """
+    Returns the change feed's counters, whether it runs, and why not.
+    """
+    return dict(change_feed.stats, running=change_feed.running, reason=change_feed.reason,
+                covered=sorted(f"{s}.{t}" for s, t in change_feed.covered))
+
+# =============================================================================
+# 20. Read replicas: routing, health checks, read-your-writes
+# =============================================================================
+
+# With DATABASE_REPLICA_URLS set, the read-only *_get_* helpers
+# (@replica_read) check out their connections from a replica's role pool;
+# writes and every other read stay on the primary. A thread probes each
+# replica every REPLICA_CHECK_INTERVAL seconds for how far it has replayed
+# the primary's WAL. A read goes to the least busy replica that passed its
+# last probe and is at most REPLICA_MAX_LAG seconds behind, else to the
+# primary; a replica whose checkout fails is skipped until it probes healthy.
+#
+# Read-your-writes: each commit through unit_of_work or bulk_load records the
+# primary's WAL position, for the sessions that made it (bind_session) and as
+# this process's high-water mark. A session's reads go to a replica only once
+# it has replayed the session's last write; loads into the shared caches
+# (read cache, dimension maps, reference snapshots) wait for the high-water
+# mark, since every session reads them. When the last probe is older than
+# the write, the position is re-read on the replica connection itself, so a
+# read waits out the replica's actual lag, not the probe interval. Replicas
+# that aren't physical standbys (e.g. logical replication) have no position
+# to compare: they are treated as REPLICA_MAX_LAG behind every write.
+#
+# db_async.py, streaming exports and the change feed always use the primary.
+REPLICA_MAX_LAG = float(os.environ.get("REPLICA_MAX_LAG", "5"))                  # seconds
+REPLICA_CHECK_INTERVAL = float(os.environ.get("REPLICA_CHECK_INTERVAL", "2"))    # seconds
+READ_YOUR_WRITES_TTL = 300     # seconds a session's last write position is kept
+READ_YOUR_WRITES_MAX = 10000   # sessions remembered
+
+replica_log = logging.getLogger("healthcare.db.replicas")
+
+# WAL positions are compared as byte offsets (pg_wal_lsn_diff from 0/0).
+_WRITE_POSITION_SQL = "SELECT pg_wal_lsn_diff(pg_current_wal_insert_lsn(), '0/0')"
+_REPLAY_POSITION_SQL = "SELECT pg_wal_lsn_diff(pg_last_wal_replay_lsn(), '0/0')"
+_REPLICA_PROBE_SQL = """
+SELECT pg_is_in_recovery(),
+       pg_wal_lsn_diff(pg_last_wal_replay_lsn(), '0/0'),
+       extract(epoch FROM now() - pg_last_xact_replay_timestamp())
+"""
+
+
+class Replica:
+    """
+    One read replica: its role pool and its health as of the last probe.
+    """
+
+    def __init__(self, url: str):
+        self.url = url
+        self.name = sqlalchemy.engine.make_url(url).render_as_string(hide_password=True)
+        sizes = {}
+        if DB_MAX_CONNECTIONS:
+            # Replicas are assumed to be sized like the primary.
+            budget = connection_budget()
+            sizes = {"pool_size": budget["pool_size"], "max_overflow": budget["max_overflow"]}
+        self.pool = RolePool(url, **sizes)
+        self.healthy = False
+        self.standby = None       # pg_is_in_recovery()
+        self.position = None      # WAL replayed, in bytes (standbys only)
+        self.lag_seconds = None
+        self.lag_bytes = None
+        self.checked_at = None
+        self.error = None
+        self.in_use = 0
+        self.stats = {"reads": 0, "probes": 0, "failures": 0, "rechecks": 0}
+        self._probe_engine = None
+
+    def probe(self, primary_position):
+        """
+        Reads the replica's state; primary_position: the primary's WAL
+        position just before (None if unknown).
+        """
+        if self._probe_engine is None:
+            self._probe_engine = create_engine(self.url, pool_size=1, max_overflow=0,
+                                               pool_pre_ping=True)
+        self.stats["probes"] += 1
+        try:
+            with self._probe_engine.connect() as conn:
+                standby, position, replay_age = conn.execute(text(_REPLICA_PROBE_SQL)).one()
+        except exc.DBAPIError as e:
+            self.fail(e)
+            return
+        self.standby = bool(standby)
+        if self.standby and position is not None:
+            self.position = int(position)
+            behind = None if primary_position is None else max(0, primary_position - self.position)
+            self.lag_bytes = behind
+            # Caught up with the primary: no lag, however long ago the last
+            # transaction was replayed.
+            self.lag_seconds = 0.0 if behind == 0 else \
+                float(replay_age) if replay_age is not None else float("inf")
+        else:
+            self.position = self.lag_bytes = self.lag_seconds = None
+        self.healthy = True
+        self.error = None
+        self.checked_at = time.time()
+
+    def fail(self, error):
+        self.healthy = False
+        self.error = str(getattr(error, "orig", None) or error).strip()
+        self.stats["failures"] += 1
+
+    def snapshot(self):
+        return {
+            "replica": self.name,
+            "healthy": self.healthy,
+            "standby": self.standby,
+            "lag_seconds": self.lag_seconds,
+            "lag_bytes": self.lag_bytes,
+            "checked_at": self.checked_at,
+            "error": self.error,
+            "in_use": self.in_use,
+            **self.stats,
+            "pools": self.pool.metrics(),
+        }
+
+    def dispose(self):
+        self.pool.dispose()
+        if self._probe_engine is not None:
+            self._probe_engine.dispose()
+
+
+class ReplicaRouter:
+    """
+    Picks a replica (or the primary) for each replica_read checkout.
+    """
+
+    def __init__(self, urls, max_lag: float = REPLICA_MAX_LAG,
+                 interval: float = REPLICA_CHECK_INTERVAL):
+        self.replicas = [Replica(u) for u in urls]
+        self.max_lag = max_lag
+        self.interval = interval
+        self._sessions = OrderedDict()   # session -> (position, written_at)
+        self._written = None             # this process's last (position, written_at)
+        self._thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self.stats = {"replica_reads": 0, "primary_reads": 0, "no_replica": 0,
+                      "behind": 0, "errors": 0, "writes": 0}
+
+    @property
+    def enabled(self):
+        return bool(self.replicas)
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """
+        Probes the replicas once and starts the health-check thread
+        (idempotent).
+        """
+        if not self.enabled or self.running:
+            return
+        with self._start_lock:
+            if self.running:
+                return
+            self.check()
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="replica-checks", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+        self._thread = None
+
+    def dispose(self):
+        self.stop()
+        for replica in self.replicas:
+            replica.dispose()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.check()
+            except Exception:
+                replica_log.exception("replicas: health check failed")
+
+    def check(self):
+        """
+        Probes every replica and forgets the session positions they have
+        all replayed.
+        """
+        try:
+            with engine.connect() as conn:
+                primary_position = int(conn.execute(text(_WRITE_POSITION_SQL)).scalar())
+        except exc.DBAPIError:
+            primary_position = None
+        for replica in self.replicas:
+            replica.probe(primary_position)
+        now = time.monotonic()
+        with self._lock:
+            for session, token in list(self._sessions.items()):
+                if now - token[1] > READ_YOUR_WRITES_TTL or all(
+                        self._caught_up(r, token, now) for r in self.replicas):
+                    del self._sessions[session]
+
+    # --- read-your-writes --------------------------------------------------
+
+    def note_commit(self, conn, sessions=()):
+        """
+        Records the primary's WAL position after a commit on conn, for
+        `sessions` and the process. Never raises: the write has committed.
+        """
+        if not self.enabled:
+            return
+        try:
+            position = int(conn.execute(text(_WRITE_POSITION_SQL)).scalar())
+            conn.rollback()
+        except exc.DBAPIError:
+            position = None  # falls back to REPLICA_MAX_LAG
+        now = time.monotonic()
+        with self._lock:
+            self.stats["writes"] += 1
+            if self._written is not None and position is not None \
+                    and self._written[0] is not None:
+                position = max(position, self._written[0])
+            self._written = (position, now)
+            for session in sessions:
+                self._sessions[session] = (position, now)
+                self._sessions.move_to_end(session)
+            while len(self._sessions) > READ_YOUR_WRITES_MAX:
+                self._sessions.popitem(last=False)
+
+    def _token(self):
+        # The write the current read has to see, if any.
+        if getattr(_routing, "shared", False):
+            return self._written
+        session = getattr(_routing, "session", None)
+        return self._sessions.get(session) if session is not None else None
+
+    def _caught_up(self, replica, token, now):
+        position, written_at = token
+        if replica.standby and position is not None:
+            return replica.position is not None and replica.position >= position
+        return now - written_at >= self.max_lag
+
+    # --- routing -----------------------------------------------------------
+
+    def _candidates(self):
+        usable = [
+            r for r in self.replicas
+            if r.healthy and (r.lag_seconds is None or r.lag_seconds <= self.max_lag)
+        ]
+        return sorted(usable, key=lambda r: (r.in_use, r.lag_seconds or 0.0))
+
+    def _checkout(self, replica, role: str, schema: str, settings, token):
+        # An ExitStack holding a replica connection, or None if the replica
+        # hasn't replayed `token` yet.
+        stack = ExitStack()
+        conn = stack.enter_context(replica.pool.connection(role, schema, settings))
+        if token is None or self._caught_up(replica, token, time.monotonic()):
+            return stack, conn
+        if replica.standby and token[0] is not None:
+            replica.stats["rechecks"] += 1
+            try:
+                replica.position = int(conn.execute(text(_REPLAY_POSITION_SQL)).scalar())
+            finally:
+                conn.rollback()
+            if replica.position >= token[0]:
+                return stack, conn
+        stack.close()
+        return None, None
+
+    @contextmanager
+    def connection(self, role: str, schema: str, settings: dict = None):
+        """
+        role_pool.connection(...) on a replica that is healthy, within
+        REPLICA_MAX_LAG and has replayed the writes this read must see;
+        on the primary otherwise.
+        """
+        self.start()
+        token = self._token()
+        chosen, stack, conn = None, None, None
+        candidates = self._candidates()
+        for replica in candidates:
+            try:
+                stack, conn = self._checkout(replica, role, schema, settings, token)
+            except (exc.DBAPIError, exc.TimeoutError) as e:
+                replica.fail(e)
+                self.stats["errors"] += 1
+                continue
+            if stack is not None:
+                chosen = replica
+                break
+            self.stats["behind"] += 1
+        if chosen is None:
+            if not candidates:
+                self.stats["no_replica"] += 1
+            self.stats["primary_reads"] += 1
+            with role_pool.connection(role, schema, settings) as conn:
+                yield conn
+            return
+        self.stats["replica_reads"] += 1
+        chosen.stats["reads"] += 1
+        with self._lock:
+            chosen.in_use += 1
+        try:
+            with stack:
+                yield conn
+        except exc.OperationalError as e:
+            chosen.fail(e)  # connection lost mid-read: skip it until it probes healthy
+            raise
+        finally:
+            with self._lock:
+                chosen.in_use -= 1
+
+
+replicas = ReplicaRouter(REPLICA_URLS)
+atexit.register(replicas.stop)
+
+
+def bind_session(session_id):
+    """
+    Ties the current thread's reads and writes to session_id (e.g. a
+    Streamlit session), for read-your-writes. Call it at the start of each
+    request / rerun; None unbinds.
+    """
+    _routing.session = session_id
+
+
+def replica_stats():
+    """
+    Returns the routing counters and each replica's health, lag and pools.
+    """
+    return dict(replicas.stats, enabled=replicas.enabled, running=replicas.running,
+                max_lag=replicas.max_lag, sessions=len(replicas._sessions),
+                replicas=[r.snapshot() for r in replicas.replicas])
+
+# --- Cell ---
@@ -0,0 +1,430 @@
+# db_async.py
+#
+# asyncio counterpart of db.py, so a dashboard can load its independent
+# panels concurrently: page latency is then the slowest panel, not the sum.
+#
+# Same semantics as db.py: every (role, schema) pair gets its own pool of
+# asyncpg connections (SQLAlchemy async engine) with SET search_path and
+# SET ROLE applied once when the physical connection opens and no pre-ping
+# on checkout (a dead connection fails its first statement and invalidates
+# the pool, as in db.RolePool); per-request settings such as app.patient_id
+# are transaction-local; statements show up in db.query_metrics(); reads go
+# through db.read_cache under the same keys as their db.py twins, so the sync
+# and async paths share cached results and are invalidated by the same
+# writes.
+#
+# asyncpg connections belong to the event loop that opened them. Streamlit
+# runs the script in a plain thread, so coroutines are executed on one
+# long-lived loop in a background thread (run / fan_out), never with
+# asyncio.run per rerun.
+#
+#   import db_async
+#   panels = db_async.fan_out({
+#       "doctors": db_async.admin_get_all_doctors_df,
+#       "hospitals": db_async.admin_get_all_hospitals_df,
+#       "rollups": rollups.status,             # plain callables run in a thread
+#   })
+#
+# Needs asyncpg and greenlet (pip install asyncpg greenlet).
+
+import asyncio
+import inspect
+import os
+import threading
+from contextlib import asynccontextmanager
+
+from sqlalchemy import event, text
+from sqlalchemy.engine import make_url
+
+import db
+
+try:
+    from sqlalchemy.ext.asyncio import create_async_engine
+except ImportError:  # pragma: no cover - very old SQLAlchemy
+    create_async_engine = None
+
+# Defaults to db.DATABASE_URL with the driver swapped for asyncpg.
+ASYNC_DATABASE_URL = os.environ.get("ASYNC_DATABASE_URL")
+
+
+def async_url(url: str = None):
+    """
+    Returns `url` (default: ASYNC_DATABASE_URL or db.DATABASE_URL) with the
+    postgresql+asyncpg driver.
+    """
+    url = make_url(url or ASYNC_DATABASE_URL or db.DATABASE_URL)
+    return url.set(drivername="postgresql+asyncpg")
+
+
+# =============================================================================
+# 1. Role-scoped async pool
+# =============================================================================
+
+class AsyncRolePool:
+    """
+    One async engine per (role, schema) pair, over a single database URL.
+
+    Usage (inside a coroutine):
+        async with role_pool.connection("doctor_user", "doctor_schema") as conn:
+            rows = (await conn.execute(text("SELECT * FROM patients"))).fetchall()
+    """
+
+    def __init__(self, url: str = None, pool_size: int = db.POOL_SIZE,
+                 max_overflow: int = db.POOL_MAX_OVERFLOW,
+                 timeout: float = db.POOL_TIMEOUT, recycle: int = db.POOL_RECYCLE):
+        self.url = url
+        self.pool_size = pool_size
+        self.max_overflow = max_overflow
+        self.timeout = timeout
+        self.recycle = recycle
+        self._engines = {}
+        self._lock = threading.Lock()
+
+    def configure(self, pool_size: int = None, max_overflow: int = None):
+        """
+        Change the pool sizes for engines created from now on (used by the
+        connection budget, before any connection is opened).
+        """
+        if pool_size is not None:
+            self.pool_size = pool_size
+        if max_overflow is not None:
+            self.max_overflow = max_overflow
+
+    def engine_for(self, role: str, schema: str):
+        """
+        Returns the AsyncEngine backing the (role, schema) pool, creating it
+        on first use.
+        """
+        key = (role, schema)
+        eng = self._engines.get(key)
+        if eng is not None:
+            return eng
+        with self._lock:
+            eng = self._engines.get(key)
+            if eng is None:
+                eng = self._engines[key] = self._create_engine(role, schema)
+        return eng
+
+    def _create_engine(self, role: str, schema: str):
+        if create_async_engine is None:
+            raise ImportError("db_async needs SQLAlchemy's asyncio extension.")
+        eng = create_async_engine(
+            async_url(self.url),
+            echo=False,
+            pool_size=self.pool_size,
+            max_overflow=self.max_overflow,
+            pool_timeout=self.timeout,
+            pool_recycle=self.recycle,
+        )
+
+        @event.listens_for(eng.sync_engine, "connect")
+        def _apply_role(dbapi_conn, connection_record):
+            # asyncpg runs one statement per call; committed so a later
+            # rollback does not undo it.
+            cur = dbapi_conn.cursor()
+            cur.execute(f"SET search_path TO {schema}")
+            cur.execute(f"SET ROLE {role}")
+            cur.close()
+            dbapi_conn.commit()
+
+        @event.listens_for(eng.sync_engine, "handle_error")
+        def _on_error(context):
+            if context.is_disconnect:
+                context.invalidate_pool_on_disconnect = True
+
+        db._instrument_engine(eng.sync_engine, role, schema, explain=False)
+        return eng
+
+    @asynccontextmanager
+    async def connection(self, role: str, schema: str, settings: dict = None):
+        """
+        Check out a connection running as `role` with `schema` on its
+        search_path. Optional `settings` (e.g. {"app.patient_id": 42}) are
+        set transaction-locally, so they end with the first commit/rollback
+        and never leak to the next checkout.
+        """
+        async with self.engine_for(role, schema).connect() as conn:
+            if settings:
+                names = list(settings)
+                exprs = ", ".join(
+                    f"set_config(:k{i}, :v{i}, true)" for i in range(len(names))
+                )
+                params = {}
+                for i, name in enumerate(names):
+                    params[f"k{i}"] = name
+                    params[f"v{i}"] = str(settings[name])
+                await conn.execute(text(f"SELECT {exprs}"), params)
+            yield conn
+
+    def metrics(self):
+        """
+        Returns live size / checked-out counts per (role, schema) pool.
+        """
+        return {
+            f"{role}@{schema}": {
+                "size": eng.pool.size(),
+                "checked_out": eng.pool.checkedout(),
+                "idle": eng.pool.checkedin(),
+                "overflow": eng.pool.overflow(),
+            }
+            for (role, schema), eng in list(self._engines.items())
+        }
+
+    async def dispose(self):
+        """
+        Close every pooled connection.
+        """
+        with self._lock:
+            engines = list(self._engines.values())
+            self._engines.clear()
+        for eng in engines:
+            await eng.dispose()
+
+
+role_pool = AsyncRolePool()
+db.register_budgeted_pool(role_pool, len(db.SCHEMA_ROLES))
+
+
+def role_connection(role: str, schema: str, settings: dict = None):
+    """
+    Shortcut for role_pool.connection(...).
+    """
+    return role_pool.connection(role, schema, settings)
+
+
+# =============================================================================
+# 2. Running coroutines from synchronous code
+# =============================================================================
+
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def event_loop():
+    """
+    Returns the module's event loop, started in a daemon thread on first use.
+    All pooled connections live on this loop.
+    """
+    global _loop
+    with _loop_lock:
+        if _loop is None or _loop.is_closed():
+            loop = asyncio.new_event_loop()
+            threading.Thread(
+                target=loop.run_forever, name="db-async-loop", daemon=True
+            ).start()
+            _loop = loop
+    return _loop
+
+
+def run(coro, timeout: float = None):
+    """
+    Runs a coroutine on the module's event loop and returns its result.
+    Call it from synchronous code (e.g. the Streamlit script), not from a
+    coroutine already running on that loop.
+    """
+    loop = event_loop()
+    if threading.current_thread().name == "db-async-loop":
+        raise RuntimeError("db_async.run() called from the db-async loop; await instead.")
+    return asyncio.run_coroutine_threadsafe(coro, loop).result(timeout)
+
+
+# =============================================================================
+# 3. Running SQL as a role on a schema
+# =============================================================================
+
+async def execute_with_role(sql_text: str, role: str, schema: str, **params):
+    """
+    Async db._execute_with_role: returns the rows as a list of dicts for a
+    SELECT, or None for INSERT/UPDATE/DELETE (which are committed).
+    """
+    async with role_connection(role, schema) as conn:
+        result = await conn.execute(text(sql_text), params)
+        if result.returns_rows:
+            rows = [dict(r._mapping) for r in result.fetchall()]
+            # No await since the statement ran, so this thread's "last
+            # statement" is still ours.
+            db.query_stats.note_materialized(rows)
+            await conn.commit()
+            return rows
+        await conn.commit()
+        return None
+
+
+async def cached_read(role: str, schema: str, tables, query_key, loader, scope=None,
+                      delta=None):
+    """
+    Async db.cached_read: loader is a coroutine function. Keys match
+    db.cached_read, so both paths share entries.
+    """
+    key = (role, schema, db._freeze(query_key), scope)
+    return await db.read_cache.get_or_load_async(
+        key, [(schema, t) for t in tables], loader, delta
+    )
+
+
+async def _execute_cached(sql_text: str, role: str, schema: str, tables, scope=None,
+                          delta=None, **params):
+    return await cached_read(
+        role, schema, tables, (sql_text, params),
+        lambda: execute_with_role(sql_text, role=role, schema=schema, **params),
+        scope=scope, delta=delta,
+    )
+
+
+async def fetch_dataframe(sql, role: str, schema: str, table=None,
+                          settings: dict = None, **params):
+    """
+    Async db.fetch_dataframe: a typed DataFrame built column by column.
+    """
+    stmt = text(sql) if isinstance(sql, str) else sql
+    types = db._statement_types(stmt, table)
+    async with role_connection(role, schema, settings) as conn:
+        result = await conn.execute(stmt, params)
+        names = list(result.keys())
+        rows = result.fetchall()
+        await conn.rollback()
+    return db.frame_from_batches(names, [types.get(n) for n in names], [rows])
+
+
+async def table_dataframe(schema: str, table_name: str, columns=None, patient_id: int = None):
+    """
+    Async db.table_dataframe (same cache entries; reference tables come from
+    the shared reference store when it is enabled).
+    """
+    if not columns and db.reference_store.holds(schema, table_name):
+        return db.reference_store.frame(schema, table_name)
+    stmt = db._table_select(schema, table_name, columns)
+    role = db.SCHEMA_ROLES[schema]
+    return await cached_read(
+        role, schema, [table_name],
+        ("frame", table_name, tuple(columns) if columns else None),
+        lambda: fetch_dataframe(
+            stmt, role, schema, settings=db._stream_settings(schema, patient_id)
+        ),
+        scope=("patient_id", patient_id) if patient_id is not None else None,
+        delta="frame" if patient_id is None else None,
+    )
+
+
+# =============================================================================
+# 4. Read helpers (async twins of the db.py ones)
+# =============================================================================
+
+async def doctor_get_all_patients():
+    """
+    Returns all rows from doctor_schema.patients as a list of dicts.
+    """
+    return await _execute_cached(
+        "SELECT * FROM patients", "doctor_user", "doctor_schema", ["patients"], delta="rows")
+
+
+async def doctor_get_all_medical_records():
+    """
+    Returns all rows from doctor_schema.medical_records as a list of dicts.
+    """
+    return await _execute_cached(
+        "SELECT * FROM medical_records", "doctor_user", "doctor_schema", ["medical_records"],
+        delta="rows")
+
+
+async def patient_get_own_medical_records(patient_id: int):
+    """
+    Returns the caller's rows from patient_schema.medical_records; RLS does
+    the filtering on app.patient_id, set for this transaction only.
+    """
+    async def load():
+        async with role_connection(
+            "patient_user", "patient_schema", {"app.patient_id": int(patient_id)}
+        ) as conn:
+            result = await conn.execute(text("SELECT * FROM medical_records"))
+            rows = [dict(r._mapping) for r in result.fetchall()]
+            db.query_stats.note_materialized(rows)
+            await conn.rollback()
+        return rows
+
+    return await cached_read(
+        "patient_user", "patient_schema", ["medical_records"],
+        "SELECT * FROM medical_records", load, scope=("patient_id", patient_id),
+    )
+
+
+async def admin_get_all_doctors():
+    """
+    Returns all rows from admin_schema.doctors as a list of dicts.
+    """
+    if db.reference_store.holds("admin_schema", "doctors"):
+        return db.reference_store.rows("admin_schema", "doctors")
+    return await _execute_cached(
+        "SELECT * FROM doctors", "admin_user", "admin_schema", ["doctors"], delta="rows")
+
+
+async def admin_get_all_doctors_df():
+    """
+    Returns admin_schema.doctors as a typed pandas DataFrame.
+    """
+    return await table_dataframe("admin_schema", "doctors")
+
+
+async def admin_get_all_hospitals():
+    """
+    Returns all rows from admin_schema.hospitals.
+    """
+    if db.reference_store.holds("admin_schema", "hospitals"):
+        return db.reference_store.rows("admin_schema", "hospitals")
+    return await _execute_cached(
+        "SELECT * FROM hospitals", "admin_user", "admin_schema", ["hospitals"], delta="rows")
+
+
+async def admin_get_all_hospitals_df():
+    """
+    Returns admin_schema.hospitals as a typed pandas DataFrame.
+    """
+    return await table_dataframe("admin_schema", "hospitals")
+
+
+# =============================================================================
+# 5. Fan-out for dashboard panels
+# =============================================================================
+
+async def _load_panel(loader):
+    if inspect.isawaitable(loader):
+        return await loader
+    if inspect.iscoroutinefunction(loader):
+        return await loader()
+    # A plain db.py helper: run it on a worker thread (db's pools are
+    # thread-safe), so it still overlaps with the other panels.
+    return await asyncio.to_thread(loader)
+
+
+async def gather(panels: dict, timeout: float = None):
+    """
+    Loads a dashboard's independent panels concurrently.
+    - panels: {name: loader}; a loader is a coroutine, a coroutine function
+      (e.g. db_async.admin_get_all_doctors_df) or a plain callable
+      (e.g. db.admin_aggregate with functools.partial), run in a thread.
+    - timeout: seconds for the whole page; unfinished panels get TimeoutError.
+    Returns {name: result}. A panel that fails gets its exception as the
+    result, so one broken panel does not blank the whole page.
+    """
+    names = list(panels)
+    tasks = [asyncio.ensure_future(_load_panel(panels[n])) for n in names]
+    done, pending = await asyncio.wait(tasks, timeout=timeout) if tasks else (set(), set())
+    for task in pending:
+        task.cancel()
+    results = {}
+    for name, task in zip(names, tasks):
+        if task in pending:
+            results[name] = asyncio.TimeoutError(f"panel {name!r} timed out")
+        elif task.exception() is not None:
+            results[name] = task.exception()
+        else:
+            results[name] = task.result()
+    return results
+
+
+def fan_out(panels: dict, timeout: float = None):
+    """
+    Synchronous entry point for gather(): runs the panels on the module's
+    event loop and returns {name: result or exception}.
+    """
+    return run(gather(panels, timeout))
@@ -0,0 +1,359 @@
+# export.py
+#
+# Columnar snapshots of admin_schema.medical_records and the tables its ids
+# point at, for offline analysis: analysts read Parquet / Arrow files instead
+# of querying the OLTP database.
+#
+# An export directory looks like:
+#
+#   medical_records/month=2023-04/part-000000060001-000000061000.parquet
+#   medical_records/month=__HIVE_DEFAULT_PARTITION__/...   (no admission date)
+#   dimensions/patients.parquet, doctors.parquet, ...      (replaced every run)
+#   _export_state.json                                     (watermark, history)
+#
+# Runs are incremental. The state file holds the highest record_id already
+# exported; a run exports (watermark, horizon], where the horizon is
+# max(record_id) read under a brief SHARE lock on every copy of
+# medical_records (rollups._safe_horizon), so rows of in-flight inserts,
+# wherever they were written, are never skipped. Each run adds one file per admission
+# month it touches. Rows are streamed with a server-side cursor in admission
+# date order and written batch by batch, so only one file is open at a time
+# and memory stays at about one batch whatever the table size. Files are written under a
+# "."-prefixed name (ignored by readers) and renamed into place before the
+# watermark moves. Exported rows are treated as immutable: to pick up edits
+# of old records, run with --full, which rewrites everything.
+#
+#   python export.py run exports/                 # incremental, Parquet
+#   python export.py run exports/ --format arrow --full
+#   python export.py status exports/
+#
+#   import export
+#   table = export.read("exports/", columns=["hospital_id", "billing_amount"],
+#                       filter=pc.field("month") >= "2023-01")   # memory-mapped
+#
+# Needs pyarrow (pip install pyarrow).
+
+import argparse
+import datetime
+import glob
+import json
+import os
+import sys
+import time
+
+from sqlalchemy import select
+
+import db
+import rollups
+
+SOURCE_SCHEMA = rollups.SOURCE_SCHEMA
+SOURCE_TABLE = rollups.SOURCE_TABLE
+PARTITION_COLUMN = "date_of_admission"
+DIMENSIONS = ["patients"] + [ref for ref, _ in db.RECORD_DIMENSIONS.values()]
+EXPORT_DIR = os.environ.get("EXPORT_DIR", "exports")
+EXPORT_BATCH_SIZE = 50000
+FORMATS = {"parquet": ".parquet", "arrow": ".arrow"}
+STATE_FILE = "_export_state.json"
+NULL_PARTITION = "__HIVE_DEFAULT_PARTITION__"
+HISTORY = 20                  # runs kept in the state file
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+    except ImportError:
+        raise ImportError("Exports need pyarrow (pip install pyarrow).")
+    return pyarrow
+
+
+# =============================================================================
+# 1. Writers
+# =============================================================================
+
+class _Writer:
+    """
+    One output file, written under a hidden temporary name and renamed into
+    place by commit().
+    """
+
+    def __init__(self, path: str, schema, fmt: str):
+        pa = _pyarrow()
+        self.path = path
+        self.tmp = os.path.join(os.path.dirname(path), "." + os.path.basename(path) + ".tmp")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if fmt == "parquet":
+            import pyarrow.parquet as pq
+            self._writer = pq.ParquetWriter(self.tmp, schema, compression="zstd")
+            self._sink = None
+        else:
+            self._sink = pa.OSFile(self.tmp, "wb")
+            self._writer = pa.ipc.new_file(self._sink, schema)
+        self.rows = 0
+
+    def write(self, batch):
+        self._writer.write_batch(batch)
+        self.rows += batch.num_rows
+
+    def close(self):
+        if self._writer is None:
+            return
+        self._writer.close()
+        if self._sink is not None:
+            self._sink.close()
+        self._writer = None
+
+    def commit(self):
+        os.replace(self.tmp, self.path)
+
+    def discard(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+        if os.path.exists(self.tmp):
+            os.remove(self.tmp)
+
+
+def _partition(value):
+    return f"{value:%Y-%m}" if value is not None else NULL_PARTITION
+
+
+def _export_table(stmt, schema, path_for, fmt: str, batch_size: int, partition_index=None):
+    # Streams stmt as admin_user and writes it through one _Writer per
+    # partition (a single file when partition_index is None).
+    writers = {}
+    try:
+        for rows in db.stream_query_batches(stmt, "admin_user", SOURCE_SCHEMA,
+                                            batch_size, as_dicts=False):
+            if partition_index is None:
+                groups = {None: rows}
+            else:
+                groups = {}
+                for row in rows:
+                    groups.setdefault(_partition(row[partition_index]), []).append(row)
+            for key, group in groups.items():
+                writer = writers.get(key)
+                if writer is None:
+                    # Rows come in partition order: the previous file is done.
+                    for done in writers.values():
+                        done.close()
+                    writer = writers[key] = _Writer(path_for(key), schema, fmt)
+                writer.write(db.arrow_batch(schema, group))
+        for writer in writers.values():
+            writer.close()  # no-op for the ones already closed
+    except BaseException:
+        for writer in writers.values():
+            writer.discard()
+        raise
+    return writers
+
+
+# =============================================================================
+# 2. export()
+# =============================================================================
+
+def read_state(out_dir: str):
+    """
+    Returns the export state of out_dir (format, last_id, exported_at, runs),
+    or None if nothing was exported there yet.
+    """
+    path = os.path.join(out_dir, STATE_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _write_state(out_dir: str, state: dict):
+    path = os.path.join(out_dir, STATE_FILE)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(state, f, indent=2, default=str)
+    os.replace(tmp, path)
+
+
+def export(out_dir: str = None, fmt: str = "parquet", full: bool = False,
+           batch_size: int = EXPORT_BATCH_SIZE, dimensions: bool = True):
+    """
+    Exports medical records added since the last run (all of them with
+    full=True) into out_dir, partitioned by admission month, plus a fresh
+    snapshot of the dimension tables.
+    - fmt: "parquet" or "arrow" (Arrow IPC files); an existing export keeps
+      its format unless full=True.
+    Returns {"from_id", "to_id", "rows", "files", "dimensions", "seconds",
+    "format"}; rows is None if the source table was busy (nothing written).
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown export format {fmt!r}; use one of {sorted(FORMATS)}.")
+    out_dir = out_dir or EXPORT_DIR
+    started = time.perf_counter()
+    state = read_state(out_dir)
+    if state is not None and not full and state["format"] != fmt:
+        raise ValueError(f"{out_dir} holds a {state['format']} export; "
+                         f"use that format or full=True.")
+    lo = 0 if full or state is None else state["last_id"]
+
+    pk = rollups._source_pk()
+    try:
+        hi = rollups._safe_horizon(pk)
+    except db.exc.OperationalError:
+        return {"from_id": lo, "to_id": None, "rows": None, "files": [],
+                "dimensions": {}, "seconds": time.perf_counter() - started,
+                "format": fmt}
+
+    ext = FORMATS[fmt]
+    table = db.get_table(SOURCE_SCHEMA, SOURCE_TABLE)
+    schema = db.arrow_schema(table)
+    records_dir = os.path.join(out_dir, SOURCE_TABLE)
+    old_files = glob.glob(os.path.join(records_dir, "month=*", "part-*")) if full else []
+    stmt = (select(*table.c)
+            .where(table.c[pk] > lo, table.c[pk] <= hi)
+            .order_by(table.c[PARTITION_COLUMN].asc().nulls_last(), table.c[pk]))
+    name = f"part-{lo + 1:012d}-{hi:012d}{ext}"
+    writers = _export_table(
+        stmt, schema,
+        lambda month: os.path.join(records_dir, f"month={month}", name),
+        fmt, batch_size, partition_index=list(table.c.keys()).index(PARTITION_COLUMN),
+    ) if hi > lo else {}
+
+    dim_writers = {}
+    if dimensions:
+        try:
+            for dim in DIMENSIONS:
+                dim_table = db.get_table(SOURCE_SCHEMA, dim)
+                dim_writers[dim] = _export_table(
+                    db._table_select(SOURCE_SCHEMA, dim), db.arrow_schema(dim_table),
+                    lambda _, dim=dim: os.path.join(out_dir, "dimensions", dim + ext),
+                    fmt, batch_size,
+                ).get(None)
+        except BaseException:
+            for writer in list(writers.values()) + [w for w in dim_writers.values() if w]:
+                writer.discard()
+            raise
+
+    # Publish: files first, then the watermark.
+    for writer in list(writers.values()) + [w for w in dim_writers.values() if w]:
+        writer.commit()
+    if full:
+        published = {w.path for w in writers.values()}
+        for path in old_files:
+            if path not in published:
+                os.remove(path)
+        if dimensions:
+            for path in glob.glob(os.path.join(out_dir, "dimensions", "*")):
+                if not path.endswith(ext):
+                    os.remove(path)
+
+    summary = {
+        "from_id": lo,
+        "to_id": hi,
+        "rows": sum(w.rows for w in writers.values()),
+        "files": sorted(os.path.relpath(w.path, out_dir) for w in writers.values()),
+        "dimensions": {d: (w.rows if w else 0) for d, w in dim_writers.items()},
+        "seconds": time.perf_counter() - started,
+        "format": fmt,
+    }
+    runs = [] if full or state is None else state.get("runs", [])
+    if summary["rows"] or not runs:
+        runs.append({k: summary[k] for k in ("from_id", "to_id", "rows")}
+                    | {"at": datetime.datetime.now().isoformat(timespec="seconds"),
+                       "files": len(summary["files"])})
+    _write_state(out_dir, {
+        "format": fmt,
+        "last_id": max(hi, lo),
+        "exported_at": datetime.datetime.now().isoformat(timespec="seconds"),
+        "runs": runs[-HISTORY:],
+    })
+    return summary
+
+
+def status(out_dir: str = None):
+    """
+    Returns the export state of out_dir plus how many records are waiting
+    to be exported.
+    """
+    out_dir = out_dir or EXPORT_DIR
+    state = read_state(out_dir) or {"format": None, "last_id": 0, "exported_at": None, "runs": []}
+    pk = rollups._source_pk()
+    rows = db._execute_with_role(
+        f"SELECT count(*) AS pending FROM {SOURCE_TABLE} WHERE {pk} > :last_id",
+        "admin_user", SOURCE_SCHEMA, last_id=state["last_id"],
+    )
+    return dict(state, pending_records=rows[0]["pending"])
+
+
+# =============================================================================
+# 3. Reading an export (memory-mapped)
+# =============================================================================
+
+def dataset(out_dir: str = None, table: str = SOURCE_TABLE):
+    """
+    Returns a pyarrow.dataset.Dataset over an exported table. Files are
+    memory-mapped: Arrow IPC columns are used in place without copying, and
+    Parquet pages are decoded straight from the mapping. medical_records has
+    a "month" partition column ("YYYY-MM") usable in filters.
+    """
+    pa = _pyarrow()
+    import pyarrow.dataset as ds
+    from pyarrow import fs
+
+    out_dir = out_dir or EXPORT_DIR
+    state = read_state(out_dir)
+    if state is None:
+        raise FileNotFoundError(f"No export found in {out_dir}.")
+    fmt = "parquet" if state["format"] == "parquet" else "ipc"
+    filesystem = fs.LocalFileSystem(use_mmap=True)
+    if table == SOURCE_TABLE:
+        return ds.dataset(
+            os.path.abspath(os.path.join(out_dir, table)), format=fmt, filesystem=filesystem,
+            partitioning=ds.partitioning(pa.schema([("month", pa.string())]), flavor="hive"),
+        )
+    path = os.path.join(out_dir, "dimensions", table + FORMATS[state["format"]])
+    return ds.dataset(os.path.abspath(path), format=fmt, filesystem=filesystem)
+
+
+def read(out_dir: str = None, table: str = SOURCE_TABLE, columns=None, filter=None):
+    """
+    Reads an exported table (or just `columns` / rows matching the pyarrow
+    `filter` expression) as a pyarrow Table.
+    """
+    return dataset(out_dir, table).to_table(columns=columns, filter=filter)
+
+
+def read_dataframe(out_dir: str = None, table: str = SOURCE_TABLE, columns=None, filter=None):
+    """
+    Same as read(), as a pandas DataFrame.
+    """
+    return read(out_dir, table, columns, filter).to_pandas()
+
+
+# =============================================================================
+# 4. Command line
+# =============================================================================
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Export admin_schema.medical_records to partitioned Parquet / Arrow files.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    run = sub.add_parser("run", help="export records added since the last run")
+    run.add_argument("out_dir", nargs="?", default=EXPORT_DIR)
+    run.add_argument("--format", choices=sorted(FORMATS), default="parquet")
+    run.add_argument("--full", action="store_true", help="re-export everything")
+    run.add_argument("--batch-size", type=int, default=EXPORT_BATCH_SIZE)
+    run.add_argument("--no-dimensions", action="store_true",
+                     help="skip the dimension table snapshots")
+    st = sub.add_parser("status", help="show the watermark and pending records")
+    st.add_argument("out_dir", nargs="?", default=EXPORT_DIR)
+    args = parser.parse_args(argv)
+
+    if args.command == "run":
+        result = export(args.out_dir, args.format, args.full, args.batch_size,
+                        dimensions=not args.no_dimensions)
+    else:
+        result = status(args.out_dir)
+    print(json.dumps(result, indent=2, default=str))
+    return 1 if args.command == "run" and result["rows"] is None else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,723 @@
+# index_advisor.py
+#
+# Proposes and applies indexes for the access paths the app really uses.
+#
+# Inputs:
+#   - the reflected tables of doctor_schema / patient_schema / admin_schema
+#     (db.get_table), plus the live index list from the catalog;
+#   - the statement workload recorded by db.query_stats, either replayed here
+#     from the app's read helpers or loaded from a file written by a running
+#     app (QUERY_WORKLOAD_FILE, see db.save_query_workload);
+#   - row-level-security policies, whose USING clause is an implicit filter
+#     on every read (patient_schema.medical_records filters on patient_id).
+#
+# Each statement is parsed for equality / range / IS NULL predicates, join
+# keys, ORDER BY and the columns it reads. Equality columns lead, then the
+# sort (or first range) column. Narrow SELECT lists get INCLUDE columns so the
+# index covers them, and IS [NOT] NULL filters become partial indexes.
+# Join keys (*_id columns naming another table's primary key) are proposed in
+# every schema. Anything already served by an existing index is dropped.
+#
+# Indexes are built CONCURRENTLY, so the dashboard keeps working. The
+# "report" command times a probe query per index, builds the indexes,
+# ANALYZEs, and times the probes again with before/after plans.
+#
+#   python index_advisor.py advise                  # proposals + DDL
+#   python index_advisor.py advise --write-migration
+#   python index_advisor.py report --plans          # measure, apply, measure
+#   python index_advisor.py migrate                 # apply migrations/*.sql
+#   python index_advisor.py advise --workload workload.json
+
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import random
+import re
+import statistics
+import sys
+import time
+
+from sqlalchemy import inspect, text
+
+import db
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+MIGRATIONS_DIR = os.path.join(HERE, "migrations")
+MAX_INCLUDE = 4            # widest INCLUDE list worth keeping index-only
+LOW_CARDINALITY = 20       # leading columns with fewer distinct values are skipped
+PROBE_RUNS = 5
+
+_IDENT = r"[A-Za-z_]\w*"
+_COLREF = rf"(?:{_IDENT}\.){{0,2}}{_IDENT}"
+_PLACEHOLDER = r"(?:%\(\w+\)s|%s|\?|:\w+)"
+_EQ = re.compile(rf"({_COLREF})\s*=\s*(?:ANY\s*\(\s*)?(?:{_PLACEHOLDER}|({_COLREF}))", re.I)
+_IN = re.compile(rf"({_COLREF})\s+IN\s*\(", re.I)
+_RANGE = re.compile(rf"({_COLREF})\s*(?:<=|>=|<|>|\bBETWEEN\b)", re.I)
+_NULL = re.compile(rf"({_COLREF})\s+IS\s+(NOT\s+)?NULL", re.I)
+_TABLES = re.compile(rf"\b(?:FROM|JOIN)\s+({_IDENT}(?:\.{_IDENT})?)", re.I)
+_OR = re.compile(r"\bOR\b", re.I)
+_QUAL_EQ = re.compile(rf"\(?\s*({_COLREF})\s*=", re.I)   # policy: col = current_setting(...)
+
+
+# =============================================================================
+# 1. Workload
+# =============================================================================
+
+def _replay_calls(rng):
+    # The dashboard's read paths, as the app calls them.
+    patients = db.estimate_row_count("doctor_user", "doctor_schema", "patients") or 1
+    calls = [
+        (db.doctor_get_all_patients, (), {}),
+        (db.doctor_get_all_medical_records, (), {}),
+        (db.doctor_get_patients_page, (), {}),
+        (db.doctor_get_medical_records_page, (), {}),
+        (db.admin_get_all_doctors_df, (), {}),
+        (db.admin_get_all_hospitals_df, (), {}),
+        (db.admin_aggregate, (["count", "avg:billing_amount"],),
+         {"group_by": ["hospital_id"]}),
+        (db.admin_aggregate, (["count", "avg:length_of_stay"],),
+         {"group_by": ["medical_condition"],
+          "filters": [("date_of_admission", ">=", datetime.date.today()
+                       - datetime.timedelta(days=90))]}),
+    ]
+    for column in ("date_of_admission", "billing_amount"):
+        calls.append((db.doctor_get_medical_records_page, (),
+                      {"sort_column": column, "direction": "desc"}))
+    for _ in range(20):
+        calls.append((db.patient_get_own_medical_records,
+                      (rng.randint(1, max(1, patients)),), {}))
+    return calls
+
+
+def replay_workload(rounds: int = 3, seed: int = 0):
+    """
+    Runs the app's read helpers `rounds` times with the read cache disabled
+    and returns the recorded statements (db.query_metrics()).
+    """
+    rng = random.Random(seed)
+    db.query_stats.reset()
+    ttl, db.read_cache.ttl = db.read_cache.ttl, 0
+    try:
+        for _ in range(rounds):
+            for fn, args, kwargs in _replay_calls(rng):
+                result = fn(*args, **kwargs)
+                # Follow the first page link, like the Next button does.
+                if isinstance(result, dict) and result.get("next_cursor"):
+                    fn(*args, cursor=result["next_cursor"], **kwargs)
+    finally:
+        db.read_cache.ttl = ttl
+    return db.query_metrics()
+
+
+def load_workload(path: str):
+    """
+    Reads a workload file written by db.save_query_workload().
+    """
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+# =============================================================================
+# 2. Parsing statements
+# =============================================================================
+
+def _clause(sql: str, start: str, ends):
+    m = re.search(rf"\b{start}\b(.*?)(?=\b(?:{'|'.join(ends)})\b|$)", sql, re.I | re.S)
+    return m.group(1) if m else ""
+
+
+def _resolve(ref: str, tables: dict):
+    # "schema.table.col" / "table.col" / "col" -> (table, col), or None.
+    parts = ref.split(".")
+    col = parts[-1]
+    if len(parts) >= 2:
+        table = tables.get(parts[-2])
+        return (parts[-2], col) if table is not None and col in table.c else None
+    owners = [name for name, table in tables.items() if col in table.c]
+    return (owners[0], col) if len(owners) == 1 else None
+
+
+def _policies(conn):
+    # RLS USING clauses per (schema, table): [(roles, qual)].
+    rows = conn.execute(text(
+        "SELECT schemaname, tablename, roles, qual FROM pg_policies "
+        "WHERE cmd IN ('SELECT', 'ALL') AND qual IS NOT NULL")).all()
+    out = {}
+    for schema, table, roles, qual in rows:
+        out.setdefault((schema, table), []).append((set(roles), qual))
+    return out
+
+
+def parse_statement(sql: str, schema: str, role: str = None, policies=None):
+    """
+    Returns {table: {"eq", "range", "sort", "null", "select", "star"}} for the
+    tables of `schema` that `sql` reads.
+    """
+    uses = {}
+    for part in sql.split(";"):
+        names = {m.group(1).split(".")[-1] for m in _TABLES.finditer(part)
+                 if m.group(1).split(".")[0] in (schema, m.group(1))}
+        tables = {n: db.get_table(schema, n) for n in names
+                  if n in db.SCHEMA_TABLES.get(schema, ())}
+        if not tables:
+            continue
+        where = _clause(part, "WHERE", ["GROUP BY", "ORDER BY", "LIMIT", "OFFSET", "FOR"])
+        for on in re.findall(r"\bON\b(.*?)(?=\bJOIN\b|\bWHERE\b|$)", part, re.I | re.S):
+            where += " AND " + on
+        group = _clause(part, "GROUP BY", ["HAVING", "ORDER BY", "LIMIT"])
+        # An aggregate's ORDER BY sorts its output, not the table.
+        order = "" if group else _clause(part, "ORDER BY", ["LIMIT", "OFFSET", "FOR"])
+        select_list = _clause(part, "SELECT", ["FROM"])
+        has_or = bool(_OR.search(where))
+
+        def use(name):
+            return uses.setdefault(name, {"eq": set(), "range": [], "sort": [],
+                                          "null": set(), "select": set(), "star": False})
+
+        for m in _EQ.finditer(where):
+            sides = [m.group(1)] + ([m.group(2)] if m.group(2) else [])
+            for ref in sides:
+                hit = _resolve(ref, tables)
+                if hit:
+                    u = use(hit[0])
+                    # Inside an OR (keyset seeks) the column is only a range.
+                    (u["range"].append(hit[1]) if has_or else u["eq"].add(hit[1]))
+        for m in _IN.finditer(where):
+            hit = _resolve(m.group(1), tables)
+            if hit and not has_or:
+                use(hit[0])["eq"].add(hit[1])
+        for m in _RANGE.finditer(where):
+            hit = _resolve(m.group(1), tables)
+            if hit and hit[1] not in use(hit[0])["range"]:
+                use(hit[0])["range"].append(hit[1])
+        for m in _NULL.finditer(where):
+            hit = _resolve(m.group(1), tables)
+            if hit and not has_or:
+                use(hit[0])["null"].add((hit[1], bool(m.group(2))))
+        for item in order.split(","):
+            m = re.match(rf"\s*({_COLREF})", item)
+            hit = _resolve(m.group(1), tables) if m else None
+            if hit and hit[1] not in use(hit[0])["sort"]:
+                use(hit[0])["sort"].append(hit[1])
+        for ref in re.findall(_COLREF, select_list + " " + group):
+            hit = _resolve(ref, tables)
+            if hit:
+                use(hit[0])["select"].add(hit[1])
+        if re.search(r"(^|[\s,.])\*", select_list):
+            for name in tables:
+                use(name)["star"] = True
+
+        # Row-level security adds its USING clause to every read.
+        for name in tables:
+            for roles, qual in (policies or {}).get((schema, name), ()):
+                if role is None or role in roles or "public" in roles:
+                    for m in _QUAL_EQ.finditer(qual):
+                        hit = _resolve(m.group(1), {name: tables[name]})
+                        if hit:
+                            use(name)["eq"].add(hit[1])
+    return uses
+
+
+# =============================================================================
+# 3. Candidates
+# =============================================================================
+
+def existing_indexes(conn, schema: str, table_name: str):
+    """
+    [(columns, include, where)] for the live indexes and primary key.
+    """
+    insp = inspect(conn)
+    out = []
+    pk = insp.get_pk_constraint(table_name, schema=schema)
+    if pk.get("constrained_columns"):
+        out.append((list(pk["constrained_columns"]), [], None))
+    for ix in insp.get_indexes(table_name, schema=schema):
+        opts = ix.get("dialect_options", {})
+        out.append((
+            [c for c in ix["column_names"] if c is not None],
+            list(ix.get("include_columns") or opts.get("postgresql_include") or []),
+            opts.get("postgresql_where"),
+        ))
+    return out
+
+
+def _covered(cand, existing):
+    for columns, include, where in existing:
+        if where is not None and cand["where"] is None:
+            continue
+        if where is None and cand["where"] is not None:
+            continue
+        if columns[:len(cand["columns"])] == cand["columns"] and \
+                set(cand["include"]) <= set(columns) | set(include):
+            return True
+    return False
+
+
+def _index_name(cand):
+    name = "ix_{}_{}".format(cand["table"], "_".join(cand["columns"]))
+    if cand["include"]:
+        name += "_cov"
+    if cand["where"]:
+        name += "_part"
+    if len(name) > 63:
+        digest = hashlib.md5(name.encode()).hexdigest()[:8]
+        name = f"{name[:54]}_{digest}"
+    return name
+
+
+def _qualified(cand):
+    return f'{cand["schema"]}.{cand["name"]}'
+
+
+def index_ddl(cand):
+    """
+    The CREATE INDEX CONCURRENTLY statement for a candidate.
+    """
+    sql = (f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {cand["name"]} '
+           f'ON {cand["schema"]}.{cand["table"]} ({", ".join(cand["columns"])})')
+    if cand["include"]:
+        sql += f' INCLUDE ({", ".join(cand["include"])})'
+    if cand["where"]:
+        sql += f' WHERE {cand["where"]}'
+    return sql
+
+
+def _new_candidate(schema, table, eq, rng, sort, include=(), where=None,
+                   score=0.0, calls=0, reason=""):
+    columns = list(eq) + [c for c in (sort or rng[:1]) if c not in eq]
+    cand = {
+        "schema": schema, "table": table, "columns": columns,
+        "eq": list(eq), "range": None if sort else (rng[0] if rng else None),
+        "sort": list(sort), "include": sorted(set(include) - set(columns)),
+        "where": where, "score": score, "calls": calls, "reasons": [reason],
+    }
+    cand["name"] = _index_name(cand)
+    return cand
+
+
+def _join_keys(schema: str):
+    # medical_records.doctor_id etc.: reflected foreign keys, plus *_id
+    # columns that name another table's single-column primary key.
+    pk_owner = {}
+    for s, names in db.SCHEMA_TABLES.items():
+        for n in names:
+            pk = list(db.get_table(s, n).primary_key.columns)
+            if len(pk) == 1:
+                pk_owner.setdefault(pk[0].name, n)
+    for name in db.SCHEMA_TABLES[schema]:
+        table = db.get_table(schema, name)
+        for col in table.c:
+            target = None
+            if col.foreign_keys:
+                target = next(iter(col.foreign_keys)).column.table.name
+            elif col.name.endswith("_id") and pk_owner.get(col.name) not in (None, name):
+                target = pk_owner[col.name]
+            if target and not col.primary_key:
+                yield name, col.name, target
+
+
+def _n_distinct(conn, schema, table, column):
+    value = conn.execute(text(
+        "SELECT n_distinct FROM pg_stats "
+        "WHERE schemaname = :s AND tablename = :t AND attname = :c"),
+        {"s": schema, "t": table, "c": column}).scalar()
+    return value  # > 0: distinct values; < 0: fraction of rows; None: no stats
+
+
+def advise(workload, schemas=None):
+    """
+    Returns index candidates for the workload, best first. Each is a dict
+    with schema, table, columns, include, where, name, score (seconds of
+    workload that would use it), calls and reasons.
+    """
+    schemas = schemas or list(db.SCHEMA_TABLES)
+    found = {}
+    with db.engine.connect() as conn:
+        policies = _policies(conn)
+
+        for s in workload:
+            if s["schema"] not in schemas:
+                continue
+            uses = parse_statement(s["sql"], s["schema"], s.get("role"), policies)
+            for table, u in uses.items():
+                if not (u["eq"] or u["range"] or u["sort"]):
+                    continue
+                covering = () if u["star"] else u["select"]
+                if set(covering) | u["eq"] | set(u["range"]) | set(u["sort"]) \
+                        >= set(db.get_table(s["schema"], table).c.keys()):
+                    covering = ()  # covering every column just copies the table
+                where = " AND ".join(
+                    f"{c} IS {'NOT ' if not_ else ''}NULL" for c, not_ in sorted(u["null"])
+                ) or None
+                cand = _new_candidate(
+                    s["schema"], table, sorted(u["eq"]), u["range"], u["sort"],
+                    include=covering if len(set(covering) - u["eq"]) <= MAX_INCLUDE else (),
+                    where=where, score=s["seconds_sum"], calls=s["calls"],
+                    reason=f"{s['calls']}x {s['role']}: {s['sql'][:80]}",
+                )
+                prior = found.get((cand["schema"], cand["name"]))
+                if prior:
+                    prior["score"] += cand["score"]
+                    prior["calls"] += cand["calls"]
+                    prior["reasons"] += cand["reasons"]
+                else:
+                    found[(cand["schema"], cand["name"])] = cand
+
+        for schema in schemas:
+            for table, column, target in _join_keys(schema):
+                cand = _new_candidate(schema, table, [column], [], [],
+                                      reason=f"join key -> {target}")
+                found.setdefault((cand["schema"], cand["name"]), cand)
+
+        # Fold candidates that are a prefix of a longer one on the same table.
+        kept = []
+        for cand in sorted(found.values(), key=lambda c: -len(c["columns"])):
+            for k in kept:
+                if (k["schema"], k["table"], k["where"]) == \
+                        (cand["schema"], cand["table"], cand["where"]) \
+                        and k["columns"][:len(cand["columns"])] == cand["columns"] \
+                        and set(cand["include"]) <= set(k["columns"]) | set(k["include"]):
+                    k["score"] += cand["score"]
+                    k["calls"] += cand["calls"]
+                    k["reasons"] += cand["reasons"]
+                    break
+            else:
+                kept.append(cand)
+
+        out = []
+        existing = {}
+        for cand in kept:
+            key = (cand["schema"], cand["table"])
+            if key not in existing:
+                existing[key] = existing_indexes(conn, *key)
+            if _covered(cand, existing[key]):
+                continue
+            lead = cand["columns"][0]
+            n = _n_distinct(conn, cand["schema"], cand["table"], lead)
+            if n is not None and 0 < n < LOW_CARDINALITY and len(cand["columns"]) == 1 \
+                    and not cand["include"] and not cand["where"]:
+                continue  # an index on a handful of values won't be used
+            out.append(cand)
+    return sorted(out, key=lambda c: (-c["score"], c["schema"], c["name"]))
+
+
+# =============================================================================
+# 4. Applying: direct, or through numbered migration files
+# =============================================================================
+
+def apply(candidates, progress=None):
+    """
+    Builds the indexes CONCURRENTLY (outside a transaction) and ANALYZEs the
+    tables. Returns {schema.index name: build seconds}.
+    """
+    timings = {}
+    with db.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        for cand in candidates:
+            started = time.perf_counter()
+            conn.execute(text(index_ddl(cand)))
+            timings[_qualified(cand)] = time.perf_counter() - started
+            if progress:
+                progress(cand, timings[_qualified(cand)])
+        for schema, table in sorted({(c["schema"], c["table"]) for c in candidates}):
+            conn.execute(text(f"ANALYZE {schema}.{table}"))
+    return timings
+
+
+def drop(candidates):
+    """
+    Drops the candidates' indexes (to re-run a before/after comparison).
+    """
+    with db.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        for cand in candidates:
+            conn.execute(text(
+                f"DROP INDEX CONCURRENTLY IF EXISTS {_qualified(cand)}"))
+
+
+def write_migration(candidates, label: str = "index_advisor"):
+    """
+    Writes the candidates' DDL as the next numbered file in migrations/.
+    Returns the path.
+    """
+    os.makedirs(MIGRATIONS_DIR, exist_ok=True)
+    numbers = [int(f.split("_", 1)[0]) for f in os.listdir(MIGRATIONS_DIR)
+               if f.endswith(".sql") and f.split("_", 1)[0].isdigit()]
+    path = os.path.join(MIGRATIONS_DIR, f"{max(numbers, default=0) + 1:04d}_{label}.sql")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(f"-- Generated by index_advisor.py on {datetime.date.today()}.\n")
+        f.write("-- One statement per line; each runs outside a transaction.\n\n")
+        for cand in candidates:
+            f.write(f"-- {cand['reasons'][0]}\n{index_ddl(cand)};\n\n")
+    return path
+
+
+_REQUIRES = re.compile(r"^--\s*requires:\s*(.+)$", re.M)
+_SQL_TOKEN = re.compile(r"--[^\n]*|'(?:[^']|'')*'|(\$\w*\$)|;", re.S)
+
+
+def split_statements(source: str):
+    """
+    Splits a SQL file into statements on top-level semicolons, skipping
+    comments and keeping quoted strings and $$ function bodies intact.
+    """
+    statements, start, pos = [], 0, 0
+    chunks = []
+    while True:
+        m = _SQL_TOKEN.search(source, pos)
+        if m is None:
+            chunks.append(source[start:])
+            break
+        token = m.group(0)
+        if token.startswith("--"):
+            chunks.append(source[start:m.start()])
+            start = pos = m.end()
+        elif m.group(1):
+            end = source.find(token, m.end())
+            pos = len(source) if end < 0 else end + len(token)
+        elif token == ";":
+            chunks.append(source[start:m.start()])
+            statements.append("".join(chunks))
+            chunks, start, pos = [], m.end(), m.end()
+        else:
+            pos = m.end()
+    statements.append("".join(chunks))
+    return [s.strip() for s in statements if s.strip()]
+
+
+def migrate(progress=None):
+    """
+    Applies migrations/*.sql not yet recorded in public.schema_migrations,
+    in file-name order, one statement at a time with autocommit (needed for
+    CONCURRENTLY). A file starting with "-- requires: ext1, ext2" is skipped
+    (and retried on the next run) while those extensions are not available
+    on the server. Returns {"applied": [names], "skipped": {name: reason}}.
+    """
+    applied_now, skipped = [], {}
+    files = sorted(f for f in os.listdir(MIGRATIONS_DIR) if f.endswith(".sql")) \
+        if os.path.isdir(MIGRATIONS_DIR) else []
+    with db.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.execute(text(
+            "CREATE TABLE IF NOT EXISTS public.schema_migrations ("
+            " version text PRIMARY KEY, applied_at timestamptz NOT NULL DEFAULT now())"))
+        done = set(conn.execute(text("SELECT version FROM public.schema_migrations")).scalars())
+        available = set(conn.execute(text("SELECT name FROM pg_available_extensions")).scalars())
+        for name in files:
+            if name in done:
+                continue
+            with open(os.path.join(MIGRATIONS_DIR, name), encoding="utf-8") as f:
+                source = f.read()
+            required = {e.strip() for m in _REQUIRES.finditer(source) for e in m.group(1).split(",")}
+            if required - available:
+                skipped[name] = "needs extension " + ", ".join(sorted(required - available))
+                continue
+            for statement in split_statements(source):
+                started = time.perf_counter()
+                conn.execute(text(statement))
+                if progress:
+                    progress(name, statement, time.perf_counter() - started)
+            conn.execute(text("INSERT INTO public.schema_migrations (version) VALUES (:v)"),
+                         {"v": name})
+            applied_now.append(name)
+    for schema in db.SCHEMA_TABLES:
+        db.invalidate_table(schema)
+    return {"applied": applied_now, "skipped": skipped}
+
+
+# =============================================================================
+# 5. Before / after measurement
+# =============================================================================
+
+def _probe(conn, cand):
+    # A representative query for the index, with values sampled from the
+    # table: equality on real values, a ~1% range, the sort and its LIMIT.
+    table = f'{cand["schema"]}.{cand["table"]}'
+    params, where = {}, []
+    if cand["eq"]:
+        row = conn.execute(text(
+            f'SELECT {", ".join(cand["eq"])} FROM {table} '
+            f'WHERE {" AND ".join(f"{c} IS NOT NULL" for c in cand["eq"])} '
+            f'{"AND " + cand["where"] if cand["where"] else ""} '
+            f'ORDER BY random() LIMIT 1')).first()
+        if row is None:
+            return None
+        for i, (col, value) in enumerate(zip(cand["eq"], row)):
+            params[f"e{i}"] = value
+            where.append(f"{col} = :e{i}")
+    if cand["range"]:
+        params["r"] = conn.execute(text(
+            f'SELECT percentile_disc(0.99) WITHIN GROUP (ORDER BY {cand["range"]}) '
+            f'FROM {table}')).scalar()
+        where.append(f'{cand["range"]} >= :r')
+    if cand["where"]:
+        where.append(cand["where"])
+    columns = ", ".join(cand["columns"] + cand["include"]) if cand["include"] else "*"
+    sql = f'SELECT {columns} FROM {cand["table"]}'
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    if cand["sort"]:
+        sql += f' ORDER BY {", ".join(cand["sort"])} LIMIT {db.DEFAULT_PAGE_SIZE}'
+
+    settings = None
+    if cand["schema"] == "patient_schema":
+        pid = params.get(f'e{cand["eq"].index("patient_id")}') if "patient_id" in cand["eq"] \
+            else conn.execute(text(f"SELECT patient_id FROM {table} LIMIT 1")).scalar()
+        settings = {"app.patient_id": str(pid)}
+    return {"sql": sql, "params": params, "settings": settings}
+
+
+def _explain(probe, schema, runs: int = PROBE_RUNS, plans: bool = False):
+    # Median execution time over `runs`, as the schema's own role.
+    role = db.SCHEMA_ROLES[schema]
+    times, node, blocks, plan = [], None, None, None
+    with db.role_connection(role, schema, probe["settings"]) as conn:
+        try:
+            for _ in range(runs):
+                doc = conn.execute(
+                    text("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + probe["sql"]),
+                    probe["params"]).scalar()
+                doc = (json.loads(doc) if isinstance(doc, str) else doc)[0]
+                times.append(doc["Execution Time"])
+                top = doc["Plan"]
+                while top.get("Node Type") in ("Limit", "Sort", "Gather", "Result") and top.get("Plans"):
+                    top = top["Plans"][0]
+                node = top["Node Type"] + (f' ({top["Index Name"]})' if "Index Name" in top else "")
+                blocks = doc["Plan"].get("Shared Hit Blocks", 0) + \
+                    doc["Plan"].get("Shared Read Blocks", 0)
+            if plans:
+                plan = db._redact_plan(r[0] for r in conn.execute(
+                    text("EXPLAIN (ANALYZE, BUFFERS) " + probe["sql"]), probe["params"]))
+        finally:
+            conn.rollback()
+    return {"ms": statistics.median(times), "node": node, "blocks": blocks, "plan": plan}
+
+
+def report(candidates, plans: bool = False, keep: bool = True, progress=None):
+    """
+    Times a probe per candidate, builds the indexes, times the probes again.
+    Returns one dict per candidate: name, ddl, before / after (ms, node,
+    blocks, plan), speedup and build_seconds. keep=False drops the indexes
+    again afterwards.
+    """
+    with db.engine.connect() as conn:
+        probes = {_qualified(c): _probe(conn, c) for c in candidates}
+    before = {_qualified(c): _explain(probes[_qualified(c)], c["schema"], plans=plans)
+              for c in candidates if probes[_qualified(c)]}
+    builds = apply(candidates, progress=progress)
+    after = {_qualified(c): _explain(probes[_qualified(c)], c["schema"], plans=plans)
+             for c in candidates if probes[_qualified(c)]}
+    if not keep:
+        drop(candidates)
+
+    out = []
+    for c in candidates:
+        key = _qualified(c)
+        b, a = before.get(key), after.get(key)
+        out.append({
+            "index": key, "ddl": index_ddl(c),
+            "probe": probes[key]["sql"] if probes[key] else None,
+            "before": b, "after": a,
+            "speedup": (b["ms"] / a["ms"]) if b and a and a["ms"] else None,
+            "build_seconds": builds.get(key),
+        })
+    return out
+
+
+def compare_workloads(before, after):
+    """
+    Per-statement p50 before / after two replays (db.query_metrics() lists).
+    """
+    index = {(s["role"], s["schema"], s["query_id"]): s for s in after}
+    rows = []
+    for s in before:
+        a = index.get((s["role"], s["schema"], s["query_id"]))
+        if a and s["p50_ms"] is not None and a["p50_ms"] is not None:
+            rows.append({"role": s["role"], "sql": s["sql"],
+                         "before_p50_ms": s["p50_ms"], "after_p50_ms": a["p50_ms"]})
+    return sorted(rows, key=lambda r: -r["before_p50_ms"])
+
+
+# =============================================================================
+# 6. Command line
+# =============================================================================
+
+def _print_candidates(candidates):
+    if not candidates:
+        print("No new indexes to propose.")
+    for c in candidates:
+        print(f"{c['score'] * 1000:>10.1f} ms {c['calls']:>6} calls  {index_ddl(c)}")
+        for reason in c["reasons"][:3]:
+            print(f"{'':>26}{reason}")
+
+
+def _print_report(rows, plans: bool):
+    print(f"{'index':<64} {'before ms':>10} {'after ms':>10} {'speedup':>8} "
+          f"{'build s':>8}  plan")
+    for r in rows:
+        b, a = r["before"], r["after"]
+        if not b:
+            print(f"{r['index']:<64} (no rows to probe)")
+            continue
+        print(f"{r['index']:<64} {b['ms']:>10.3f} {a['ms']:>10.3f} "
+              f"{r['speedup']:>7.1f}x {r['build_seconds']:>8.2f}  "
+              f"{b['node']} -> {a['node']}")
+        if plans:
+            print(f"\n  probe: {r['probe']}\n  -- before --\n  "
+                  + b["plan"].replace("\n", "\n  ")
+                  + "\n  -- after --\n  " + a["plan"].replace("\n", "\n  ") + "\n")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Propose, measure and apply indexes for the app's workload.")
+    parser.add_argument("command", choices=["advise", "report", "migrate"])
+    parser.add_argument("--workload", metavar="PATH",
+                        help="workload file from db.save_query_workload "
+                             "(default: replay the app's read helpers)")
+    parser.add_argument("--rounds", type=int, default=3, help="replay rounds")
+    parser.add_argument("--schema", action="append", choices=list(db.SCHEMA_TABLES))
+    parser.add_argument("--write-migration", action="store_true",
+                        help="advise: write the proposals to migrations/")
+    parser.add_argument("--plans", action="store_true", help="report: print plans")
+    parser.add_argument("--drop-after", action="store_true",
+                        help="report: drop the indexes again when done")
+    parser.add_argument("--json", action="store_true", help="machine-readable output")
+    args = parser.parse_args(argv)
+
+    if args.command == "migrate":
+        result = migrate(progress=lambda name, stmt, s: print(
+            f"{name}: {s:.2f}s  {stmt.splitlines()[0][:90]}", file=sys.stderr))
+        print(json.dumps(result, indent=2))
+        return 0
+
+    replayed = args.workload is None
+    workload = load_workload(args.workload) if not replayed else replay_workload(args.rounds)
+    candidates = advise(workload, args.schema)
+
+    if args.command == "advise":
+        if args.json:
+            print(json.dumps(candidates, indent=2, default=str))
+        else:
+            _print_candidates(candidates)
+        if args.write_migration and candidates:
+            print(f"wrote {write_migration(candidates)}", file=sys.stderr)
+        return 0
+
+    rows = report(candidates, plans=args.plans, keep=not args.drop_after)
+    result = {"indexes": rows}
+    if replayed and not args.drop_after:
+        result["workload"] = compare_workloads(workload, replay_workload(args.rounds))
+    if args.json:
+        print(json.dumps(result, indent=2, default=str))
+        return 0
+    _print_report(rows, args.plans)
+    if result.get("workload"):
+        print(f"\n{'statement p50 (replayed)':<90} {'before ms':>10} {'after ms':>10}")
+        for r in result["workload"]:
+            print(f"{(r['role'] + ': ' + r['sql'])[:90]:<90} "
+                  f"{r['before_p50_ms']:>10.3f} {r['after_p50_ms']:>10.3f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
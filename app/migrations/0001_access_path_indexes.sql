@@ -0,0 +1,48 @@
+-- Generated by index_advisor.py on 2026-10-17.
+-- One statement per line; each runs outside a transaction.
+
+-- 60x patient_user: SELECT set_config(?, %(patient_id)s, true); SELECT * FROM medical_records
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_medical_records_patient_id ON patient_schema.medical_records (patient_id);
+
+-- 3x doctor_user: SELECT doctor_schema.medical_records.record_id, doctor_schema.medical_records.pa
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_medical_records_billing_amount_record_id ON doctor_schema.medical_records (billing_amount, record_id);
+
+-- 3x doctor_user: SELECT doctor_schema.medical_records.record_id, doctor_schema.medical_records.pa
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_medical_records_date_of_admission_record_id ON doctor_schema.medical_records (date_of_admission, record_id);
+
+-- 3x admin_user: SELECT admin_schema.medical_records.medical_condition, count(*) AS count, CAST(a
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_medical_records_date_of_admission_cov ON admin_schema.medical_records (date_of_admission) INCLUDE (length_of_stay, medical_condition);
+
+-- join key -> doctors
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_medical_records_doctor_id ON admin_schema.medical_records (doctor_id);
+
+-- join key -> hospitals
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_medical_records_hospital_id ON admin_schema.medical_records (hospital_id);
+
+-- join key -> medications
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_medical_records_medication_id ON admin_schema.medical_records (medication_id);
+
+-- join key -> patients
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_medical_records_patient_id ON admin_schema.medical_records (patient_id);
+
+-- join key -> doctors
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_medical_records_doctor_id ON doctor_schema.medical_records (doctor_id);
+
+-- join key -> hospitals
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_medical_records_hospital_id ON doctor_schema.medical_records (hospital_id);
+
+-- join key -> medications
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_medical_records_medication_id ON doctor_schema.medical_records (medication_id);
+
+-- join key -> patients
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_medical_records_patient_id ON doctor_schema.medical_records (patient_id);
+
+-- join key -> doctors
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_medical_records_doctor_id ON patient_schema.medical_records (doctor_id);
+
+-- join key -> hospitals
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_medical_records_hospital_id ON patient_schema.medical_records (hospital_id);
+
+-- join key -> medications
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_medical_records_medication_id ON patient_schema.medical_records (medication_id);
+
@@ -0,0 +1,13 @@
+-- Patient search (db.search_patients): name prefix (as written and
+-- surname-first), name words, and the per-condition "most recently admitted"
+-- walk. The surname-first expression must match db._SURNAME_FIRST.
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_patients_name_prefix ON doctor_schema.patients ((lower(name) COLLATE "C"));
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_patients_surname_prefix ON doctor_schema.patients ((lower(regexp_replace(name, '^(.*\S)\s+(\S+)$', '\2 \1')) COLLATE "C"));
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_patients_name_words ON doctor_schema.patients USING gin (to_tsvector('simple', name));
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_medical_records_condition_recent ON doctor_schema.medical_records (medical_condition, date_of_admission DESC);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_patients_name_prefix ON admin_schema.patients ((lower(name) COLLATE "C"));
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_patients_surname_prefix ON admin_schema.patients ((lower(regexp_replace(name, '^(.*\S)\s+(\S+)$', '\2 \1')) COLLATE "C"));
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_patients_name_words ON admin_schema.patients USING gin (to_tsvector('simple', name));
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_medical_records_condition_recent ON admin_schema.medical_records (medical_condition, date_of_admission DESC);
@@ -0,0 +1,8 @@
+-- requires: pg_trgm
+-- Fuzzy (typo-tolerant) patient name search. Skipped by the migration runner
+-- until the pg_trgm extension is available on the server.
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_patients_name_trgm ON doctor_schema.patients USING gin (lower(name) gin_trgm_ops);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_patients_name_trgm ON admin_schema.patients USING gin (lower(name) gin_trgm_ops);
@@ -0,0 +1,71 @@
+-- Change feed (db.ChangeFeed): statement-level triggers that publish each
+-- committed change to patients, medical_records, doctors and hospitals on
+-- the "healthcare_changes" channel, as one compact JSON event per statement:
+--   {"s": schema, "t": table, "op": "I"|"U"|"D", "n": rows, "ids": [...]}
+-- Only primary keys travel, never row contents: any role that can connect
+-- can LISTEN, and patient_schema is behind row-level security. The listener
+-- reads the changed rows as the schema's own role. Past 1000 rows, or when
+-- the keys would not fit in a notification (8000 bytes), only the count is
+-- sent (the listener then reloads).
+
+CREATE OR REPLACE FUNCTION public.healthcare_notify_change() RETURNS trigger
+LANGUAGE plpgsql AS $$
+DECLARE
+    pk text := TG_ARGV[0];
+    op text := left(TG_OP, 1);
+    changed text := CASE WHEN TG_OP = 'DELETE' THEN 'old_rows' ELSE 'new_rows' END;
+    n bigint;
+    payload text;
+    body json;
+BEGIN
+    EXECUTE format('SELECT count(*) FROM %I', changed) INTO n;
+    IF n = 0 THEN
+        RETURN NULL;
+    END IF;
+    IF n <= 1000 THEN
+        EXECUTE format('SELECT json_agg(%I) FROM %I', pk, changed) INTO body;
+        payload := json_build_object('s', TG_TABLE_SCHEMA, 't', TG_TABLE_NAME,
+                                     'op', op, 'n', n, 'ids', body)::text;
+    END IF;
+    IF payload IS NULL OR octet_length(payload) > 7900 THEN
+        payload := json_build_object('s', TG_TABLE_SCHEMA, 't', TG_TABLE_NAME,
+                                     'op', op, 'n', n)::text;
+    END IF;
+    PERFORM pg_notify('healthcare_changes', payload);
+    RETURN NULL;
+END
+$$;
+
+DO $$
+DECLARE
+    t record;
+BEGIN
+    FOR t IN SELECT * FROM (VALUES
+        ('doctor_schema', 'patients', 'patient_id'),
+        ('doctor_schema', 'medical_records', 'record_id'),
+        ('patient_schema', 'patients', 'patient_id'),
+        ('patient_schema', 'medical_records', 'record_id'),
+        ('admin_schema', 'patients', 'patient_id'),
+        ('admin_schema', 'medical_records', 'record_id'),
+        ('admin_schema', 'doctors', 'doctor_id'),
+        ('admin_schema', 'hospitals', 'hospital_id')
+    ) AS v(schema_name, table_name, pk)
+    LOOP
+        EXECUTE format('DROP TRIGGER IF EXISTS healthcare_change_insert ON %I.%I', t.schema_name, t.table_name);
+        EXECUTE format('DROP TRIGGER IF EXISTS healthcare_change_update ON %I.%I', t.schema_name, t.table_name);
+        EXECUTE format('DROP TRIGGER IF EXISTS healthcare_change_delete ON %I.%I', t.schema_name, t.table_name);
+        EXECUTE format('CREATE TRIGGER healthcare_change_insert AFTER INSERT ON %I.%I'
+                       ' REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT'
+                       ' EXECUTE FUNCTION public.healthcare_notify_change(%L)',
+                       t.schema_name, t.table_name, t.pk);
+        EXECUTE format('CREATE TRIGGER healthcare_change_update AFTER UPDATE ON %I.%I'
+                       ' REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT'
+                       ' EXECUTE FUNCTION public.healthcare_notify_change(%L)',
+                       t.schema_name, t.table_name, t.pk);
+        EXECUTE format('CREATE TRIGGER healthcare_change_delete AFTER DELETE ON %I.%I'
+                       ' REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT'
+                       ' EXECUTE FUNCTION public.healthcare_notify_change(%L)',
+                       t.schema_name, t.table_name, t.pk);
+    END LOOP;
+END
+$$;
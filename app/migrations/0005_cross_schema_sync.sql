@@ -0,0 +1,85 @@
+-- Cross-schema sync (sync.py): patients and medical_records exist once per
+-- schema (doctor_schema is canonical, patient_schema and admin_schema hold
+-- copies). A write to any copy is fanned out to the others by these
+-- statement-level triggers, in the same transaction, as one set-based
+-- upsert / delete per copy and statement (a 10,000-row COPY batch costs two
+-- statements, not 20,000). The copies already share their id sequences
+-- (LIKE public... INCLUDING ALL), so ids never collide.
+--
+-- The writes the triggers make don't fan out again (pg_trigger_depth), and a
+-- transaction can switch fan-out off with set_config('healthcare.sync',
+-- 'off', true), which sync.repair does while it copies chunks itself.
+-- Rows written before this migration are brought in line by
+-- "python sync.py repair" (run "python sync.py verify" first).
+
+CREATE OR REPLACE FUNCTION public.healthcare_sync_copies() RETURNS trigger
+LANGUAGE plpgsql SECURITY DEFINER SET search_path = pg_catalog, public AS $$
+DECLARE
+    pk text := TG_ARGV[0];
+    cols text;
+    sets text;
+    target text;
+    i int;
+BEGIN
+    IF pg_trigger_depth() > 1 OR current_setting('healthcare.sync', true) = 'off' THEN
+        RETURN NULL;
+    END IF;
+    SELECT string_agg(quote_ident(attname), ', ' ORDER BY attnum),
+           string_agg(format('%I = EXCLUDED.%I', attname, attname), ', ' ORDER BY attnum)
+      INTO cols, sets
+      FROM pg_attribute
+     WHERE attrelid = TG_RELID AND attnum > 0 AND NOT attisdropped;
+    FOR i IN 1 .. TG_NARGS - 1 LOOP
+        target := TG_ARGV[i];
+        IF TG_OP = 'DELETE' THEN
+            EXECUTE format('DELETE FROM %I.%I c USING old_rows o WHERE c.%I = o.%I',
+                           target, TG_TABLE_NAME, pk, pk);
+        ELSIF TG_OP = 'UPDATE' THEN
+            -- rows whose primary key itself changed
+            EXECUTE format('DELETE FROM %I.%I c WHERE c.%I IN'
+                           ' (SELECT %I FROM old_rows EXCEPT SELECT %I FROM new_rows)',
+                           target, TG_TABLE_NAME, pk, pk, pk);
+        END IF;
+        IF TG_OP <> 'DELETE' THEN
+            EXECUTE format('INSERT INTO %1$I.%2$I AS c (%3$s) SELECT %3$s FROM new_rows'
+                           ' ON CONFLICT (%4$I) DO UPDATE SET %5$s'
+                           ' WHERE (c.*) IS DISTINCT FROM (EXCLUDED.*)',
+                           target, TG_TABLE_NAME, cols, pk, sets);
+        END IF;
+    END LOOP;
+    RETURN NULL;
+END
+$$;
+
+DO $$
+DECLARE
+    t record;
+    copies text;
+BEGIN
+    FOR t IN SELECT s.schema_name, v.table_name, v.pk
+               FROM (VALUES ('patients', 'patient_id'), ('medical_records', 'record_id'))
+                    AS v(table_name, pk)
+              CROSS JOIN (VALUES ('doctor_schema'), ('patient_schema'), ('admin_schema'))
+                    AS s(schema_name)
+    LOOP
+        SELECT string_agg(quote_literal(o), ', ') INTO copies
+          FROM unnest(ARRAY['doctor_schema', 'patient_schema', 'admin_schema']) AS o
+         WHERE o <> t.schema_name;
+        EXECUTE format('DROP TRIGGER IF EXISTS healthcare_sync_insert ON %I.%I', t.schema_name, t.table_name);
+        EXECUTE format('DROP TRIGGER IF EXISTS healthcare_sync_update ON %I.%I', t.schema_name, t.table_name);
+        EXECUTE format('DROP TRIGGER IF EXISTS healthcare_sync_delete ON %I.%I', t.schema_name, t.table_name);
+        EXECUTE format('CREATE TRIGGER healthcare_sync_insert AFTER INSERT ON %I.%I'
+                       ' REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT'
+                       ' EXECUTE FUNCTION public.healthcare_sync_copies(%L, %s)',
+                       t.schema_name, t.table_name, t.pk, copies);
+        EXECUTE format('CREATE TRIGGER healthcare_sync_update AFTER UPDATE ON %I.%I'
+                       ' REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT'
+                       ' EXECUTE FUNCTION public.healthcare_sync_copies(%L, %s)',
+                       t.schema_name, t.table_name, t.pk, copies);
+        EXECUTE format('CREATE TRIGGER healthcare_sync_delete AFTER DELETE ON %I.%I'
+                       ' REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT'
+                       ' EXECUTE FUNCTION public.healthcare_sync_copies(%L, %s)',
+                       t.schema_name, t.table_name, t.pk, copies);
+    END LOOP;
+END
+$$;
@@ -0,0 +1,447 @@
+# rollups.py
+#
+# Daily KPI rollups for the admin dashboard, kept in admin_schema:
+#
+#   rollup_hospital_daily   (day, hospital_id, ...)
+#   rollup_doctor_daily     (day, doctor_id, ...)
+#   rollup_condition_daily  (day, medical_condition, ...)
+#
+# each holding admissions, billing sum and length-of-stay count / sum / sum of
+# squares / min / max (enough for averages and standard deviations).
+#
+# Refreshes are incremental: rollup_watermarks stores the highest
+# medical_records primary key already folded in, and a refresh aggregates only
+# the rows above it and upserts the deltas. Any write path (the doctor/admin
+# helpers, bulk_load, other jobs) is picked up, because the watermark is on
+# the table itself. To get a safe upper bound, the refresh briefly takes a
+# SHARE lock on every copy of medical_records (db.synced_copies): inserts
+# made in another schema reach this copy through the migration-0005 fan-out,
+# at the end of their statement and long after drawing their ids, so only
+# the lock on the table they write into waits for them. Once all in-flight
+# inserts have finished, every id at or below max(id) is committed, and later
+# inserts draw higher ids.
+#
+# NULL group keys are stored as 0 / '' and a NULL admission date as
+# -infinity, so they still count and still upsert cleanly.
+#
+# Because of that lock, refreshes never run on a page render: the dashboard
+# only reads status() and kpis(). They run from the command line (cron, after
+# bulk loads) or from the background refresher (start_refresher), which
+# refreshes every REFRESH_INTERVAL seconds and when asked (request_refresh).
+#
+#   python rollups.py create      # DDL (run as the schema owner)
+#   python rollups.py refresh     # fold in new records (cron / after loads)
+#   python rollups.py watch       # refresh every --interval seconds
+#   python rollups.py rebuild     # recompute everything from scratch
+#   python rollups.py status
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+from sqlalchemy import text
+from sqlalchemy.sql import sqltypes
+
+import db
+
+SOURCE_SCHEMA = "admin_schema"
+SOURCE_TABLE = "medical_records"
+WATERMARK_KEY = f"{SOURCE_SCHEMA}.{SOURCE_TABLE}"
+LOCK_TIMEOUT = "2s"         # give up (and serve slightly stale data) after this
+DEFAULT_MAX_AGE = 300       # seconds, for refresh_if_stale()
+# Background refresher period in seconds; 0 = no refresher in this process
+# (run "python rollups.py watch" or cron instead, e.g. with several workers).
+REFRESH_INTERVAL = float(os.environ.get("ROLLUP_REFRESH_INTERVAL", DEFAULT_MAX_AGE))
+
+# rollup name -> (group column, SQL type, value used for NULL)
+ROLLUPS = {
+    "hospital":  ("hospital_id", "integer", "0"),
+    "doctor":    ("doctor_id", "integer", "0"),
+    "condition": ("medical_condition", "text", "''"),
+}
+ROLLUP_KEY_TYPES = {"hospital": sqltypes.Integer, "doctor": sqltypes.Integer,
+                    "condition": sqltypes.Text}
+
+
+def rollup_table(name: str):
+    return f"rollup_{name}_daily"
+
+
+# =============================================================================
+# 1. DDL
+# =============================================================================
+
+def ddl():
+    """
+    Returns the CREATE statements for the rollup and watermark tables.
+    """
+    statements = []
+    for name, (key, sql_type, _) in ROLLUPS.items():
+        statements.append(f"""
+        CREATE TABLE IF NOT EXISTS {SOURCE_SCHEMA}.{rollup_table(name)} (
+            day          date    NOT NULL,
+            {key}        {sql_type} NOT NULL,
+            admissions   bigint  NOT NULL,
+            billing_sum  numeric NOT NULL,
+            stay_count   bigint  NOT NULL,
+            stay_sum     bigint  NOT NULL,
+            stay_sq_sum  numeric NOT NULL,
+            stay_min     integer,
+            stay_max     integer,
+            PRIMARY KEY (day, {key})
+        )""")
+    statements.append(f"""
+        CREATE TABLE IF NOT EXISTS {SOURCE_SCHEMA}.rollup_watermarks (
+            source        text PRIMARY KEY,
+            last_id       bigint NOT NULL DEFAULT 0,
+            refreshed_at  timestamptz
+        )""")
+    statements.append(
+        "GRANT SELECT, INSERT, UPDATE, DELETE ON "
+        + ", ".join(f"{SOURCE_SCHEMA}.{rollup_table(n)}" for n in ROLLUPS)
+        + f", {SOURCE_SCHEMA}.rollup_watermarks TO admin_user"
+    )
+    return statements
+
+
+def create_tables(bind=None):
+    """
+    Creates the rollup tables. Needs CREATE on admin_schema, so by default it
+    runs on db.engine (the owner connection), not as admin_user.
+    """
+    with (bind or db.engine).begin() as conn:
+        for statement in ddl():
+            conn.execute(text(statement))
+
+
+# =============================================================================
+# 2. Refresh
+# =============================================================================
+
+def _source_pk():
+    table = db.get_table(SOURCE_SCHEMA, SOURCE_TABLE)
+    (pk,) = table.primary_key.columns
+    return pk.name
+
+
+def _upsert_sql(name: str, pk: str):
+    key, _, null_value = ROLLUPS[name]
+    target = f"{SOURCE_SCHEMA}.{rollup_table(name)}"
+    return f"""
+    INSERT INTO {target} AS r (
+        day, {key}, admissions, billing_sum,
+        stay_count, stay_sum, stay_sq_sum, stay_min, stay_max)
+    SELECT coalesce(date_of_admission, '-infinity'::date),
+           coalesce({key}, {null_value}),
+           count(*),
+           coalesce(sum(billing_amount), 0),
+           count(length_of_stay),
+           coalesce(sum(length_of_stay), 0),
+           coalesce(sum(length_of_stay::numeric * length_of_stay), 0),
+           min(length_of_stay),
+           max(length_of_stay)
+    FROM {SOURCE_SCHEMA}.{SOURCE_TABLE}
+    WHERE {pk} > :lo AND {pk} <= :hi
+    GROUP BY 1, 2
+    ON CONFLICT (day, {key}) DO UPDATE SET
+        admissions  = r.admissions  + EXCLUDED.admissions,
+        billing_sum = r.billing_sum + EXCLUDED.billing_sum,
+        stay_count  = r.stay_count  + EXCLUDED.stay_count,
+        stay_sum    = r.stay_sum    + EXCLUDED.stay_sum,
+        stay_sq_sum = r.stay_sq_sum + EXCLUDED.stay_sq_sum,
+        stay_min    = least(r.stay_min, EXCLUDED.stay_min),
+        stay_max    = greatest(r.stay_max, EXCLUDED.stay_max)
+    """
+
+
+def _safe_horizon(pk: str):
+    # SHARE conflicts with the ROW EXCLUSIVE lock every INSERT holds on the
+    # copy it writes into, so acquiring it on every copy waits for in-flight
+    # inserts wherever they started; max(pk) is then final. The other copies
+    # belong to other roles: this runs on the owner engine. Copies are locked
+    # canonical copy first; a writer that started in another copy can
+    # deadlock with that, and as the refresh waited first, PostgreSQL aborts
+    # the refresh (an OperationalError, like the lock timeout).
+    copies = ", ".join(f"{s}.{SOURCE_TABLE}" for s in db.synced_copies(SOURCE_TABLE))
+    with db.engine.connect() as conn:
+        conn.execute(text(f"SET LOCAL lock_timeout = '{LOCK_TIMEOUT}'"))
+        conn.execute(text(f"LOCK TABLE {copies} IN SHARE MODE"))
+        hi = conn.execute(
+            text(f"SELECT coalesce(max({pk}), 0) FROM {SOURCE_SCHEMA}.{SOURCE_TABLE}")
+        ).scalar()
+        conn.commit()  # release the locks straight away
+    return hi
+
+
+def refresh():
+    """
+    Folds medical_records rows inserted since the watermark into every
+    rollup, in one transaction with the watermark update.
+    Returns {"from_id", "to_id", "rows", "seconds"}; rows is None if the
+    source was busy and the refresh was skipped.
+    """
+    started = time.perf_counter()
+    pk = _source_pk()
+    try:
+        hi = _safe_horizon(pk)
+    except db.exc.OperationalError:
+        return {"from_id": None, "to_id": None, "rows": None,
+                "seconds": time.perf_counter() - started}
+    with db.role_connection("admin_user", SOURCE_SCHEMA) as conn:
+        # Serialise concurrent refreshers on the watermark row.
+        conn.execute(text(
+            f"INSERT INTO {SOURCE_SCHEMA}.rollup_watermarks (source) VALUES (:s) "
+            f"ON CONFLICT (source) DO NOTHING"), {"s": WATERMARK_KEY})
+        lo = conn.execute(text(
+            f"SELECT last_id FROM {SOURCE_SCHEMA}.rollup_watermarks "
+            f"WHERE source = :s FOR UPDATE"), {"s": WATERMARK_KEY}).scalar()
+
+        rows = 0
+        if hi > lo:
+            rows = conn.execute(text(
+                f"SELECT count(*) FROM {SOURCE_SCHEMA}.{SOURCE_TABLE} "
+                f"WHERE {pk} > :lo AND {pk} <= :hi"), {"lo": lo, "hi": hi}).scalar()
+            for name in ROLLUPS:
+                conn.execute(text(_upsert_sql(name, pk)), {"lo": lo, "hi": hi})
+        conn.execute(text(
+            f"UPDATE {SOURCE_SCHEMA}.rollup_watermarks "
+            f"SET last_id = greatest(last_id, :hi), refreshed_at = now() "
+            f"WHERE source = :s"), {"hi": hi, "s": WATERMARK_KEY})
+        conn.commit()
+
+    for name in ROLLUPS:
+        db.invalidate_table(SOURCE_SCHEMA, rollup_table(name))
+    db.invalidate_table(SOURCE_SCHEMA, "rollup_watermarks")
+    return {"from_id": lo, "to_id": max(hi, lo), "rows": rows,
+            "seconds": time.perf_counter() - started}
+
+
+def rebuild():
+    """
+    Empties the rollups and the watermark, then refreshes from scratch.
+    """
+    with db.unit_of_work("admin_user", SOURCE_SCHEMA) as uow:
+        for name in ROLLUPS:
+            uow.execute(f"DELETE FROM {SOURCE_SCHEMA}.{rollup_table(name)}")
+        uow.execute(f"DELETE FROM {SOURCE_SCHEMA}.rollup_watermarks WHERE source = :s",
+                    s=WATERMARK_KEY)
+    return refresh()
+
+
+def status():
+    """
+    Staleness of the rollups: the watermark, when it was last refreshed, and
+    how many newer source records are not yet included.
+    """
+    pk = _source_pk()
+    rows = db._execute_with_role(
+        f"""
+        SELECT w.last_id, w.refreshed_at,
+               (SELECT coalesce(max({pk}), 0) FROM {SOURCE_SCHEMA}.{SOURCE_TABLE}) AS max_id,
+               extract(epoch FROM now() - w.refreshed_at) AS age_seconds
+        FROM (SELECT 1) one
+        LEFT JOIN {SOURCE_SCHEMA}.rollup_watermarks w ON w.source = :s
+        """,
+        role="admin_user", schema=SOURCE_SCHEMA, s=WATERMARK_KEY,
+    )
+    row = rows[0]
+    last_id = row["last_id"] or 0
+    return {
+        "last_id": last_id,
+        "max_id": row["max_id"],
+        "pending_records": max(0, row["max_id"] - last_id),
+        "refreshed_at": row["refreshed_at"],
+        "age_seconds": float(row["age_seconds"]) if row["age_seconds"] is not None else None,
+    }
+
+
+def refresh_if_stale(max_age: float = DEFAULT_MAX_AGE):
+    """
+    Refreshes when there are pending records and the last refresh is older
+    than max_age seconds (or never happened). Returns the status afterwards.
+    """
+    current = status()
+    age = current["age_seconds"]
+    if current["pending_records"] and (age is None or age >= max_age):
+        refresh()
+        current = status()
+    return current
+
+
+class Refresher:
+    """
+    A background thread that runs refresh_if_stale() every `interval`
+    seconds, or at once after request().
+    """
+
+    def __init__(self, interval: float = REFRESH_INTERVAL):
+        self.interval = interval
+        self.last = None            # last refresh_if_stale() result or error
+        self._wake = threading.Event()
+        self._force = False
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """
+        Starts the thread (idempotent). Returns whether it is running.
+        """
+        with self._lock:
+            if not self.running and self.interval > 0:
+                self._thread = threading.Thread(
+                    target=self._run, name="rollup-refresher", daemon=True)
+                self._thread.start()
+        return self.running
+
+    def request(self):
+        """
+        Asks for a refresh now, whatever the age. Returns without waiting.
+        """
+        self._force = True
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            force, self._force = self._force, False
+            try:
+                self.last = refresh_if_stale(0 if force else DEFAULT_MAX_AGE)
+            except Exception as e:
+                self.last = e
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+
+refresher = Refresher()
+
+
+def start_refresher():
+    """
+    Starts the background refresher unless ROLLUP_REFRESH_INTERVAL=0; cheap
+    to call on every Streamlit rerun. Returns whether it is running.
+    """
+    return refresher.start()
+
+
+def request_refresh():
+    """
+    Has the background refresher (started if needed) refresh now. Returns
+    whether one is running; the page shows the result on a later render.
+    """
+    running = refresher.start()
+    refresher.request()
+    return running
+
+
+# =============================================================================
+# 3. Dashboard reads
+# =============================================================================
+
+def kpis(rollup: str, start=None, end=None, time_bucket: str = None,
+         group: bool = True, order_by: str = None, limit: int = 1000):
+    """
+    Hospital / doctor / condition KPIs served from a rollup table as a typed
+    DataFrame: admissions, billing_sum, avg_billing, avg_stay, stddev_stay,
+    min_stay, max_stay.
+
+    - rollup: "hospital", "doctor" or "condition".
+    - start / end: admission-date range (inclusive).
+    - time_bucket: day / week / month / quarter / year, or None for totals.
+    - group: False sums over all hospitals / doctors / conditions.
+    - order_by: output column, "-col" for descending.
+    """
+    key, _, _ = ROLLUPS[rollup]
+    table = rollup_table(rollup)
+    dims = []
+    if time_bucket:
+        if time_bucket not in db.TIME_BUCKETS:
+            raise ValueError(f"time_bucket must be one of {db.TIME_BUCKETS}")
+        dims.append(f"date_trunc('{time_bucket}', day)::date AS {time_bucket}")
+    if group:
+        dims.append(key)
+    where, params = [], {}
+    if start is not None:
+        where.append("day >= :start")
+        params["start"] = start
+    if end is not None:
+        where.append("day <= :end")
+        params["end"] = end
+    columns = ([time_bucket] if time_bucket else []) + ([key] if group else []) + [
+        "admissions", "billing_sum", "avg_billing", "avg_stay",
+        "stddev_stay", "min_stay", "max_stay"]
+    order = ", ".join(str(i + 1) for i in range(len(dims))) or None
+    if order_by:
+        name = order_by.lstrip("-")
+        if name not in columns:
+            raise ValueError(f"Cannot order by {order_by!r}")
+        order = f"{name} {'DESC' if order_by.startswith('-') else 'ASC'}"
+
+    sql = f"""
+    SELECT {''.join(d + ', ' for d in dims)}
+           sum(admissions)::bigint AS admissions,
+           sum(billing_sum)::float8 AS billing_sum,
+           (sum(billing_sum) / nullif(sum(admissions), 0))::float8 AS avg_billing,
+           (sum(stay_sum)::numeric / nullif(sum(stay_count), 0))::float8 AS avg_stay,
+           sqrt(greatest(
+               (sum(stay_sq_sum) - sum(stay_sum)::numeric ^ 2 / nullif(sum(stay_count), 0))
+               / nullif(sum(stay_count) - 1, 0), 0))::float8 AS stddev_stay,
+           min(stay_min) AS min_stay,
+           max(stay_max) AS max_stay
+    FROM {SOURCE_SCHEMA}.{table}
+    {'WHERE ' + ' AND '.join(where) if where else ''}
+    {'GROUP BY ' + ', '.join(str(i + 1) for i in range(len(dims))) if dims else ''}
+    {'ORDER BY ' + order if order else ''}
+    LIMIT {int(limit)}
+    """
+    types = {
+        "admissions": sqltypes.BigInteger, "min_stay": sqltypes.Integer,
+        "max_stay": sqltypes.Integer, key: ROLLUP_KEY_TYPES[rollup],
+    }
+    if time_bucket:
+        types[time_bucket] = sqltypes.Date
+    for name in ("billing_sum", "avg_billing", "avg_stay", "stddev_stay"):
+        types[name] = sqltypes.Float
+    stmt = text(sql).columns(**{c: types[c] for c in columns})
+    return db.cached_read(
+        "admin_user", SOURCE_SCHEMA, [table], (sql, db._freeze(params)),
+        lambda: db.fetch_dataframe(stmt, "admin_user", SOURCE_SCHEMA, **params),
+    )
+
+
+# =============================================================================
+# 4. Command line
+# =============================================================================
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Maintain the admin KPI rollups.")
+    parser.add_argument("command", choices=["create", "refresh", "rebuild", "status", "watch"])
+    parser.add_argument("--interval", type=float, default=DEFAULT_MAX_AGE,
+                        help="watch: seconds between refreshes")
+    args = parser.parse_args(argv)
+
+    if args.command == "watch":
+        while True:
+            print(json.dumps(refresh(), default=str), flush=True)
+            time.sleep(args.interval)
+
+    if args.command == "create":
+        create_tables()
+        result = {"created": [rollup_table(n) for n in ROLLUPS] + ["rollup_watermarks"]}
+    elif args.command == "refresh":
+        result = refresh()
+    elif args.command == "rebuild":
+        result = rebuild()
+    else:
+        result = status()
+    print(json.dumps(result, indent=2, default=str))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
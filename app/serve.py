@@ -0,0 +1,105 @@
+# serve.py
+#
+# Multi-process deployment: runs N Streamlit servers for app.py on
+# consecutive ports, to put behind a load balancer (with sticky sessions:
+# Streamlit keeps session state in the process).
+#
+# Before starting the workers it prepares what they all share, so none of
+# them does it N times:
+#   - the reflected schemas (written to the on-disk schema cache, which the
+#     workers then trust without a catalog query: SCHEMA_CACHE_TRUST=1),
+#   - the reference-table snapshots in REFERENCE_DIR (db.reference_store),
+#     which every worker memory-maps,
+# and it checks the connection budget against the server: each worker gets
+# DB_MAX_CONNECTIONS // workers connections (db.connection_budget).
+#
+#   python serve.py --workers 4 --port 8501 --max-connections 80
+#   python serve.py --workers 4 --check      # prepare and print the plan only
+
+import argparse
+import json
+import os
+import signal
+import subprocess
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_REFERENCE_DIR = "/dev/shm/healthcare-ref" if os.path.isdir("/dev/shm") else None
+
+
+def worker_env(workers: int, max_connections: int, reference_dir: str):
+    """
+    Environment shared by the workers (and used by this process while
+    preparing).
+    """
+    env = dict(os.environ)
+    env["WEB_CONCURRENCY"] = str(workers)
+    env["DB_MAX_CONNECTIONS"] = str(max_connections)
+    if reference_dir:
+        env["REFERENCE_DIR"] = reference_dir
+    return env
+
+
+def prepare(env: dict):
+    """
+    Warms the schema cache and the reference snapshots and checks the
+    connection budget. Returns a summary dict.
+    """
+    os.environ.update(env)
+    sys.path.insert(0, HERE)
+    import db
+
+    db.load_schemas()
+    summary = {"budget": db.connection_budget(), "server": db.check_connection_budget()}
+    if db.reference_store.enabled:
+        summary["reference"] = db.reference_store.warm()
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run several Streamlit workers for app.py.")
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("WEB_CONCURRENCY", 2)))
+    parser.add_argument("--port", type=int, default=8501, help="port of the first worker")
+    parser.add_argument("--max-connections", type=int,
+                        default=int(os.environ.get("DB_MAX_CONNECTIONS", 0)) or 50,
+                        help="database connections for all workers together")
+    parser.add_argument("--reference-dir",
+                        default=os.environ.get("REFERENCE_DIR", DEFAULT_REFERENCE_DIR),
+                        help="shared reference snapshots (tmpfs recommended)")
+    parser.add_argument("--check", action="store_true", help="prepare and print the plan only")
+    args = parser.parse_args(argv)
+
+    env = worker_env(args.workers, args.max_connections, args.reference_dir)
+    summary = prepare(env)
+    summary["ports"] = list(range(args.port, args.port + args.workers))
+    print(json.dumps(summary, indent=2, default=str), file=sys.stderr)
+    if not summary["server"]["fits"]:
+        print("warning: the connection budget exceeds what the server allows",
+              file=sys.stderr)
+    if args.check:
+        return 0
+
+    env["SCHEMA_CACHE_TRUST"] = "1"  # prepare() just wrote the current cache
+    procs = [
+        subprocess.Popen(
+            [sys.executable, "-m", "streamlit", "run", os.path.join(HERE, "app.py"),
+             "--server.port", str(port), "--server.headless", "true"],
+            env=env,
+        )
+        for port in summary["ports"]
+    ]
+
+    def stop(signum, frame):
+        for p in procs:
+            p.terminate()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    status = 0
+    for p in procs:
+        status = max(status, p.wait())
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
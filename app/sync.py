@@ -0,0 +1,220 @@
+# sync.py
+#
+# Verification and repair of the cross-schema copies of patients and
+# medical_records (db.SYNCED_TABLES). Migration 0005 keeps the copies
+# identical as they are written; this checks that they are, and fixes the
+# rows that aren't (e.g. written before the migration, or with the fan-out
+# switched off), without a bulk resync.
+#
+# verify() walks each table in primary-key ranges of CHUNK_SIZE ids. For each
+# range, one query computes (row count, md5 of the rows in key order) in
+# every schema, so all copies are compared within the same snapshot. Plain
+# SELECTs: nothing is locked against writers.
+#
+# repair() re-checks each mismatched range and fixes it in a short
+# transaction of its own: rows that only a copy has are adopted into the
+# canonical copy (or, with prune, deleted), then the canonical rows are
+# upserted into every copy, touching only rows that differ. Row locks wait
+# at most LOCK_TIMEOUT; a busy range is skipped and reported, to be retried
+# by the next run. Rows copied into admin_schema.medical_records below the
+# rollup watermark aren't picked up by a rollup refresh: run
+# "python rollups.py rebuild" after a repair that copied records.
+#
+#   python sync.py verify                    # exit status 1 if copies differ
+#   python sync.py verify --table patients --chunk-size 20000
+#   python sync.py repair                    # adopt copy-only rows
+#   python sync.py repair --prune            # delete copy-only rows instead
+
+import argparse
+import json
+import sys
+import time
+
+from sqlalchemy import exc, text
+
+import db
+
+CHUNK_SIZE = 5000           # primary-key values per range
+LOCK_TIMEOUT = "2s"
+
+
+def _columns(table_name: str):
+    return [c.name for c in db.get_table(db.CANONICAL_SCHEMA, table_name).c]
+
+
+def _qualified(schema: str, table_name: str):
+    return f'"{schema}"."{table_name}"'
+
+
+# =============================================================================
+# 1. Verify
+# =============================================================================
+
+def _checksum_sql(table_name: str):
+    pk = db.SYNCED_TABLES[table_name]
+    row = ", ".join(f'"{c}"' for c in _columns(table_name))
+    return " UNION ALL ".join(
+        f"SELECT '{schema}' AS schema_name, count(*) AS row_count,"
+        f" coalesce(md5(string_agg(md5(CAST(ROW({row}) AS text)), '' ORDER BY \"{pk}\")), '')"
+        f" AS digest FROM {_qualified(schema, table_name)}"
+        f' WHERE "{pk}" >= :lo AND "{pk}" < :hi'
+        for schema in db.synced_copies(table_name)
+    )
+
+
+def _key_range(conn, table_name: str):
+    pk = db.SYNCED_TABLES[table_name]
+    bounds = conn.execute(text(" UNION ALL ".join(
+        f'SELECT min("{pk}"), max("{pk}") FROM {_qualified(schema, table_name)}'
+        for schema in db.synced_copies(table_name)
+    ))).fetchall()
+    lows = [lo for lo, _ in bounds if lo is not None]
+    highs = [hi for _, hi in bounds if hi is not None]
+    return (min(lows), max(highs)) if lows else (None, None)
+
+
+def _check_range(conn, sql: str, lo: int, hi: int):
+    # {schema: (row count, digest)} for one key range.
+    return {s: (n, d) for s, n, d in conn.execute(text(sql), {"lo": lo, "hi": hi})}
+
+
+def verify(tables=None, chunk_size: int = CHUNK_SIZE, pause: float = 0, progress=None):
+    """
+    Compares every copy of each synced table (default: all) range by range.
+    - pause: seconds to sleep between ranges, to spread the load.
+    - progress: called with (table, lo, hi, matched) after each range.
+    Returns {table: {"ranges", "rows": {schema: n}, "mismatched": [{"lo",
+    "hi", "rows": {schema: n}}], "seconds"}}.
+    """
+    report = {}
+    for table_name in tables or db.SYNCED_TABLES:
+        started = time.perf_counter()
+        sql = _checksum_sql(table_name)
+        schemas = db.synced_copies(table_name)
+        result = {"ranges": 0, "rows": dict.fromkeys(schemas, 0), "mismatched": []}
+        with db.engine.connect() as conn:
+            first, last = _key_range(conn, table_name)
+            conn.rollback()
+            lo = first
+            while lo is not None and lo <= last:
+                hi = lo + chunk_size
+                sums = _check_range(conn, sql, lo, hi)
+                conn.rollback()  # one short snapshot per range
+                for schema in schemas:
+                    result["rows"][schema] += sums[schema][0]
+                matched = len(set(sums.values())) == 1
+                if not matched:
+                    result["mismatched"].append(
+                        {"lo": lo, "hi": hi, "rows": {s: n for s, (n, _) in sums.items()}})
+                result["ranges"] += 1
+                if progress:
+                    progress(table_name, lo, hi, matched)
+                lo = hi
+                if pause:
+                    time.sleep(pause)
+        result["seconds"] = round(time.perf_counter() - started, 3)
+        report[table_name] = result
+    return report
+
+
+# =============================================================================
+# 2. Repair
+# =============================================================================
+
+def _repair_range(conn, table_name: str, lo: int, hi: int, prune: bool):
+    pk = db.SYNCED_TABLES[table_name]
+    cols = ", ".join(f'"{c}"' for c in _columns(table_name))
+    sets = ", ".join(f'"{c}" = EXCLUDED."{c}"' for c in _columns(table_name))
+    canonical, *others = db.synced_copies(table_name)
+    canon = _qualified(canonical, table_name)
+    in_range = f'r."{pk}" >= :lo AND r."{pk}" < :hi'
+    params = {"lo": lo, "hi": hi}
+    counts = {"adopted": 0, "pruned": 0, "copied": 0}
+    # This transaction copies the rows itself: no trigger fan-out.
+    conn.execute(text("SELECT set_config('healthcare.sync', 'off', true),"
+                      " set_config('lock_timeout', :timeout, true)"), {"timeout": LOCK_TIMEOUT})
+    for schema in others:
+        copy = _qualified(schema, table_name)
+        missing = f'NOT EXISTS (SELECT 1 FROM {canon} c WHERE c."{pk}" = r."{pk}")'
+        if prune:
+            counts["pruned"] += conn.execute(text(
+                f"DELETE FROM {copy} r WHERE {in_range} AND {missing}"), params).rowcount
+        else:
+            counts["adopted"] += conn.execute(text(
+                f"INSERT INTO {canon} ({cols}) SELECT {cols} FROM {copy} r"
+                f" WHERE {in_range} AND {missing} ON CONFLICT (\"{pk}\") DO NOTHING"),
+                params).rowcount
+    for schema in others:
+        counts["copied"] += conn.execute(text(
+            f"INSERT INTO {_qualified(schema, table_name)} AS c ({cols})"
+            f" SELECT {cols} FROM {canon} r WHERE {in_range}"
+            f' ON CONFLICT ("{pk}") DO UPDATE SET {sets}'
+            f" WHERE (c.*) IS DISTINCT FROM (EXCLUDED.*)"), params).rowcount
+    return counts
+
+
+def repair(tables=None, chunk_size: int = CHUNK_SIZE, prune: bool = False,
+           pause: float = 0, progress=None):
+    """
+    Verifies, then brings every mismatched range in line with the canonical
+    copy, one short transaction per range (see the module notes).
+    - prune: delete rows that only a copy has, instead of adopting them.
+    Returns {table: {"ranges", "mismatched", "repaired", "skipped": [{"lo",
+    "hi", "error"}], "adopted", "pruned", "copied"}}.
+    """
+    report = {}
+    checked = verify(tables, chunk_size, pause)
+    for table_name, found in checked.items():
+        sql = _checksum_sql(table_name)
+        result = {"ranges": found["ranges"], "mismatched": len(found["mismatched"]),
+                  "repaired": 0, "skipped": [], "adopted": 0, "pruned": 0, "copied": 0}
+        for chunk in found["mismatched"]:
+            lo, hi = chunk["lo"], chunk["hi"]
+            try:
+                with db.engine.begin() as conn:
+                    if len(set(_check_range(conn, sql, lo, hi).values())) == 1:
+                        continue  # caught up since verify() looked at it
+                    for key, n in _repair_range(conn, table_name, lo, hi, prune).items():
+                        result[key] += n
+                result["repaired"] += 1
+            except exc.OperationalError as e:
+                result["skipped"].append({"lo": lo, "hi": hi, "error": str(e.orig).strip()})
+            if progress:
+                progress(table_name, lo, hi, result)
+            if pause:
+                time.sleep(pause)
+        if result["repaired"]:
+            db.invalidate_table(db.CANONICAL_SCHEMA, table_name)  # and its copies
+        report[table_name] = result
+    return report
+
+
+# =============================================================================
+# 3. Command line
+# =============================================================================
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Verify / repair the cross-schema copies of patients and medical_records.")
+    parser.add_argument("command", choices=["verify", "repair"])
+    parser.add_argument("--table", action="append", choices=list(db.SYNCED_TABLES),
+                        help="only this table (repeatable; default: all)")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    parser.add_argument("--pause", type=float, default=0,
+                        help="seconds to sleep between ranges")
+    parser.add_argument("--prune", action="store_true",
+                        help="repair: delete rows only a copy has, instead of adopting them")
+    args = parser.parse_args(argv)
+
+    if args.command == "verify":
+        result = verify(args.table, args.chunk_size, args.pause)
+        status = 1 if any(r["mismatched"] for r in result.values()) else 0
+    else:
+        result = repair(args.table, args.chunk_size, args.prune, args.pause)
+        status = 1 if any(r["skipped"] for r in result.values()) else 0
+    print(json.dumps(result, indent=2, default=str))
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
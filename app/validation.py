@@ -0,0 +1,368 @@
+# validation.py
+#
+# Batch validation of incoming rows, before they reach the database.
+#
+# A Validator is built once per table from its reflected columns and checks
+# a whole batch (DataFrame, Arrow batch or list of dicts) column by column
+# with pandas / NumPy operations, no Python loop over rows:
+#   - type:       the value converts to the column's type (integer in range,
+#                 number within the numeric precision, parseable date, ...);
+#   - required:   NOT NULL columns without a default are present and not blank;
+#   - enum:       ENUM_VALUES (admission_type, gender, blood_type) and any
+#                 reflected Enum type;
+#   - range:      RANGES (no negative ages, bills or stays);
+#   - order:      discharge_date >= date_of_admission;
+#   - stay:       length_of_stay = discharge_date - date_of_admission (days);
+#   - foreign key: FOREIGN_KEYS columns (and reflected foreign keys) hold ids
+#                 that exist. Reference tables are checked against the cached
+#                 {id: name} maps (db.dimension_cache); patients against the
+#                 ids in the batch, fetched in one query, or for large batches
+#                 against a cached sorted id array.
+# The result holds a per-row error mask (one boolean column per check), the
+# typed frame and per-row messages. bulk_load.py uses it to reject bad rows
+# in one pass instead of paying a database error (and a savepoint split) per
+# row; app.py checks form submissions with the same rules.
+#
+#   python validation.py doctor_schema medical_records admissions.csv
+
+import argparse
+import json
+import sys
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import select
+from sqlalchemy.sql import sqltypes
+
+import db
+
+ENUM_VALUES = {
+    "admission_type": ("Emergency", "Elective", "Routine"),
+    "gender": ("Male", "Female", "Other"),
+    "blood_type": ("A+", "A-", "B+", "B-", "AB+", "AB-", "O+", "O-"),
+}
+
+# column -> (min, max), None = unbounded
+RANGES = {
+    "age": (0, 150),
+    "billing_amount": (0, None),
+    "length_of_stay": (0, None),
+    "room_number": (0, None),
+}
+
+# column -> referenced table (these columns carry no FOREIGN KEY constraint)
+FOREIGN_KEYS = {
+    "patient_id": "patients",
+    **{column: table for column, (table, _) in db.RECORD_DIMENSIONS.items()},
+}
+
+POINT_LOOKUP_MAX = 1000     # distinct ids checked with one query; more use the id set
+
+_INT_BOUNDS = {
+    sqltypes.SmallInteger: (-2 ** 15, 2 ** 15 - 1),
+    sqltypes.BigInteger: (-2 ** 63, 2 ** 63 - 1),
+    sqltypes.Integer: (-2 ** 31, 2 ** 31 - 1),
+}
+
+
+def _int_bounds(column_type):
+    for type_, bounds in _INT_BOUNDS.items():  # most specific first
+        if isinstance(column_type, type_):
+            return bounds
+    return _INT_BOUNDS[sqltypes.Integer]
+
+
+def _present(series):
+    # Not null and, for strings, not blank.
+    present = series.notna().to_numpy(dtype=bool)
+    if series.dtype == object or pd.api.types.is_string_dtype(series):
+        blank = series.map(lambda v: isinstance(v, str) and not v.strip(), na_action="ignore")
+        present = present & ~blank.fillna(False).to_numpy(dtype=bool)
+    return present
+
+
+def _coerce(series, column_type):
+    """
+    Converts a column to its pandas dtype (db.pandas_dtype); returns
+    (typed series, mask of present values that didn't convert).
+    """
+    present = _present(series)
+    if isinstance(column_type, sqltypes.Boolean):
+        # 1 / 0 hash equal to True / False, so they need no entries of their own.
+        truth = {True: True, False: False, "t": True, "f": False,
+                 "true": True, "false": False, "1": True, "0": False}
+        typed = series.map(lambda v: truth.get(v.lower() if isinstance(v, str) else v),
+                           na_action="ignore").astype("boolean")
+        return typed, present & typed.isna().to_numpy()
+    if isinstance(column_type, sqltypes.Integer):
+        num = pd.to_numeric(series.where(present), errors="coerce")
+        lo, hi = _int_bounds(column_type)
+        values = num.to_numpy(dtype="float64", na_value=np.nan)
+        with np.errstate(invalid="ignore"):
+            bad = present & (np.isnan(values) | (values % 1 != 0) | (values < lo) | (values > hi))
+        return num.where(~bad).astype("Int64"), bad
+    if isinstance(column_type, (sqltypes.Numeric, sqltypes.Float)):
+        num = pd.to_numeric(series.where(present), errors="coerce").astype("float64")
+        values = num.to_numpy()
+        bad = present & np.isnan(values)
+        precision, scale = getattr(column_type, "precision", None), getattr(column_type, "scale", None)
+        if precision and not isinstance(column_type, sqltypes.Float):
+            with np.errstate(invalid="ignore"):
+                bad |= present & (np.abs(values) >= 10.0 ** (precision - (scale or 0)))
+        return num.where(~bad), bad
+    if isinstance(column_type, (sqltypes.Date, sqltypes.DateTime)):
+        utc = isinstance(column_type, sqltypes.DateTime) and getattr(column_type, "timezone", False)
+        typed = pd.to_datetime(series.where(present), errors="coerce", utc=utc, format="mixed")
+        if isinstance(column_type, sqltypes.Date) and not isinstance(column_type, sqltypes.DateTime):
+            typed = typed.dt.normalize()
+        return typed, present & typed.isna().to_numpy()
+    return series.where(present, None), np.zeros(len(series), dtype=bool)
+
+
+class ValidationResult:
+    """
+    The outcome of Validator.validate for one batch.
+    - frame: the batch with every checked column converted to its dtype.
+    - mask: boolean DataFrame, one column per failed check ("column:check"),
+      True where the row fails it.
+    - valid: boolean array, True for rows that pass every check.
+    """
+
+    def __init__(self, frame, mask, messages):
+        self.frame = frame
+        self.mask = mask
+        self.valid = ~mask.to_numpy().any(axis=1) if len(mask.columns) else \
+            np.ones(len(frame), dtype=bool)
+        self._messages = messages
+
+    def errors(self):
+        """
+        Returns {row position: [messages]} for the rows that fail.
+        """
+        errors = {}
+        for name in self.mask.columns:
+            for i in np.flatnonzero(self.mask[name].to_numpy()):
+                errors.setdefault(int(i), []).append(self._messages[name])
+        return dict(sorted(errors.items()))
+
+    def summary(self):
+        """
+        Returns rows, valid, invalid and the number of failures per check.
+        """
+        counts = self.mask.sum()
+        return {
+            "rows": len(self.frame),
+            "valid": int(self.valid.sum()),
+            "invalid": int((~self.valid).sum()),
+            "checks": {name: int(n) for name, n in counts.items() if n},
+        }
+
+
+class Validator:
+    """
+    The checks for one table, derived from its reflected columns.
+    """
+
+    def __init__(self, schema: str, table_name: str, foreign_keys: bool = True):
+        self.schema = schema
+        self.table = db.get_table(schema, table_name)
+        self.foreign_keys = foreign_keys
+        pk = {c.name for c in self.table.primary_key.columns}
+        self.required = [
+            c.name for c in self.table.c
+            if not c.nullable and c.server_default is None and c.name not in pk
+        ]
+        self.references = {}
+        for c in self.table.c:
+            target = next((fk.column.table.name for fk in c.foreign_keys), None) \
+                or FOREIGN_KEYS.get(c.name)
+            if target and c.name not in pk and target != self.table.name:
+                self.references[c.name] = target
+
+    def validate(self, data, columns=None):
+        """
+        Checks a batch: a DataFrame, a pyarrow RecordBatch / Table, or a list
+        of dicts. columns: the columns being written (default: those in the
+        batch that belong to the table). Returns a ValidationResult.
+        """
+        frame = _as_frame(data, columns)
+        columns = [c for c in (columns or frame.columns) if c in self.table.c]
+        failed, messages = {}, {}
+
+        def fail(name, mask, message):
+            if mask.any():
+                failed[name] = mask
+                messages[name] = message
+
+        n = len(frame)
+        unknown = [c for c in frame.columns if c not in self.table.c]
+        if unknown:
+            fail("columns:unknown", np.ones(n, dtype=bool),
+                 f"unknown columns: {', '.join(map(str, unknown))}")
+        typed = {}
+        for name in columns:
+            column = self.table.c[name]
+            typed[name], bad = _coerce(frame[name], column.type)
+            fail(f"{name}:type", bad, f"{name}: not a valid {_type_name(column.type)}")
+        for name in self.required:
+            missing = ~_present(frame[name]) if name in frame else np.ones(n, dtype=bool)
+            fail(f"{name}:required", missing, f"{name}: required")
+        for name in columns:
+            values = typed[name]
+            allowed = ENUM_VALUES.get(name) or getattr(self.table.c[name].type, "enums", None)
+            if allowed:
+                fail(f"{name}:enum", (values.notna() & ~values.isin(allowed)).to_numpy(),
+                     f"{name}: must be one of {', '.join(allowed)}")
+            if name in RANGES:
+                lo, hi = RANGES[name]
+                out = np.zeros(n, dtype=bool)
+                if lo is not None:
+                    out |= (values < lo).fillna(False).to_numpy(dtype=bool)
+                if hi is not None:
+                    out |= (values > hi).fillna(False).to_numpy(dtype=bool)
+                bounds = f">= {lo}" if hi is None else f"between {lo} and {hi}"
+                fail(f"{name}:range", out, f"{name}: must be {bounds}")
+        if {"date_of_admission", "discharge_date"} <= typed.keys():
+            admitted, discharged = typed["date_of_admission"], typed["discharge_date"]
+            fail("discharge_date:order", (discharged < admitted).to_numpy(dtype=bool),
+                 "discharge_date: before date_of_admission")
+            if "length_of_stay" in typed:
+                days = (discharged - admitted).dt.days
+                stay = typed["length_of_stay"]
+                both = (days.notna() & stay.notna()).to_numpy()
+                wrong = np.zeros(n, dtype=bool)
+                wrong[both] = days.to_numpy()[both] != stay.to_numpy(dtype="float64",
+                                                                     na_value=np.nan)[both]
+                fail("length_of_stay:stay", wrong,
+                     "length_of_stay: doesn't match discharge_date - date_of_admission")
+        if self.foreign_keys:
+            for name, target in self.references.items():
+                if name in typed:
+                    fail(f"{name}:foreign_key", self._missing_ids(typed[name], target),
+                         f"{name}: no such {target[:-1] if target.endswith('s') else target}")
+        typed_frame = frame.assign(**typed) if typed else frame
+        return ValidationResult(typed_frame, pd.DataFrame(failed, index=frame.index), messages)
+
+    def _missing_ids(self, values, target: str):
+        present = values.notna().to_numpy()
+        ids = values.to_numpy(dtype="float64", na_value=np.nan)[present].astype("int64")
+        missing = np.zeros(len(values), dtype=bool)
+        if not len(ids):
+            return missing
+        known = known_ids(self.schema, target, np.unique(ids))
+        if known is None:
+            return missing  # can't be checked from here (patient_schema, RLS)
+        missing[present] = ~np.isin(ids, known)
+        return missing
+
+
+def _as_frame(data, columns=None):
+    if isinstance(data, pd.DataFrame):
+        return data
+    if hasattr(data, "to_pandas"):  # pyarrow RecordBatch / Table
+        return data.to_pandas(types_mapper=None)
+    return pd.DataFrame.from_records(list(data), columns=columns)
+
+
+def _type_name(column_type):
+    if isinstance(column_type, sqltypes.Integer):
+        return "integer"
+    if isinstance(column_type, (sqltypes.Numeric, sqltypes.Float)):
+        return "number"
+    if isinstance(column_type, sqltypes.DateTime):
+        return "timestamp"
+    if isinstance(column_type, sqltypes.Date):
+        return "date"
+    if isinstance(column_type, sqltypes.Boolean):
+        return "boolean"
+    return "value"
+
+
+def known_ids(schema: str, table_name: str, ids):
+    """
+    Returns the subset of ids (a NumPy array) that exist in table_name, or
+    None if it can't be read: reference tables come from db.dimension_cache,
+    others from `schema` (one query for up to POINT_LOOKUP_MAX ids, else the
+    whole id column, cached in db.read_cache until the table is written).
+    """
+    if table_name in {t for t, _ in db.RECORD_DIMENSIONS.values()}:
+        return np.fromiter(db.dimension_cache.mapping(table_name), dtype="int64")
+    if schema not in db.SCHEMA_ROLES or schema == "patient_schema" \
+            or table_name not in db.SCHEMA_TABLES.get(schema, ()):
+        return None
+    table = db.get_table(schema, table_name)
+    (pk,) = table.primary_key.columns
+    role = db.SCHEMA_ROLES[schema]
+    if len(ids) <= POINT_LOOKUP_MAX:
+        stmt = select(pk).where(pk.in_([int(i) for i in ids]))
+        return db.fetch_dataframe(stmt, role, schema)[pk.name].to_numpy(dtype="int64")
+    return db.cached_read(
+        role, schema, [table_name], ("id_set", table_name),
+        lambda: np.sort(db.fetch_dataframe(select(pk), role, schema)[pk.name]
+                        .to_numpy(dtype="int64")),
+    )
+
+
+_validators = {}
+
+
+def validator(schema: str, table_name: str):
+    """
+    Returns the (shared) Validator for schema.table_name.
+    """
+    key = (schema, table_name)
+    if key not in _validators:
+        _validators[key] = Validator(schema, table_name)
+    return _validators[key]
+
+
+def validate_record(schema: str, table_name: str, values: dict):
+    """
+    Checks one row (e.g. a form submission). Returns its error messages,
+    empty if it is valid.
+    """
+    result = validator(schema, table_name).validate([values])
+    return result.errors().get(0, [])
+
+
+# =============================================================================
+# Command line
+# =============================================================================
+
+def main(argv=None):
+    import bulk_load
+
+    parser = argparse.ArgumentParser(
+        description="Validate a CSV / Parquet file against a table without loading it.")
+    parser.add_argument("schema", choices=list(db.SCHEMA_TABLES))
+    parser.add_argument("table")
+    parser.add_argument("path")
+    parser.add_argument("--format", choices=["csv", "parquet"])
+    parser.add_argument("--batch-size", type=int, default=bulk_load.DEFAULT_BATCH_SIZE)
+    parser.add_argument("--show", type=int, default=10, help="invalid rows to print")
+    args = parser.parse_args(argv)
+
+    check = validator(args.schema, args.table)
+    total = {"rows": 0, "valid": 0, "invalid": 0, "checks": {}}
+    examples = []
+    offset = 0
+    for batch in bulk_load._batches(bulk_load.read_records(args.path, args.format),
+                                    args.batch_size):
+        result = check.validate(batch)
+        summary = result.summary()
+        for key in ("rows", "valid", "invalid"):
+            total[key] += summary[key]
+        for name, n in summary["checks"].items():
+            total["checks"][name] = total["checks"].get(name, 0) + n
+        for i, messages in result.errors().items():
+            if len(examples) >= args.show:
+                break
+            examples.append({"row": offset + i + 1, "errors": messages})
+        offset += len(batch)
+    total["examples"] = examples
+    print(json.dumps(total, indent=2, default=str))
+    return 1 if total["invalid"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,517 @@
+# write_queue.py
+#
+# Write-behind queue for the app's form submissions (add patient / medical
+# record / doctor / hospital).
+#
+# submit() appends the insert to a local SQLite journal (WAL, synced on
+# commit, so a submission survives a crash) and returns a job id at once;
+# the page never waits on PostgreSQL. A background worker thread drains the
+# journal: it claims the waiting jobs, lingers LINGER seconds so a burst
+# arrives together, and writes each schema's jobs in one unit_of_work with
+# batched multi-row INSERTs per table (db.UnitOfWork.insert_many).
+#
+# Failures:
+#   - connection problems (OperationalError / InterfaceError) are retried
+#     with exponential backoff (RETRY_BASE .. RETRY_MAX seconds), up to
+#     MAX_ATTEMPTS, then the job fails;
+#   - a batch rejected by the database (constraint, bad value) is replayed
+#     one job per savepoint, so only the offending jobs fail and the rest
+#     are committed.
+# results() reports each job's status, the new primary key or the error:
+# app.py polls it on every rerun to tell the session how its writes went.
+#
+# Several processes (serve.py) can share one journal: jobs are claimed in a
+# SQLite write transaction, with a lease; a job whose worker died is claimed
+# again after LEASE seconds. A worker renews its lease just before writing
+# and drops jobs claimed away from it, and only records results for jobs it
+# still holds, so a re-claimed job is neither written twice by two live
+# workers nor reported twice. Delivery is at-least-once: a crash between the
+# PostgreSQL commit and the journal update replays that batch.
+#
+#   python write_queue.py status
+#   python write_queue.py drain          # process everything now, then exit
+#   python write_queue.py retry          # put failed jobs back in the queue
+#   python write_queue.py purge          # drop finished jobs
+
+import argparse
+import datetime
+import decimal
+import json
+import logging
+import os
+import socket
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from sqlalchemy import exc
+from sqlalchemy.sql import sqltypes
+
+import db
+
+QUEUE_PATH = os.environ.get(
+    "WRITE_QUEUE_PATH", os.path.join(db.SCHEMA_CACHE_DIR, "write_queue.sqlite3")
+)
+BATCH_MAX = 500         # jobs per drain
+LINGER = 0.02           # seconds to wait for more jobs before writing a batch
+POLL = 1.0              # seconds between checks for jobs submitted by other processes
+LEASE = 60              # seconds before a claimed, unfinished job is claimed again
+MAX_ATTEMPTS = 8
+RETRY_BASE = 0.5        # seconds, doubled per attempt
+RETRY_MAX = 60
+RETENTION = 24 * 3600   # seconds finished jobs are kept for results()
+
+# op -> (role, schema, table); the same rows the db.*_insert_* helpers write.
+OPS = {
+    "doctor_insert_patient": ("doctor_user", "doctor_schema", "patients"),
+    "doctor_insert_medical_record": ("doctor_user", "doctor_schema", "medical_records"),
+    "admin_insert_doctor": ("admin_user", "admin_schema", "doctors"),
+    "admin_insert_hospital": ("admin_user", "admin_schema", "hospitals"),
+}
+
+_TRANSIENT = (exc.OperationalError, exc.InterfaceError)
+
+log = logging.getLogger("healthcare.write_queue")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id          INTEGER PRIMARY KEY AUTOINCREMENT,
+    op          TEXT NOT NULL,
+    payload     TEXT NOT NULL,
+    session     TEXT,
+    status      TEXT NOT NULL DEFAULT 'pending',   -- pending / running / done / failed
+    attempts    INTEGER NOT NULL DEFAULT 0,
+    not_before  REAL NOT NULL,
+    claimed_by  TEXT,
+    claimed_at  REAL,
+    created_at  REAL NOT NULL,
+    finished_at REAL,
+    result      TEXT,
+    error       TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_waiting ON jobs (status, not_before);
+CREATE INDEX IF NOT EXISTS jobs_session ON jobs (session);
+"""
+
+
+# =============================================================================
+# 1. The queue
+# =============================================================================
+
+def _encode(value):
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    if isinstance(value, decimal.Decimal):
+        return str(value)
+    raise TypeError(f"Can't queue a value of type {type(value).__name__}.")
+
+
+def _decode(table, values: dict):
+    # JSON values back to the column types (dates arrive as ISO strings).
+    out = {}
+    for name, value in values.items():
+        if name not in table.c:
+            raise ValueError(f"{table.fullname} has no column {name!r}.")
+        column_type = table.c[name].type
+        if isinstance(value, str):
+            if isinstance(column_type, sqltypes.DateTime):
+                value = datetime.datetime.fromisoformat(value)
+            elif isinstance(column_type, sqltypes.Date):
+                value = datetime.date.fromisoformat(value)
+            elif isinstance(column_type, sqltypes.Numeric) and not isinstance(
+                    column_type, sqltypes.Float):
+                value = decimal.Decimal(value)
+        out[name] = value
+    return out
+
+
+class WriteQueue:
+    """
+    A durable job journal plus the worker thread that drains it.
+    """
+
+    def __init__(self, path: str = QUEUE_PATH):
+        self.path = path
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self._ready = False
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.stats = {"submitted": 0, "batches": 0, "rows": 0, "retries": 0,
+                      "failed": 0, "isolated": 0}
+
+    # --- journal -----------------------------------------------------------
+
+    @contextmanager
+    def _connect(self):
+        if not self._ready:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=FULL")
+            if not self._ready:
+                conn.executescript(_SCHEMA)
+                self._ready = True
+            yield conn
+        finally:
+            conn.close()
+
+    def submit(self, op: str, session: str = None, **values):
+        """
+        Queues one insert (op: a key of OPS, values: its columns) and returns
+        the job id. Wakes this process's worker.
+        """
+        if op not in OPS:
+            raise ValueError(f"Unknown write {op!r}; expected one of {sorted(OPS)}.")
+        now = time.time()
+        with self._connect() as conn:
+            job_id = conn.execute(
+                "INSERT INTO jobs (op, payload, session, not_before, created_at)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (op, json.dumps(values, default=_encode), session, now, now),
+            ).lastrowid
+        with self._lock:
+            self.stats["submitted"] += 1
+        self._wake.set()
+        return job_id
+
+    def results(self, job_ids):
+        """
+        Returns {job_id: {"status", "result", "error", "attempts"}} for the
+        given jobs; result is the new row's primary key once done.
+        """
+        job_ids = [int(j) for j in job_ids]
+        if not job_ids:
+            return {}
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT id, status, result, error, attempts FROM jobs"
+                f" WHERE id IN ({', '.join('?' * len(job_ids))})", job_ids,
+            ).fetchall()
+        return {
+            job_id: {"status": status, "result": json.loads(result) if result else None,
+                     "error": error, "attempts": attempts}
+            for job_id, status, result, error, attempts in rows
+        }
+
+    def wait(self, job_id: int, timeout: float = 5.0):
+        """
+        Blocks until the job is done or failed (or timeout) and returns its
+        results() entry. For scripts; the app doesn't wait.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            job = self.results([job_id]).get(int(job_id))
+            if job is None or job["status"] in ("done", "failed") or time.monotonic() > deadline:
+                return job
+            time.sleep(0.01)
+
+    def _claim(self, limit: int = BATCH_MAX):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            rows = conn.execute(
+                "SELECT id, op, payload, attempts, session FROM jobs"
+                " WHERE (status = 'pending' AND not_before <= ?)"
+                "    OR (status = 'running' AND claimed_at < ?)"
+                " ORDER BY id LIMIT ?",
+                (now, now - LEASE, limit),
+            ).fetchall()
+            conn.executemany(
+                "UPDATE jobs SET status = 'running', claimed_by = ?, claimed_at = ? WHERE id = ?",
+                [(self.worker_id, now, r[0]) for r in rows],
+            )
+            conn.execute("COMMIT")
+        return [{"id": i, "op": op, "values": json.loads(p), "attempts": a, "session": s,
+                 "claimed_at": now}
+                for i, op, p, a, s in rows]
+
+    # A job is still ours while it is running under our worker id and the
+    # claim time we recorded; another worker re-claiming it changes both.
+    _HELD = " WHERE id = ? AND status = 'running' AND claimed_by = ? AND claimed_at = ?"
+
+    def _renew(self, group):
+        """
+        Restarts the lease on the jobs of `group` this worker still holds and
+        returns them; jobs another worker has claimed meanwhile are dropped.
+        """
+        now = time.time()
+        held = []
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            for job in group:
+                if conn.execute("UPDATE jobs SET claimed_at = ?" + self._HELD,
+                                (now, job["id"], self.worker_id, job["claimed_at"])).rowcount:
+                    job["claimed_at"] = now
+                    held.append(job)
+            conn.execute("COMMIT")
+        if len(held) < len(group):
+            log.warning("write queue: %d job(s) claimed by another worker, skipped",
+                        len(group) - len(held))
+        return held
+
+    def _finish(self, group, done: dict, failed: dict, retry: dict):
+        # done: {id: pk}; failed: {id: error}; retry: {id: (attempts, error)}
+        # Only jobs this worker still holds are updated.
+        claims = {job["id"]: job["claimed_at"] for job in group}
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            n_done = conn.executemany(
+                "UPDATE jobs SET status = 'done', result = ?, error = NULL, finished_at = ?,"
+                " attempts = attempts + 1" + self._HELD,
+                [(json.dumps(pk, default=_encode), now, i, self.worker_id, claims[i])
+                 for i, pk in done.items()],
+            ).rowcount
+            n_failed = conn.executemany(
+                "UPDATE jobs SET status = 'failed', error = ?, finished_at = ?,"
+                " attempts = attempts + 1" + self._HELD,
+                [(error, now, i, self.worker_id, claims[i]) for i, error in failed.items()],
+            ).rowcount
+            n_retry = conn.executemany(
+                "UPDATE jobs SET status = 'pending', error = ?, attempts = ?, not_before = ?,"
+                " claimed_by = NULL, claimed_at = NULL" + self._HELD,
+                [(error, attempts, now + min(RETRY_BASE * 2 ** (attempts - 1), RETRY_MAX),
+                  i, self.worker_id, claims[i])
+                 for i, (attempts, error) in retry.items()],
+            ).rowcount
+            conn.execute("COMMIT")
+        lost = len(done) + len(failed) + len(retry) - n_done - n_failed - n_retry
+        if lost:
+            log.warning("write queue: lease lost on %d job(s), result not recorded", lost)
+        with self._lock:
+            self.stats["rows"] += n_done
+            self.stats["failed"] += n_failed
+            self.stats["retries"] += n_retry
+
+    # --- draining ----------------------------------------------------------
+
+    def drain_once(self, limit: int = BATCH_MAX):
+        """
+        Claims and writes one batch of due jobs. Returns how many were claimed.
+        """
+        jobs = self._claim(limit)
+        if not jobs:
+            return 0
+        by_schema = OrderedDict()
+        unknown = {}
+        for job in jobs:
+            if job["op"] in OPS:
+                by_schema.setdefault(OPS[job["op"]][:2], []).append(job)
+            else:
+                unknown[job["id"]] = f"Unknown write {job['op']!r}."
+        if unknown:
+            self._finish(jobs, {}, unknown, {})
+        for (role, schema), group in by_schema.items():
+            group = self._renew(group)
+            if not group:
+                continue
+            done, failed, retry = {}, {}, {}
+            try:
+                done = self._write_batch(role, schema, group)
+            except _TRANSIENT as e:
+                self._reschedule(group, e, failed, retry)
+            except Exception:
+                done, failed, retry = self._write_isolated(role, schema, group)
+            self._finish(group, done, failed, retry)
+        with self._lock:
+            self.stats["batches"] += 1
+        return len(jobs)
+
+    def _rows(self, schema: str, group):
+        # {(table, column names): [(job, decoded values)]}, in job order
+        rows = OrderedDict()
+        for job in group:
+            table = db.get_table(schema, OPS[job["op"]][2])
+            values = _decode(table, job["values"])
+            rows.setdefault((table.name, tuple(sorted(values))), []).append((job, values))
+        return rows
+
+    def _write_batch(self, role: str, schema: str, group):
+        done = {}
+        with db.unit_of_work(role, schema) as uow:
+            uow.sessions.update(job["session"] for job in group if job["session"])
+            for (table_name, _), items in self._rows(schema, group).items():
+                # insert_many returns the keys in input order.
+                pks = uow.insert_many(table_name, [values for _, values in items])
+                done.update((job["id"], pk) for (job, _), pk in zip(items, pks))
+        return done
+
+    def _write_isolated(self, role: str, schema: str, group):
+        # One savepoint per job: the bad ones fail, the rest commit together.
+        with self._lock:
+            self.stats["isolated"] += 1
+        done, failed, retry = {}, {}, {}
+        try:
+            with db.unit_of_work(role, schema) as uow:
+                uow.sessions.update(job["session"] for job in group if job["session"])
+                for job in group:
+                    try:
+                        table = db.get_table(schema, OPS[job["op"]][2])
+                        values = _decode(table, job["values"])
+                        with uow.savepoint():
+                            done[job["id"]] = uow.insert(table.name, **values)
+                    except _TRANSIENT:
+                        raise
+                    except Exception as e:
+                        failed[job["id"]] = _message(e)
+        except _TRANSIENT as e:
+            done, failed = {}, {}
+            self._reschedule(group, e, failed, retry)
+        return done, failed, retry
+
+    def _reschedule(self, group, error, failed: dict, retry: dict):
+        for job in group:
+            attempts = job["attempts"] + 1
+            if attempts >= MAX_ATTEMPTS:
+                failed[job["id"]] = _message(error)
+            else:
+                retry[job["id"]] = (attempts, _message(error))
+
+    # --- worker ------------------------------------------------------------
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """
+        Starts the worker thread unless it runs already (idempotent).
+        """
+        with self._lock:
+            if self.running:
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="write-queue", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: float = 10):
+        """
+        Stops the worker after the batch in progress.
+        """
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self._thread = None
+
+    def _run(self):
+        purged_at = 0
+        while not self._stop.is_set():
+            self._wake.wait(POLL)
+            if self._stop.is_set():
+                break
+            if self._wake.is_set():
+                self._wake.clear()
+                time.sleep(LINGER)  # let the rest of a burst arrive
+            try:
+                while self.drain_once() and not self._stop.is_set():
+                    pass
+                if time.time() - purged_at > 3600:
+                    self.purge()
+                    purged_at = time.time()
+            except Exception:
+                log.exception("write queue: drain failed")
+                self._stop.wait(RETRY_BASE)
+
+    # --- maintenance -------------------------------------------------------
+
+    def counts(self):
+        """
+        Returns {status: number of jobs} plus the oldest waiting job's age.
+        """
+        with self._connect() as conn:
+            counts = dict(conn.execute("SELECT status, count(*) FROM jobs GROUP BY status"))
+            oldest = conn.execute(
+                "SELECT min(created_at) FROM jobs WHERE status IN ('pending', 'running')"
+            ).fetchone()[0]
+        counts["oldest_waiting_seconds"] = round(time.time() - oldest, 3) if oldest else None
+        return counts
+
+    def retry_failed(self):
+        """
+        Puts every failed job back in the queue. Returns how many.
+        """
+        with self._connect() as conn:
+            return conn.execute(
+                "UPDATE jobs SET status = 'pending', attempts = 0, not_before = ?,"
+                " finished_at = NULL WHERE status = 'failed'", (time.time(),),
+            ).rowcount
+
+    def purge(self, older_than: float = RETENTION):
+        """
+        Drops done jobs finished more than older_than seconds ago.
+        """
+        with self._connect() as conn:
+            return conn.execute(
+                "DELETE FROM jobs WHERE status = 'done' AND finished_at < ?",
+                (time.time() - older_than,),
+            ).rowcount
+
+
+def _message(e):
+    return str(getattr(e, "orig", None) or e).strip()
+
+
+queue = WriteQueue()
+
+
+def submit(op: str, session: str = None, **values):
+    """
+    Queues an insert on the shared queue (see WriteQueue.submit) and makes
+    sure this process's worker is running.
+    """
+    queue.start()
+    return queue.submit(op, session=session, **values)
+
+
+def results(job_ids):
+    """
+    Status / new primary key / error of each job (see WriteQueue.results).
+    """
+    return queue.results(job_ids)
+
+
+def write_queue_stats():
+    """
+    Returns this process's worker counters and the journal's job counts.
+    """
+    return dict(queue.stats, running=queue.running, path=queue.path, jobs=queue.counts())
+
+
+# =============================================================================
+# 2. Command line
+# =============================================================================
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Inspect or drain the write-behind queue.")
+    parser.add_argument("command", choices=["status", "drain", "retry", "purge"])
+    args = parser.parse_args(argv)
+
+    if args.command == "drain":
+        started = time.perf_counter()
+        claimed = 0
+        while True:
+            n = queue.drain_once()
+            if not n:
+                break
+            claimed += n
+        result = dict(queue.stats, claimed=claimed,
+                      seconds=round(time.perf_counter() - started, 3), jobs=queue.counts())
+    elif args.command == "retry":
+        result = {"requeued": queue.retry_failed()}
+    elif args.command == "purge":
+        result = {"purged": queue.purge(0)}
+    else:
+        result = write_queue_stats()
+    print(json.dumps(result, indent=2, default=str))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())